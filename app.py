@@ -1,17 +1,28 @@
 import streamlit as st
 import os
 import logging
-from datetime import datetime
+from datetime import datetime, timedelta
 from dotenv import load_dotenv
-from groq import Groq
 import sqlite3
-from werkzeug.security import generate_password_hash, check_password_hash
-import pandas as pd
-import io
-from docx import Document
-from reportlab.pdfgen import canvas
 import random
 import json
+import re
+import hashlib
+import secrets
+import time
+import queue
+import threading
+import tempfile
+import functools
+import zlib
+import sys
+import subprocess
+import socket
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing, contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from xml.sax.saxutils import escape
 
 # Load environment variables
 load_dotenv()
@@ -21,20 +32,562 @@ logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(
 
 # Database configuration
 DB_NAME = "storytelling_assistant.db"
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", 8))
+DB_BUSY_TIMEOUT_MS = int(os.getenv("DB_BUSY_TIMEOUT_MS", 5000))
+DB_STATEMENT_CACHE_SIZE = 256
+
+# Response cache configuration
+CACHE_DB_NAME = os.path.join(os.path.dirname(DB_NAME), "story_cache.db")
+CACHE_TTL_SECONDS = int(os.getenv("STORY_CACHE_TTL_SECONDS", 7 * 24 * 3600))
+CACHE_MAX_ENTRIES = int(os.getenv("STORY_CACHE_MAX_ENTRIES", 1000))
+
+STORY_MODEL = os.getenv("STORY_MODEL", "llama-3.1-70b-versatile")
+
+# LLM request policy: per-attempt deadline, jittered retries, a hedge request to a faster
+# fallback model once the primary runs past its observed p95, and a circuit breaker per model
+FALLBACK_MODEL = os.getenv("STORY_FALLBACK_MODEL", "llama-3.1-8b-instant") or None
+LLM_ATTEMPT_TIMEOUT_SECONDS = float(os.getenv("LLM_ATTEMPT_TIMEOUT_SECONDS", 60))
+LLM_MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", 2))
+LLM_BACKOFF_SECONDS = 0.5
+LLM_HEDGE_QUANTILE = 0.95
+LLM_HEDGE_MIN_SAMPLES = 20
+LLM_HEDGE_DEFAULT_SECONDS = float(os.getenv("LLM_HEDGE_DEFAULT_SECONDS", 20))
+LLM_HEDGE_MIN_SECONDS = 0.5
+CIRCUIT_FAILURE_THRESHOLD = 5
+CIRCUIT_RESET_SECONDS = 30
+
+# Fair-share LLM scheduling: every request waits for its turn in a weighted fair queue across users,
+# where interactive work weighs more than batch work, and is charged against one of the user's token
+# buckets (interactive or batch, so a batch run doesn't use up the user's allowance in the app) and
+# the provider-wide one. A rate of 0 means no limit
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", 8))
+# Executor threads beyond a primary and a hedge per turn, for abandoned attempts still winding down
+LLM_EXECUTOR_HEADROOM = LLM_MAX_CONCURRENCY
+LLM_TOKENS_PER_MINUTE = int(os.getenv("LLM_TOKENS_PER_MINUTE", 0))
+USER_TOKENS_PER_MINUTE = int(os.getenv("USER_TOKENS_PER_MINUTE", 10000))
+USER_TOKEN_BURST = int(os.getenv("USER_TOKEN_BURST", 20000))
+BATCH_TOKENS_PER_MINUTE = int(os.getenv("BATCH_TOKENS_PER_MINUTE", 0))
+LLM_BUDGET_LOG_SECONDS = 1.0
+LLM_DEFAULT_COMPLETION_TOKENS = 800
+LLM_SCHEDULER_MAX_USERS = 1000
+LLM_PRIORITIES = {
+    'interactive': {'weight': 4, 'queue_timeout': float(os.getenv("LLM_QUEUE_TIMEOUT_SECONDS", 60))},
+    'batch': {'weight': 1, 'queue_timeout': None}
+}
+USAGE_HISTORY_DAYS = 30
+
+NARRATIVE_STRUCTURES = [
+    "Story-Spine (Default)",
+    "The Story Hanger",
+    "Hero's Journey",
+    "Beginning to End",
+    "In Media Res",
+    "Nested Loops",
+    "The Cliffhanger"
+]
+
+# Multi-draft generation
+MAX_DRAFTS = 5
+DRAFT_MAX_CONCURRENCY = int(os.getenv("DRAFT_MAX_CONCURRENCY", 3))
+
+# Well-known tale corpus
+TALES_FILE = os.path.join('db', 'well_known_tales.xlsx')
+
+# Prompt token budget: source material over its share is condensed before it is sent
+PROMPT_TOKEN_BUDGET = int(os.getenv("PROMPT_TOKEN_BUDGET", 1200))
+TALE_TOKEN_BUDGET = int(os.getenv("TALE_TOKEN_BUDGET", 250))
+USER_START_TOKEN_BUDGET = int(os.getenv("USER_START_TOKEN_BUDGET", 400))
+TOKEN_PATTERN = re.compile(r"\w+|[^\w\s]")
+SENTENCE_PATTERN = re.compile(r"(?<=[.!?])[\"')\]]*\s+")
+STOPWORDS = frozenset("""
+    a an the and or but if of to in on at by for with from as is was were be been being are am it its
+    this that these those he she they we you i his her their our my your them him us me not no so than
+    then there which who whom what when where why how all any into over out up down about after before
+    also just only very can could would should will shall has have had do did does one into through
+""".split())
+
+# Section editing: a span of paragraphs is regenerated, expanded or continued with only
+# SECTION_CONTEXT_TOKENS of the story on either side as context, and the reply is capped relative
+# to the span's length instead of being a whole new story
+SECTION_CONTEXT_TOKENS = int(os.getenv("SECTION_CONTEXT_TOKENS", 150))
+SECTION_COMPLETION_HEADROOM = 64
+SECTION_ACTIONS = {
+    'regenerate': {
+        'label': "Regenerate",
+        'length_factor': 1.0,
+        'instruction': "Rewrite the SECTION so it reads differently but still fits between the text before and after it."
+    },
+    'expand': {
+        'label': "Expand",
+        'length_factor': 2.0,
+        'instruction': "Expand the SECTION with more detail, dialogue or description, keeping its events and tone."
+    },
+    'continue': {
+        'label': "Continue",
+        'length_factor': 1.0,
+        'instruction': "Write the passage that comes right after the SECTION, leading into the text after it if there is any."
+    }
+}
+
+# Near-duplicate detection: 32 LSH bands of 4 MinHash rows make stories that are ~50% similar
+# or more share a bucket with high probability
+MINHASH_PERMUTATIONS = 128
+MINHASH_PRIME = (1 << 31) - 1
+MINHASH_SEED = 20240901
+SHINGLE_SIZE = 3
+LSH_BANDS = 32
+LSH_MAX_CANDIDATES = 200
+SIMILAR_STORY_THRESHOLD = 0.5
+NEAR_DUPLICATE_THRESHOLD = 0.8
+
+# Story revisions: a full snapshot is stored once the deltas since the last one add up to the
+# size of the text, or after REVISION_MAX_CHAIN deltas, so storage follows the size of the edits
+REVISION_MAX_CHAIN = 50
+# Word-level diffing of a changed run of sentences is skipped (the run is stored as is) above this
+DELTA_MAX_COMPARISONS = 250000
+
+# Story storage: stories.content is zlib-compressed, with a preset dictionary trained on the saved
+# stories once there are COMPRESSION_MIN_SAMPLES of them. Story parameters are also kept in typed,
+# indexed columns (lists in story_tags) so filtering doesn't parse JSON row by row
+COMPRESSION_LEVEL = 9
+COMPRESSION_DICTIONARY_SIZE = 32 * 1024
+COMPRESSION_MIN_SAMPLES = 50
+COMPRESSION_SAMPLE_SIZE = 500
+STORY_PARAMETER_COLUMNS = [
+    ('story_origin', 'TEXT'),
+    ('use_case', 'TEXT'),
+    ('time_frame', 'TEXT'),
+    ('age', 'INTEGER'),
+    ('length', 'TEXT'),
+    ('story_type', 'TEXT'),
+    ('narrative_structure', 'TEXT'),
+    ('simplified_structure', 'TEXT')
+]
+STORY_TAG_PARAMETERS = ['focus', 'creative_enhancements']
+
+# Saved stories listed per "load more" page in the sidebar
+STORY_PAGE_SIZE = 20
+
+# Professional availability: hourly slots on weekdays, kept generated SLOT_WINDOW_DAYS ahead
+SLOT_WINDOW_DAYS = 14
+SLOT_FIRST_HOUR = 9
+SLOT_LAST_HOUR = 17
+SLOTS_SHOWN = 5
+DEFAULT_PROFESSIONALS = [
+    ("John Doe", "Expert storyteller with 10 years of experience in corporate narratives.", 10, 4.8, 150),
+    ("Jane Smith", "Specializes in personal branding stories with a touch of humor.", 8, 4.7, 120),
+    ("Mike Johnson", "Master of fantasy tales and creative writing workshops.", 15, 4.9, 200),
+    ("Sarah Brown", "Focuses on inspirational stories for motivational speaking.", 12, 4.6, 180),
+    ("David Lee", "Experienced in crafting compelling product launch stories.", 7, 4.5, 100),
+]
+
+# Per-session read cache: entries are dropped when a write bumps their scope's version, or after
+# the TTL so writes from other processes (e.g. batch_generate.py) show up eventually
+SESSION_CACHE_MAX_ENTRIES = 64
+SESSION_CACHE_TTL_SECONDS = 300
+
+# Logins: a session token (only its SHA-256 is stored) keeps the user logged in across browser
+# refreshes, so the deliberately slow password KDF runs only on a real login. Password checks run
+# on a small worker pool, with LOGIN_MAX_ATTEMPTS tries per username per window
+SESSION_TTL_SECONDS = int(os.getenv("SESSION_TTL_SECONDS", 30 * 24 * 3600))
+SESSION_TOKEN_BYTES = 32
+SESSION_COOKIE_NAME = 'storyteller_session'
+PASSWORD_HASH_METHOD = os.getenv("PASSWORD_HASH_METHOD", "scrypt:32768:8:1")
+PASSWORD_WORKERS = int(os.getenv("PASSWORD_WORKERS", 2))
+PASSWORD_MAX_PENDING = 32
+PASSWORD_TIMEOUT_SECONDS = 10
+LOGIN_MAX_ATTEMPTS = 5
+LOGIN_WINDOW_SECONDS = 300
+LOGIN_THROTTLE_MAX_USERNAMES = 10000
+
+# Full-text search results shown per section in the sidebar
+SEARCH_RESULT_LIMIT = 10
+
+# Background generation jobs
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", 4))
+JOB_POLL_SECONDS = 1.0
+JOB_PROGRESS_INTERVAL_SECONDS = 0.25
+# How often the page refreshes a job; a running job is read from memory when it runs in this process
+JOB_PAGE_POLL_SECONDS = 0.25
+JOB_LEASE_SECONDS = 60
+JOB_RETENTION_SECONDS = 24 * 3600
+
+# Export cache: built files are memoized by (content hash, format)
+EXPORT_CACHE_MAX_BYTES = int(os.getenv("EXPORT_CACHE_MAX_BYTES", 32 * 1024 * 1024))
+EXPORT_SPOOL_MAX_BYTES = 1024 * 1024
+EXPORT_MIME_TYPES = {
+    'txt': 'text/plain',
+    'docx': 'application/vnd.openxmlformats-officedocument.wordprocessingml.document',
+    'pdf': 'application/pdf'
+}
+
+# Metrics: Prometheus text is served on METRICS_PORT and/or written to METRICS_FILE when set
+METRICS_PORT = int(os.getenv("METRICS_PORT", 0))
+METRICS_FILE = os.getenv("METRICS_FILE")
+METRICS_FILE_INTERVAL_SECONDS = 5
+ADMIN_USERNAMES = {name.strip() for name in os.getenv("ADMIN_USERNAMES", "").split(",") if name.strip()}
+LATENCY_BUCKETS = [0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120]
+TOKEN_BUCKETS = [64, 128, 256, 512, 1024, 2048, 4096, 8192]
+ROW_BUCKETS = [0, 1, 5, 10, 50, 100, 500, 1000, 5000, 10000, 100000]
+BYTE_BUCKETS = [1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216]
 
 # Create db directory if it doesn't exist
 if not os.path.exists('db'):
     os.makedirs('db')
 
-# Initialize Groq client
-groq_client = Groq(api_key=os.getenv("GROQ_API_KEY"))
+# Groq client, created on first use. Assign a client object here to override it (e.g. in tests)
+groq_client = None
 
+# Heavy dependencies are imported by the code paths that need them; listed for --startup-report
+DEFERRED_IMPORTS = ['groq', 'pandas', 'openpyxl', 'docx', 'reportlab.platypus', 'werkzeug.security']
 
-# Database functions
-def init_db():
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
+
+@st.cache_resource
+def _create_groq_client():
+    from groq import Groq
+    # Retries are done by the request policy in generate_story_with_usage / generate_story_stream
+    return Groq(api_key=os.getenv("GROQ_API_KEY"), max_retries=0)
+
+def get_groq_client():
+    return groq_client or _create_groq_client()
+
+
+# Connection pool
+def _open_connection(db_name):
+    conn = sqlite3.connect(
+        db_name,
+        timeout=DB_BUSY_TIMEOUT_MS / 1000,
+        check_same_thread=False,
+        cached_statements=DB_STATEMENT_CACHE_SIZE
+    )
+    conn.execute('PRAGMA journal_mode = WAL')
+    conn.execute(f'PRAGMA busy_timeout = {DB_BUSY_TIMEOUT_MS}')
+    conn.execute('PRAGMA synchronous = NORMAL')
+    register_story_functions(conn, db_name)
+    return conn
+
+def register_story_functions(conn, db_name=None):
+    # Story text is stored compressed; SQL (search triggers, the stories_text view) reads it through
+    # story_text(). Other tools must call this on their own connections before writing to stories,
+    # or the search index triggers fail with "no such function: story_text"
+    conn.create_function('story_text', 1, functools.partial(decompress_text, db_name=db_name or DB_NAME), deterministic=True)
+
+@st.cache_resource
+def get_connection_pool(db_name):
+    # Shared across sessions and reruns; each connection is checked out by one thread at a time
+    return queue.LifoQueue(maxsize=DB_POOL_SIZE)
+
+@contextmanager
+def db_connection(db_name=None):
+    db_name = db_name or DB_NAME
+    pool = get_connection_pool(db_name)
+    try:
+        conn = pool.get_nowait()
+    except queue.Empty:
+        conn = _open_connection(db_name)
+    
+    try:
+        ensure_schema(db_name)
+        yield conn
+    finally:
+        if conn.in_transaction:
+            conn.rollback()
+        try:
+            pool.put_nowait(conn)
+        except queue.Full:
+            conn.close()
+
+@st.cache_resource
+def get_schema_state():
+    return {'ready': set(), 'initializing': set(), 'lock': threading.RLock()}
+
+def ensure_schema(db_name):
+    # Tables are created on the first connection a process makes to each database,
+    # so pages that never touch the database (e.g. the login form) don't pay for it
+    state = get_schema_state()
+    if db_name in state['ready']:
+        return
+    with state['lock']:
+        if db_name in state['ready'] or db_name in state['initializing']:
+            return
+        state['initializing'].add(db_name)
+        try:
+            if db_name == CACHE_DB_NAME:
+                init_cache_db()
+            else:
+                init_db()
+            state['ready'].add(db_name)
+        finally:
+            state['initializing'].discard(db_name)
+
+def close_connection_pool(db_name=None):
+    pool = get_connection_pool(db_name or DB_NAME)
+    while True:
+        try:
+            pool.get_nowait().close()
+        except queue.Empty:
+            break
+
+
+# Metrics
+def get_metric_definitions():
+    return {
+        'storyteller_llm_request_seconds': ('histogram', "LLM request latency, start of request to last token", LATENCY_BUCKETS),
+        'storyteller_llm_time_to_first_token_seconds': ('histogram', "Time from sending a streamed request to its first text chunk", LATENCY_BUCKETS),
+        'storyteller_llm_prompt_tokens_total': ('counter', "Prompt tokens sent to the LLM", None),
+        'storyteller_llm_completion_tokens_total': ('counter', "Completion tokens received from the LLM", None),
+        'storyteller_llm_errors_total': ('counter', "Failed LLM requests", None),
+        'storyteller_prompt_tokens': ('histogram', "Estimated size of prompts sent to the LLM", TOKEN_BUCKETS),
+        'storyteller_prompt_tokens_saved_total': ('counter', "Estimated prompt tokens saved by condensing source material", None),
+        'storyteller_section_edits_total': ('counter', "Story sections regenerated, expanded or continued", None),
+        'storyteller_llm_retries_total': ('counter', "LLM requests retried after a failed attempt", None),
+        'storyteller_llm_hedges_total': ('counter', "Hedge requests sent to the fallback model", None),
+        'storyteller_llm_hedge_wins_total': ('counter', "Hedge requests that answered before the primary model", None),
+        'storyteller_llm_circuit_open': ('gauge', "1 while the circuit breaker of a model is open", None),
+        'storyteller_llm_circuit_opened_total': ('counter', "Times the circuit breaker of a model opened", None),
+        'storyteller_llm_queue_seconds': ('histogram', "Time LLM requests waited for their turn in the fair-share queue", LATENCY_BUCKETS),
+        'storyteller_llm_queue_depth': ('gauge', "LLM requests waiting in the fair-share queue", None),
+        'storyteller_llm_in_flight': ('gauge', "LLM requests holding a turn", None),
+        'storyteller_llm_throttled_total': ('counter', "LLM requests refused by the fair-share scheduler", None),
+        'storyteller_db_query_seconds': ('histogram', "Latency of data-access functions", LATENCY_BUCKETS),
+        'storyteller_db_rows': ('histogram', "Rows returned or written by data-access functions", ROW_BUCKETS),
+        'storyteller_db_errors_total': ('counter', "Data-access functions that raised", None),
+        'storyteller_export_build_seconds': ('histogram', "Time to build a download file", LATENCY_BUCKETS),
+        'storyteller_export_bytes': ('histogram', "Size of built download files", BYTE_BUCKETS),
+        'storyteller_rerun_seconds': ('histogram', "Total time of one Streamlit script run", LATENCY_BUCKETS),
+        'storyteller_fragment_seconds': ('histogram', "Time of one fragment run, on its own or within a script run", LATENCY_BUCKETS),
+        'storyteller_run_queries': ('histogram', "Data-access calls made during one script or fragment run", ROW_BUCKETS),
+        'storyteller_session_cache_total': ('counter', "Lookups in the per-session read cache", None),
+        'storyteller_response_cache_total': ('counter', "Lookups in the story response cache", None),
+        'storyteller_booking_conflicts_total': ('counter', "Bookings refused because the slot was already taken", None),
+        'storyteller_logins_total': ('counter', "Login attempts by how they ended", None),
+        'storyteller_password_hash_seconds': ('histogram', "Time to hash or verify a password, including the wait for a worker", LATENCY_BUCKETS),
+        'storyteller_password_rehash_total': ('counter', "Password hashes upgraded to the current KDF parameters on login", None),
+        'storyteller_job_wait_seconds': ('histogram', "Time generation jobs spent queued before a worker picked them up", LATENCY_BUCKETS),
+        'storyteller_job_run_seconds': ('histogram', "Time workers spent running generation jobs", LATENCY_BUCKETS),
+        'storyteller_job_queue_depth': ('gauge', "Generation jobs waiting for a worker", None),
+        'storyteller_job_workers': ('gauge', "Generation worker threads in this process", None),
+        'storyteller_job_workers_busy': ('gauge', "Generation worker threads currently running a job", None)
+    }
+
+@st.cache_resource
+def get_metrics_registry():
+    # Process-wide, so it aggregates across sessions and survives reruns
+    return {'counters': {}, 'histograms': {}, 'lock': threading.Lock(), 'last_file_write': 0.0}
+
+def _metric_key(name, labels):
+    return (name, tuple(sorted((key, str(value)) for key, value in labels.items())))
+
+def set_gauge(name, value, **labels):
+    # Gauges share the counters dict; only the way they are updated differs
+    registry = get_metrics_registry()
+    key = _metric_key(name, labels)
+    with registry['lock']:
+        registry['counters'][key] = value
+
+def increment_counter(name, amount=1, **labels):
+    registry = get_metrics_registry()
+    key = _metric_key(name, labels)
+    with registry['lock']:
+        registry['counters'][key] = registry['counters'].get(key, 0) + amount
+
+def observe(name, value, **labels):
+    registry = get_metrics_registry()
+    buckets = get_metric_definitions()[name][2]
+    key = _metric_key(name, labels)
+    with registry['lock']:
+        histogram = registry['histograms'].get(key)
+        if histogram is None:
+            histogram = {'counts': [0] * len(buckets), 'sum': 0.0, 'count': 0}
+            registry['histograms'][key] = histogram
+        for i, bound in enumerate(buckets):
+            if value <= bound:
+                histogram['counts'][i] += 1
+                break
+        histogram['sum'] += value
+        histogram['count'] += 1
+
+@contextmanager
+def timed(name, **labels):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - start, **labels)
+
+def _row_count(result):
+    if isinstance(result, (list, tuple)):
+        return len(result)
+    return 0 if result is None else 1
+
+# Data-access calls made by the current thread, so a script or fragment run can report its own
+_thread_queries = threading.local()
+
+def queries_in_thread():
+    return getattr(_thread_queries, 'count', 0)
+
+def instrument_query(func):
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        _thread_queries.count = queries_in_thread() + 1
+        start = time.perf_counter()
+        try:
+            result = func(*args, **kwargs)
+        except Exception:
+            increment_counter('storyteller_db_errors_total', query=func.__name__)
+            raise
+        finally:
+            observe('storyteller_db_query_seconds', time.perf_counter() - start, query=func.__name__)
+        observe('storyteller_db_rows', _row_count(result), query=func.__name__)
+        return result
+    return wrapper
+
+def instrument_fragment(func):
+    # Goes under @st.fragment, so fragment-only reruns are measured too
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        queries = queries_in_thread()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            observe('storyteller_fragment_seconds', time.perf_counter() - start, fragment=func.__name__)
+            observe('storyteller_run_queries', queries_in_thread() - queries, run=func.__name__)
+    return wrapper
+
+def _format_labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ''
+    escaped = [(key, value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')) for key, value in pairs]
+    return '{' + ','.join(f'{key}="{value}"' for key, value in escaped) + '}'
+
+def render_prometheus_metrics():
+    registry = get_metrics_registry()
+    with registry['lock']:
+        counters = dict(registry['counters'])
+        histograms = {key: {'counts': list(value['counts']), 'sum': value['sum'], 'count': value['count']}
+                      for key, value in registry['histograms'].items()}
+    
+    lines = []
+    for name, (metric_type, help_text, buckets) in get_metric_definitions().items():
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {metric_type}")
+        if metric_type in ('counter', 'gauge'):
+            for (metric_name, labels), value in sorted(counters.items()):
+                if metric_name == name:
+                    lines.append(f"{name}{_format_labels(labels)} {value}")
+        else:
+            for (metric_name, labels), histogram in sorted(histograms.items()):
+                if metric_name != name:
+                    continue
+                cumulative = 0
+                for bound, count in zip(buckets, histogram['counts']):
+                    cumulative += count
+                    lines.append(f"{name}_bucket{_format_labels(labels, [('le', repr(float(bound)))])} {cumulative}")
+                lines.append(f"{name}_bucket{_format_labels(labels, [('le', '+Inf')])} {histogram['count']}")
+                lines.append(f"{name}_sum{_format_labels(labels)} {histogram['sum']}")
+                lines.append(f"{name}_count{_format_labels(labels)} {histogram['count']}")
+    return "\n".join(lines) + "\n"
+
+def histogram_quantile(quantile, buckets, counts, total):
+    # Same linear interpolation inside the bucket that Prometheus' histogram_quantile uses
+    if not total:
+        return None
+    rank = quantile * total
+    cumulative = 0
+    lower = 0.0
+    for bound, count in zip(buckets, counts):
+        if cumulative + count >= rank and count:
+            return lower + (bound - lower) * (rank - cumulative) / count
+        cumulative += count
+        lower = bound
+    return buckets[-1]
+
+def get_quantile(name, quantile, **labels):
+    # Returns (estimate, sample count) of one histogram series, or (None, 0) before any samples
+    registry = get_metrics_registry()
+    buckets = get_metric_definitions()[name][2]
+    with registry['lock']:
+        histogram = registry['histograms'].get(_metric_key(name, labels))
+        if histogram is None:
+            return None, 0
+        counts = list(histogram['counts'])
+        total = histogram['count']
+    return histogram_quantile(quantile, buckets, counts, total), total
+
+def get_metrics_summary():
+    registry = get_metrics_registry()
+    definitions = get_metric_definitions()
+    with registry['lock']:
+        histograms = [(key, dict(value, counts=list(value['counts']))) for key, value in registry['histograms'].items()]
+        counters = dict(registry['counters'])
+    
+    summary = []
+    for (name, labels), histogram in sorted(histograms):
+        buckets = definitions[name][2]
+        summary.append({
+            'metric': name,
+            'labels': ', '.join(f"{key}={value}" for key, value in labels),
+            'count': histogram['count'],
+            'mean': histogram['sum'] / histogram['count'] if histogram['count'] else None,
+            'p50': histogram_quantile(0.5, buckets, histogram['counts'], histogram['count']),
+            'p95': histogram_quantile(0.95, buckets, histogram['counts'], histogram['count']),
+            'p99': histogram_quantile(0.99, buckets, histogram['counts'], histogram['count'])
+        })
+    return summary, counters
+
+def write_metrics_file(force=False):
+    if not METRICS_FILE:
+        return
+    registry = get_metrics_registry()
+    now = time.time()
+    if not force and now - registry['last_file_write'] < METRICS_FILE_INTERVAL_SECONDS:
+        return
+    registry['last_file_write'] = now
+    
+    # Write then rename so a scraper never reads a half-written file
+    temp_path = f"{METRICS_FILE}.tmp"
+    try:
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            f.write(render_prometheus_metrics())
+        os.replace(temp_path, METRICS_FILE)
+    except OSError as e:
+        logging.error(f"Error writing metrics file: {str(e)}")
+
+@st.cache_resource
+def start_metrics_server(port):
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?')[0] != '/metrics':
+                self.send_error(404)
+                return
+            payload = render_prometheus_metrics().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+        
+        def log_message(self, format, *args):
+            pass
     
+    server = ThreadingHTTPServer(('0.0.0.0', port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True, name="metrics-server").start()
+    logging.info(f"Serving Prometheus metrics on port {port}")
+    return server
+
+
+# Schema migrations
+# Each migration runs once per database, in order, inside a transaction; PRAGMA user_version
+# records how many have been applied. Append new migrations, never edit or reorder applied ones.
+def _table_columns(cursor, table):
+    cursor.execute(f"PRAGMA table_info({table})")
+    return [column[1] for column in cursor.fetchall()]
+
+def _migrate_base_schema(cursor):
+    # Databases created before migrations existed may already hold older versions of these tables
     cursor.execute('''
         CREATE TABLE IF NOT EXISTS users (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -48,29 +601,19 @@ def init_db():
         )
     ''')
     
-    # Check if the 'parameters' column exists in the stories table
-    cursor.execute("PRAGMA table_info(stories)")
-    columns = [column[1] for column in cursor.fetchall()]
-    
-    if 'parameters' not in columns:
-        # Add the 'parameters' column to the stories table
-        cursor.execute('''
-            ALTER TABLE stories
-            ADD COLUMN parameters TEXT
-        ''')
-    else:
-        # If the table doesn't exist, create it with all columns
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS stories (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER NOT NULL,
-                title TEXT NOT NULL,
-                content TEXT NOT NULL,
-                parameters TEXT,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY (user_id) REFERENCES users (id)
-            )
-        ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS stories (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            title TEXT NOT NULL,
+            content TEXT NOT NULL,
+            parameters TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users (id)
+        )
+    ''')
+    if 'parameters' not in _table_columns(cursor, 'stories'):
+        cursor.execute('ALTER TABLE stories ADD COLUMN parameters TEXT')
     
     cursor.execute('''
         CREATE TABLE IF NOT EXISTS professionals (
@@ -82,7 +625,13 @@ def init_db():
             price FLOAT NOT NULL
         )
     ''')
+    if 'price' not in _table_columns(cursor, 'professionals'):
+        cursor.execute('ALTER TABLE professionals ADD COLUMN price FLOAT')
     
+    bookings_columns = _table_columns(cursor, 'bookings')
+    if bookings_columns and 'professional_id' not in bookings_columns:
+        # Early databases booked "storytellers" by date; carry those rows over to the current layout
+        cursor.execute('ALTER TABLE bookings RENAME TO bookings_legacy')
     cursor.execute('''
         CREATE TABLE IF NOT EXISTS bookings (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -94,223 +643,2901 @@ def init_db():
             FOREIGN KEY (professional_id) REFERENCES professionals (id)
         )
     ''')
+    if bookings_columns and 'professional_id' not in bookings_columns:
+        cursor.execute('''
+            INSERT INTO bookings (id, user_id, professional_id, slot)
+            SELECT id, user_id, storyteller_id, session_date FROM bookings_legacy
+        ''')
+        cursor.execute('DROP TABLE bookings_legacy')
+    
+    # Compiled copy of the tale spreadsheet, rebuilt when its hash changes
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS well_known_tales (
+            position INTEGER PRIMARY KEY,
+            title TEXT NOT NULL,
+            text TEXT NOT NULL
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS tale_corpus_meta (
+            key TEXT PRIMARY KEY,
+            value TEXT NOT NULL
+        )
+    ''')
+
+def _migrate_indexes(cursor):
+    # Serves the sidebar listing: WHERE user_id = ? ORDER BY created_at DESC, id DESC
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_stories_user_created ON stories (user_id, created_at, id)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_bookings_user ON bookings (user_id)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_bookings_professional ON bookings (professional_id)')
+
+def _migrate_search_index(cursor):
+    cursor.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name IN ('stories_fts', 'tales_fts')")
+    existing = {row[0] for row in cursor.fetchall()}
+    
+    # External-content FTS5 tables: the text lives only in stories/well_known_tales,
+    # the triggers keep the inverted index in step with every insert, update and delete
+    if 'stories_fts' not in existing:
+        cursor.execute('''
+            CREATE VIRTUAL TABLE stories_fts USING fts5(
+                title, content, content='stories', content_rowid='id', tokenize='porter unicode61'
+            )
+        ''')
+        cursor.execute("INSERT INTO stories_fts (stories_fts) VALUES ('rebuild')")
+    
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS stories_fts_insert AFTER INSERT ON stories BEGIN
+            INSERT INTO stories_fts (rowid, title, content) VALUES (new.id, new.title, new.content);
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS stories_fts_delete AFTER DELETE ON stories BEGIN
+            INSERT INTO stories_fts (stories_fts, rowid, title, content) VALUES ('delete', old.id, old.title, old.content);
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS stories_fts_update AFTER UPDATE OF title, content ON stories BEGIN
+            INSERT INTO stories_fts (stories_fts, rowid, title, content) VALUES ('delete', old.id, old.title, old.content);
+            INSERT INTO stories_fts (rowid, title, content) VALUES (new.id, new.title, new.content);
+        END
+    ''')
+    
+    if 'tales_fts' not in existing:
+        cursor.execute('''
+            CREATE VIRTUAL TABLE tales_fts USING fts5(
+                title, text, content='well_known_tales', content_rowid='position', tokenize='porter unicode61'
+            )
+        ''')
+        cursor.execute("INSERT INTO tales_fts (tales_fts) VALUES ('rebuild')")
+    
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS tales_fts_insert AFTER INSERT ON well_known_tales BEGIN
+            INSERT INTO tales_fts (rowid, title, text) VALUES (new.position, new.title, new.text);
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS tales_fts_delete AFTER DELETE ON well_known_tales BEGIN
+            INSERT INTO tales_fts (tales_fts, rowid, title, text) VALUES ('delete', old.position, old.title, old.text);
+        END
+    ''')
+
+def _migrate_cache_schema(cursor):
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS story_cache (
+            cache_key TEXT PRIMARY KEY,
+            request TEXT NOT NULL,
+            response TEXT NOT NULL,
+            created_at REAL NOT NULL,
+            last_accessed REAL NOT NULL,
+            hits INTEGER NOT NULL DEFAULT 0
+        )
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_story_cache_last_accessed ON story_cache (last_accessed)')
+    
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS story_cache_stats (
+            name TEXT PRIMARY KEY,
+            value INTEGER NOT NULL DEFAULT 0
+        )
+    ''')
+    cursor.execute("INSERT OR IGNORE INTO story_cache_stats (name, value) VALUES ('hits', 0), ('misses', 0), ('evictions', 0)")
+
+def _migrate_generation_jobs(cursor):
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS generation_jobs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            status TEXT NOT NULL DEFAULT 'queued',
+            parameters TEXT NOT NULL,
+            selected_tale_text TEXT,
+            bypass_cache INTEGER NOT NULL DEFAULT 0,
+            partial TEXT,
+            result TEXT,
+            error TEXT,
+            attached INTEGER NOT NULL DEFAULT 0,
+            created_at REAL NOT NULL,
+            started_at REAL,
+            heartbeat_at REAL,
+            finished_at REAL,
+            FOREIGN KEY (user_id) REFERENCES users (id)
+        )
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_generation_jobs_status ON generation_jobs (status, created_at)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_generation_jobs_user ON generation_jobs (user_id, attached, created_at)')
+
+def _migrate_tale_summaries(cursor):
+    # Prompt-sized summaries are compiled with the corpus; clearing the meta forces a recompile
+    if 'summary' not in _table_columns(cursor, 'well_known_tales'):
+        cursor.execute('ALTER TABLE well_known_tales ADD COLUMN summary TEXT')
+    cursor.execute('DELETE FROM tale_corpus_meta')
+
+def _migrate_similarity_index(cursor):
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS story_signatures (
+            story_id INTEGER PRIMARY KEY,
+            content_hash TEXT NOT NULL,
+            signature BLOB NOT NULL,
+            FOREIGN KEY (story_id) REFERENCES stories (id)
+        )
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_story_signatures_hash ON story_signatures (content_hash)')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS story_lsh_buckets (
+            user_id INTEGER NOT NULL,
+            band INTEGER NOT NULL,
+            bucket INTEGER NOT NULL,
+            story_id INTEGER NOT NULL,
+            PRIMARY KEY (user_id, band, bucket, story_id)
+        ) WITHOUT ROWID
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_story_lsh_buckets_story ON story_lsh_buckets (story_id)')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS stories_similarity_delete AFTER DELETE ON stories BEGIN
+            DELETE FROM story_signatures WHERE story_id = old.id;
+            DELETE FROM story_lsh_buckets WHERE story_id = old.id;
+        END
+    ''')
+    
+    # Signatures can't be computed in SQL, so existing stories are indexed here in batches
+    last_id = 0
+    while True:
+        cursor.execute('SELECT id, user_id, content FROM stories WHERE id > ? ORDER BY id LIMIT 1000', (last_id,))
+        batch = cursor.fetchall()
+        if not batch:
+            break
+        for story_id, user_id, content in batch:
+            _index_story(cursor, story_id, user_id, content or '')
+        last_id = batch[-1][0]
+
+def _migrate_story_revisions(cursor):
+    # Existing stories become revision 1; nothing to backfill since the head stays in stories
+    columns = _table_columns(cursor, 'stories')
+    if 'revision' not in columns:
+        cursor.execute('ALTER TABLE stories ADD COLUMN revision INTEGER NOT NULL DEFAULT 1')
+    if 'revised_at' not in columns:
+        cursor.execute('ALTER TABLE stories ADD COLUMN revised_at TIMESTAMP')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS story_revisions (
+            story_id INTEGER NOT NULL,
+            revision INTEGER NOT NULL,
+            kind TEXT NOT NULL,
+            data BLOB NOT NULL,
+            parameters TEXT,
+            size INTEGER NOT NULL,
+            created_at TIMESTAMP,
+            PRIMARY KEY (story_id, revision),
+            FOREIGN KEY (story_id) REFERENCES stories (id)
+        ) WITHOUT ROWID
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS stories_revisions_delete AFTER DELETE ON stories BEGIN
+            DELETE FROM story_revisions WHERE story_id = old.id;
+        END
+    ''')
+
+def _migrate_story_storage(cursor):
+    columns = _table_columns(cursor, 'stories')
+    for column, column_type in STORY_PARAMETER_COLUMNS:
+        if column not in columns:
+            cursor.execute(f'ALTER TABLE stories ADD COLUMN {column} {column_type}')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_stories_structure ON stories (narrative_structure, use_case)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_stories_use_case ON stories (use_case, story_type)')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS story_tags (
+            kind TEXT NOT NULL,
+            value TEXT NOT NULL,
+            story_id INTEGER NOT NULL,
+            PRIMARY KEY (kind, value, story_id),
+            FOREIGN KEY (story_id) REFERENCES stories (id)
+        ) WITHOUT ROWID
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_story_tags_story ON story_tags (story_id)')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS stories_tags_delete AFTER DELETE ON stories BEGIN
+            DELETE FROM story_tags WHERE story_id = old.id;
+        END
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS compression_dictionaries (
+            id INTEGER PRIMARY KEY,
+            data BLOB NOT NULL,
+            samples INTEGER NOT NULL,
+            created_at REAL NOT NULL
+        )
+    ''')
+    
+    # The search index can't read compressed text, so it is rebuilt on a view that decompresses it.
+    # From here on the triggers call story_text(), so writing to stories needs a connection set up
+    # by register_story_functions
+    for trigger in ('stories_fts_insert', 'stories_fts_delete', 'stories_fts_update'):
+        cursor.execute(f'DROP TRIGGER IF EXISTS {trigger}')
+    cursor.execute('DROP TABLE IF EXISTS stories_fts')
+    cursor.execute('CREATE VIEW IF NOT EXISTS stories_text AS SELECT id, title, story_text(content) AS content FROM stories')
+    
+    _compact_stories(cursor)
+    
+    cursor.execute('''
+        CREATE VIRTUAL TABLE stories_fts USING fts5(
+            title, content, content='stories_text', content_rowid='id', tokenize='porter unicode61'
+        )
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER stories_fts_insert AFTER INSERT ON stories BEGIN
+            INSERT INTO stories_fts (rowid, title, content) VALUES (new.id, new.title, story_text(new.content));
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER stories_fts_delete AFTER DELETE ON stories BEGIN
+            INSERT INTO stories_fts (stories_fts, rowid, title, content) VALUES ('delete', old.id, old.title, story_text(old.content));
+        END
+    ''')
+    # Recompressing a story changes the stored bytes but not the text; only text changes are reindexed
+    cursor.execute('''
+        CREATE TRIGGER stories_fts_update AFTER UPDATE OF title, content ON stories
+        WHEN old.title IS NOT new.title OR story_text(old.content) IS NOT story_text(new.content) BEGIN
+            INSERT INTO stories_fts (stories_fts, rowid, title, content) VALUES ('delete', old.id, old.title, story_text(old.content));
+            INSERT INTO stories_fts (rowid, title, content) VALUES (new.id, new.title, story_text(new.content));
+        END
+    ''')
+    cursor.execute("INSERT INTO stories_fts (stories_fts) VALUES ('rebuild')")
+
+def _migrate_availability(cursor):
+    # One row per bookable hour; the UNIQUE constraint doubles as the (professional_id, start_time)
+    # index, the partial index serves "next free slots" without touching booked rows
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS professional_slots (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            professional_id INTEGER NOT NULL,
+            start_time TEXT NOT NULL,
+            booking_id INTEGER,
+            UNIQUE (professional_id, start_time),
+            FOREIGN KEY (professional_id) REFERENCES professionals (id)
+        )
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_professional_slots_free ON professional_slots (professional_id, start_time) WHERE booking_id IS NULL')
+    
+    # Bookings made before slots existed only have a free-text time and no slot_id
+    if 'slot_id' not in _table_columns(cursor, 'bookings'):
+        cursor.execute('ALTER TABLE bookings ADD COLUMN slot_id INTEGER')
+    cursor.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_bookings_slot ON bookings (slot_id) WHERE slot_id IS NOT NULL')
+
+def _migrate_user_sessions(cursor):
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS user_sessions (
+            token_hash TEXT PRIMARY KEY,
+            user_id INTEGER NOT NULL,
+            created_at REAL NOT NULL,
+            expires_at REAL NOT NULL,
+            FOREIGN KEY (user_id) REFERENCES users (id)
+        ) WITHOUT ROWID
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_user_sessions_user ON user_sessions (user_id)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_user_sessions_expiry ON user_sessions (expires_at)')
+
+def _migrate_llm_usage(cursor):
+    # Daily token totals per user, request kind and model
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS llm_usage (
+            user_id INTEGER NOT NULL,
+            day TEXT NOT NULL,
+            kind TEXT NOT NULL,
+            model TEXT NOT NULL,
+            requests INTEGER NOT NULL DEFAULT 0,
+            prompt_tokens INTEGER NOT NULL DEFAULT 0,
+            completion_tokens INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (user_id, day, kind, model),
+            FOREIGN KEY (user_id) REFERENCES users (id)
+        ) WITHOUT ROWID
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_llm_usage_day ON llm_usage (day)')
+
+def _migrate_batch_checkpoints(cursor):
+    # Lines of a batch_generate.py input file that are already stored, keyed by job id
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS batch_checkpoints (
+            job_id TEXT NOT NULL,
+            line_number INTEGER NOT NULL,
+            completed_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (job_id, line_number)
+        )
+    ''')
+
+MIGRATIONS = [
+    _migrate_base_schema,
+    _migrate_indexes,
+    _migrate_search_index,
+    _migrate_generation_jobs,
+    _migrate_tale_summaries,
+    _migrate_similarity_index,
+    _migrate_story_revisions,
+    _migrate_story_storage,
+    _migrate_availability,
+    _migrate_user_sessions,
+    _migrate_llm_usage,
+    _migrate_batch_checkpoints
+]
+
+CACHE_MIGRATIONS = [
+    _migrate_cache_schema
+]
+
+def run_migrations(db_name, migrations):
+    with db_connection(db_name) as conn:
+        cursor = conn.cursor()
+        
+        # Fast path: nothing to do when the database is already at the latest version
+        cursor.execute('PRAGMA user_version')
+        if cursor.fetchone()[0] >= len(migrations):
+            return
+        
+        try:
+            # Take the write lock first so concurrent starters apply each migration once
+            cursor.execute('BEGIN IMMEDIATE')
+            cursor.execute('PRAGMA user_version')
+            version = cursor.fetchone()[0]
+            for number, migration in enumerate(migrations[version:], start=version + 1):
+                migration(cursor)
+                logging.info(f"Applied migration {number} ({migration.__name__}) to {db_name}")
+            cursor.execute(f'PRAGMA user_version = {len(migrations)}')
+            conn.commit()
+        except sqlite3.Error as e:
+            logging.error(f"Database error while migrating {db_name}: {str(e)}")
+            conn.rollback()
+            raise
+    # The storage migration may have trained a compression dictionary
+    _reset_compression_dictionary(db_name)
+
+def init_db():
+    run_migrations(DB_NAME, MIGRATIONS)
+
+def init_cache_db():
+    run_migrations(CACHE_DB_NAME, CACHE_MIGRATIONS)
+
+# Database functions
+@instrument_query
+def get_professionals():
+    with db_connection() as conn:
+        cursor = conn.cursor()
+        
+        try:
+            cursor.execute('SELECT * FROM professionals')
+            professionals = cursor.fetchall()
+            
+            # Get column names
+            column_names = [description[0] for description in cursor.description]
+            
+            result = []
+            for pro in professionals:
+                pro_dict = {}
+                for i, col in enumerate(column_names):
+                    if i < len(pro):
+                        pro_dict[col] = pro[i]
+                    else:
+                        pro_dict[col] = None  # Set to None if the column doesn't exist
+                result.append(pro_dict)
+            
+            return result
+        except sqlite3.Error as e:
+            logging.error(f"Database error in get_professionals: {str(e)}")
+            return []
+
+def add_professionals(professionals):
+    with db_connection() as conn:
+        cursor = conn.cursor()
+        
+        try:
+            cursor.executemany('''
+                INSERT INTO professionals (name, bio, experience, rating, price)
+                VALUES (?, ?, ?, ?, ?)
+            ''', professionals)
+            conn.commit()
+        except sqlite3.Error as e:
+            logging.error(f"Database error while adding professionals: {str(e)}")
+            conn.rollback()
+            raise Exception(f"Error adding professionals: {str(e)}")
+    bump_data_version('professionals')
+    generate_slots()
+
+@instrument_query
+def seed_professionals(professionals=DEFAULT_PROFESSIONALS):
+    # Only fills an empty table. The check runs under the write lock, so sessions arriving at
+    # the same time can't both see it empty and insert the list twice
+    with db_connection() as conn:
+        cursor = conn.cursor()
+        
+        try:
+            cursor.execute('BEGIN IMMEDIATE')
+            cursor.execute('SELECT EXISTS (SELECT 1 FROM professionals)')
+            if cursor.fetchone()[0]:
+                conn.rollback()
+                return 0
+            cursor.executemany('''
+                INSERT INTO professionals (name, bio, experience, rating, price)
+                VALUES (?, ?, ?, ?, ?)
+            ''', professionals)
+            conn.commit()
+        except sqlite3.Error as e:
+            logging.error(f"Database error while seeding professionals: {str(e)}")
+            conn.rollback()
+            raise Exception(f"Error adding professionals: {str(e)}")
+    bump_data_version('professionals')
+    generate_slots()
+    return len(professionals)
+
+def _slot_time(moment):
+    return moment.strftime('%Y-%m-%d %H:%M')
+
+@instrument_query
+def generate_slots(start=None, days=SLOT_WINDOW_DAYS):
+    # Tops up the rolling window for every professional and drops free slots that have passed;
+    # idempotent, so it is safe to run from several processes
+    window_from_today = start is None and days == SLOT_WINDOW_DAYS
+    start = start or datetime.now()
+    with db_connection() as conn:
+        cursor = conn.cursor()
+        
+        try:
+            cursor.execute('BEGIN IMMEDIATE')
+            cursor.execute('DELETE FROM professional_slots WHERE booking_id IS NULL AND start_time < ?', (_slot_time(start),))
+            cursor.execute('''
+                WITH RECURSIVE
+                    days (day) AS (
+                        SELECT date(?)
+                        UNION ALL
+                        SELECT date(day, '+1 day') FROM days WHERE day < date(?, '+' || (? - 1) || ' days')
+                    ),
+                    hours (hour) AS (
+                        SELECT ?
+                        UNION ALL
+                        SELECT hour + 1 FROM hours WHERE hour < ?
+                    )
+                INSERT OR IGNORE INTO professional_slots (professional_id, start_time)
+                SELECT p.id, days.day || printf(' %02d:00', hours.hour)
+                FROM professionals p, days, hours
+                WHERE strftime('%w', days.day) NOT IN ('0', '6')
+            ''', (start.date().isoformat(), start.date().isoformat(), days, SLOT_FIRST_HOUR, SLOT_LAST_HOUR))
+            # cursor.rowcount isn't set for statements that start with WITH
+            cursor.execute('SELECT changes()')
+            created = cursor.fetchone()[0]
+            conn.commit()
+            logging.info(f"Generated {created} professional slots")
+            if window_from_today:
+                # Today's window is complete, so ensure_slot_window needn't walk it again
+                get_slot_window_state()['generated_on'][_database_key(DB_NAME)] = start.date()
+            return created
+        except sqlite3.Error as e:
+            logging.error(f"Database error while generating slots: {str(e)}")
+            conn.rollback()
+            raise Exception(f"Error generating slots: {str(e)}")
+
+@st.cache_resource
+def get_slot_window_state():
+    return {'generated_on': {}, 'lock': threading.Lock()}
+
+def ensure_slot_window():
+    # Slots are generated ahead of time; this only runs the generation once a day per process
+    state = get_slot_window_state()
+    today = datetime.now().date()
+    key = _database_key(DB_NAME)
+    if state['generated_on'].get(key) == today:
+        return
+    with state['lock']:
+        if state['generated_on'].get(key) != today:
+            generate_slots()
+
+@instrument_query
+def get_next_free_slots(professional_id, limit=SLOTS_SHOWN):
+    with db_connection() as conn:
+        cursor = conn.cursor()
+        
+        cursor.execute('''
+            SELECT id, start_time FROM professional_slots
+            WHERE professional_id = ? AND booking_id IS NULL AND start_time > ?
+            ORDER BY start_time
+            LIMIT ?
+        ''', (professional_id, _slot_time(datetime.now()), limit))
+        slots = cursor.fetchall()
+    
+    return [{'id': slot[0], 'start_time': slot[1]} for slot in slots]
+
+@instrument_query
+def add_booking(user_id, professional_id, slot_id):
+    with db_connection() as conn:
+        cursor = conn.cursor()
+        
+        try:
+            # The write lock is taken before the slot is checked, so no other booker can take it
+            # between the check and the insert; the unique index on bookings.slot_id backs this up
+            cursor.execute('BEGIN IMMEDIATE')
+            cursor.execute('''
+                SELECT start_time FROM professional_slots
+                WHERE id = ? AND professional_id = ? AND booking_id IS NULL AND start_time > ?
+            ''', (slot_id, professional_id, _slot_time(datetime.now())))
+            slot = cursor.fetchone()
+            if slot is None:
+                conn.rollback()
+                increment_counter('storyteller_booking_conflicts_total')
+                raise Exception("That slot is no longer available. Please pick another one.")
+            cursor.execute('''
+                INSERT INTO bookings (user_id, professional_id, slot, slot_id)
+                VALUES (?, ?, ?, ?)
+            ''', (user_id, professional_id, slot[0], slot_id))
+            booking_id = cursor.lastrowid
+            cursor.execute('UPDATE professional_slots SET booking_id = ? WHERE id = ?', (booking_id, slot_id))
+            conn.commit()
+            bump_data_version('bookings', user_id)
+            bump_data_version('slots', professional_id)
+            logging.info(f"Booking added successfully. ID: {booking_id}")
+            return booking_id
+        except sqlite3.IntegrityError:
+            conn.rollback()
+            increment_counter('storyteller_booking_conflicts_total')
+            raise Exception("That slot is no longer available. Please pick another one.")
+        except sqlite3.Error as e:
+            logging.error(f"Database error while adding booking: {str(e)}")
+            conn.rollback()
+            raise Exception(f"Error adding booking: {str(e)}")
+
+# Authentication
+@st.cache_resource
+def get_password_pool():
+    # hashlib's scrypt and PBKDF2 release the GIL, so KDF work runs in parallel here without
+    # blocking script threads; the semaphore turns a login spike into quick "busy" errors
+    return {
+        'executor': ThreadPoolExecutor(max_workers=PASSWORD_WORKERS, thread_name_prefix="password"),
+        'pending': threading.BoundedSemaphore(PASSWORD_MAX_PENDING)
+    }
+
+def run_password_task(func, *args):
+    pool = get_password_pool()
+    if not pool['pending'].acquire(blocking=False):
+        increment_counter('storyteller_logins_total', result='busy')
+        raise Exception("Too many logins in progress. Please try again in a moment.")
+    
+    start = time.perf_counter()
+    try:
+        future = pool['executor'].submit(func, *args)
+    except Exception:
+        pool['pending'].release()
+        raise
+    future.add_done_callback(lambda _: pool['pending'].release())
+    try:
+        return future.result(timeout=PASSWORD_TIMEOUT_SECONDS)
+    finally:
+        observe('storyteller_password_hash_seconds', time.perf_counter() - start, task=func.__name__)
+
+@functools.lru_cache(maxsize=None)
+def get_password_hash_prefix():
+    # The "method:parameters" part werkzeug writes for PASSWORD_HASH_METHOD, e.g. scrypt:32768:8:1
+    from werkzeug.security import generate_password_hash
+    
+    return generate_password_hash('', method=PASSWORD_HASH_METHOD).split('$', 1)[0]
+
+def hash_password(password):
+    from werkzeug.security import generate_password_hash
+    
+    return generate_password_hash(password, method=PASSWORD_HASH_METHOD)
+
+def verify_password(password_hash, password):
+    # Returns the hash to keep: the stored one, or a new one when it was made with outdated KDF
+    # parameters, or None when the password is wrong
+    from werkzeug.security import check_password_hash
+    
+    if not check_password_hash(password_hash, password):
+        return None
+    if password_hash.split('$', 1)[0] != get_password_hash_prefix():
+        return hash_password(password)
+    return password_hash
+
+@st.cache_resource
+def get_login_throttle():
+    # Process-wide recent login attempts per username
+    return {'lock': threading.Lock(), 'attempts': {}}
+
+def register_login_attempt(username):
+    throttle = get_login_throttle()
+    now = time.monotonic()
+    with throttle['lock']:
+        if len(throttle['attempts']) > LOGIN_THROTTLE_MAX_USERNAMES:
+            throttle['attempts'] = {name: times for name, times in throttle['attempts'].items()
+                                    if now - times[-1] < LOGIN_WINDOW_SECONDS}
+        attempts = [t for t in throttle['attempts'].get(username, []) if now - t < LOGIN_WINDOW_SECONDS]
+        if len(attempts) >= LOGIN_MAX_ATTEMPTS:
+            throttle['attempts'][username] = attempts
+            retry_after = int(LOGIN_WINDOW_SECONDS - (now - attempts[0])) + 1
+            increment_counter('storyteller_logins_total', result='throttled')
+            raise Exception(f"Too many login attempts. Please try again in {retry_after} seconds.")
+        attempts.append(now)
+        throttle['attempts'][username] = attempts
+
+def clear_login_attempts(username):
+    throttle = get_login_throttle()
+    with throttle['lock']:
+        throttle['attempts'].pop(username, None)
+
+def _user_from_row(row):
+    return {
+        'id': row[0],
+        'first_name': row[1],
+        'last_name': row[2],
+        'email': row[3],
+        'profession': row[4],
+        'username': row[5],
+        'phone': row[6]
+    }
+
+@instrument_query
+def add_user(user_data):
+    hashed_password = run_password_task(hash_password, user_data['password'])
+    
+    with db_connection() as conn:
+        cursor = conn.cursor()
+        
+        try:
+            cursor.execute('''
+                INSERT INTO users (first_name, last_name, email, profession, username, phone, password)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+            ''', (user_data['first_name'], user_data['last_name'], user_data['email'], user_data['profession'],
+                  user_data['username'], user_data['phone'], hashed_password))
+            conn.commit()
+            user_id = cursor.lastrowid
+        except sqlite3.IntegrityError as e:
+            logging.error(f"Database integrity error: {str(e)}")
+            conn.rollback()
+            raise Exception("Username or email already exists")
+    
+    return user_id
+
+@instrument_query
+def get_user(username, password):
+    register_login_attempt(username)
+    
+    with db_connection() as conn:
+        cursor = conn.cursor()
+        
+        cursor.execute('SELECT * FROM users WHERE username = ?', (username,))
+        user = cursor.fetchone()
+    
+    password_hash = run_password_task(verify_password, user[7], password) if user else None
+    if password_hash is None:
+        increment_counter('storyteller_logins_total', result='failed')
+        return None
+    
+    if password_hash != user[7]:
+        with db_connection() as conn:
+            # Only replace the hash we verified, in case the password changed meanwhile
+            conn.execute('UPDATE users SET password = ? WHERE id = ? AND password = ?', (password_hash, user[0], user[7]))
+            conn.commit()
+        increment_counter('storyteller_password_rehash_total')
+        logging.info(f"Upgraded the password hash of user {user[0]} to {get_password_hash_prefix()}")
+    
+    clear_login_attempts(username)
+    increment_counter('storyteller_logins_total', result='password')
+    return _user_from_row(user)
+
+def _hash_session_token(token):
+    return hashlib.sha256(token.encode('utf-8')).hexdigest()
+
+@instrument_query
+def create_session(user_id):
+    token = secrets.token_urlsafe(SESSION_TOKEN_BYTES)
+    now = time.time()
+    with db_connection() as conn:
+        conn.execute('DELETE FROM user_sessions WHERE expires_at <= ?', (now,))
+        conn.execute('''
+            INSERT INTO user_sessions (token_hash, user_id, created_at, expires_at)
+            VALUES (?, ?, ?, ?)
+        ''', (_hash_session_token(token), user_id, now, now + SESSION_TTL_SECONDS))
+        conn.commit()
+    return token
+
+@instrument_query
+def get_session_user(token):
+    if not token:
+        return None
+    with db_connection() as conn:
+        user = conn.execute('''
+            SELECT users.* FROM user_sessions
+            JOIN users ON users.id = user_sessions.user_id
+            WHERE user_sessions.token_hash = ? AND user_sessions.expires_at > ?
+        ''', (_hash_session_token(token), time.time())).fetchone()
+    if user is None:
+        return None
+    increment_counter('storyteller_logins_total', result='session')
+    return _user_from_row(user)
+
+@instrument_query
+def delete_session(token):
+    with db_connection() as conn:
+        conn.execute('DELETE FROM user_sessions WHERE token_hash = ?', (_hash_session_token(token),))
+        conn.commit()
+
+# Story storage
+@st.cache_resource
+def get_compression_state():
+    # Dictionaries are immutable and content-addressed, so they are cached for the process;
+    # 'current' maps each database to the dictionary new writes use
+    return {'dictionaries': {}, 'current': {}, 'lock': threading.Lock()}
+
+def _database_key(db_name):
+    return os.path.abspath(db_name or DB_NAME)
+
+def _database_path(cursor):
+    cursor.execute('PRAGMA database_list')
+    return next(row[2] for row in cursor.fetchall() if row[1] == 'main')
+
+def _load_compression_dictionaries(db_name):
+    # Own connection: this runs inside SQL functions and migrations, where the pool can't be used
+    conn = sqlite3.connect(db_name, timeout=DB_BUSY_TIMEOUT_MS / 1000)
+    try:
+        rows = conn.execute('SELECT id, data FROM compression_dictionaries ORDER BY created_at').fetchall()
+    except sqlite3.OperationalError:
+        rows = []
+    finally:
+        conn.close()
+    
+    state = get_compression_state()
+    with state['lock']:
+        state['dictionaries'].update(rows)
+        state['current'].setdefault(_database_key(db_name), rows[-1][0] if rows else None)
+
+def _register_compression_dictionary(db_name, dictionary_id):
+    # Only once the dictionary is committed: other connections must find it when they read rows using it
+    state = get_compression_state()
+    with state['lock']:
+        state['current'][_database_key(db_name)] = dictionary_id
+
+def _reset_compression_dictionary(db_name):
+    # The next write reloads the current dictionary from the database, e.g. after a migration trained one
+    state = get_compression_state()
+    with state['lock']:
+        state['current'].pop(_database_key(db_name), None)
+
+def _get_compression_dictionary(dictionary_id, db_name):
+    state = get_compression_state()
+    if dictionary_id not in state['dictionaries']:
+        # Trained by another process since this one loaded its dictionaries
+        _load_compression_dictionaries(db_name)
+    if dictionary_id not in state['dictionaries']:
+        raise Exception(f"Unknown compression dictionary: {dictionary_id}")
+    return state['dictionaries'][dictionary_id]
+
+def train_compression_dictionary(samples, size=COMPRESSION_DICTIONARY_SIZE):
+    # A zlib preset dictionary is just text the compressor may refer back to: the word n-grams
+    # that occur in the most samples, weighted by length, with the most valuable ones last
+    # since nearer matches are cheaper to encode
+    counts = {}
+    for text in samples:
+        words = re.findall(r"\S+\s*", text)
+        grams = set()
+        for n in range(1, 5):
+            grams.update("".join(words[i:i + n]) for i in range(len(words) - n + 1))
+        for gram in grams:
+            counts[gram] = counts.get(gram, 0) + 1
+    
+    chosen = []
+    total = 0
+    for gram in sorted((gram for gram, count in counts.items() if count > 1), key=lambda gram: counts[gram] * len(gram), reverse=True):
+        data = gram.encode('utf-8')
+        if total + len(data) > size:
+            continue
+        chosen.append(data)
+        total += len(data)
+        if total >= size - 16:
+            break
+    return b"".join(reversed(chosen))
+
+def compress_text(text, db_name=None, dictionary_id=None):
+    # 'Z' + zlib stream, or 'D' + 8-byte dictionary id + zlib stream using that dictionary.
+    # Without a dictionary_id the database's current dictionary is used
+    key = _database_key(db_name)
+    state = get_compression_state()
+    if dictionary_id is None:
+        if key not in state['current']:
+            _load_compression_dictionaries(key)
+        dictionary_id = state['current'][key]
+    data = text.encode('utf-8')
+    if dictionary_id is None:
+        packed = b'Z' + zlib.compress(data, COMPRESSION_LEVEL)
+    else:
+        compressor = zlib.compressobj(COMPRESSION_LEVEL, zdict=state['dictionaries'][dictionary_id])
+        packed = b'D' + dictionary_id.to_bytes(8, 'big', signed=True) + compressor.compress(data) + compressor.flush()
+    # Very short texts come out larger; those, like rows written before compression, stay plain text
+    return packed if len(packed) < len(data) else text
+
+def decompress_text(value, db_name=None):
+    if value is None or isinstance(value, str):
+        return value
+    value = bytes(value)
+    if value[:1] == b'Z':
+        return zlib.decompress(value[1:]).decode('utf-8')
+    if value[:1] != b'D':
+        raise Exception("Unknown story content encoding")
+    dictionary = _get_compression_dictionary(int.from_bytes(value[1:9], 'big', signed=True), _database_key(db_name))
+    decompressor = zlib.decompressobj(zdict=dictionary)
+    return (decompressor.decompress(value[9:]) + decompressor.flush()).decode('utf-8')
+
+def parse_story_parameters(parameters):
+    # Stories saved by older versions hold str(dict) rather than JSON
+    if not parameters:
+        return {}
+    try:
+        params = json.loads(parameters)
+    except ValueError:
+        import ast
+        try:
+            params = ast.literal_eval(parameters)
+        except (ValueError, SyntaxError):
+            return {}
+    return params if isinstance(params, dict) else {}
+
+def _story_parameter_values(params):
+    values = []
+    for column, _ in STORY_PARAMETER_COLUMNS:
+        value = params.get(column)
+        values.append(None if isinstance(value, (list, dict)) else value)
+    return values
+
+def _store_story_tags(cursor, story_id, params):
+    cursor.execute('DELETE FROM story_tags WHERE story_id = ?', (story_id,))
+    cursor.executemany('INSERT OR IGNORE INTO story_tags (kind, value, story_id) VALUES (?, ?, ?)', [
+        (kind, str(value), story_id)
+        for kind in STORY_TAG_PARAMETERS if isinstance(params.get(kind), list)
+        for value in params[kind]
+    ])
+
+def _insert_story(cursor, user_id, title, content, parameters, db_name=None):
+    # Every new story goes through here: compressed content, parameter columns and tags, similarity index
+    params = parse_story_parameters(parameters)
+    columns = ", ".join(column for column, _ in STORY_PARAMETER_COLUMNS)
+    placeholders = ", ".join("?" for _ in STORY_PARAMETER_COLUMNS)
+    cursor.execute(f'''
+        INSERT INTO stories (user_id, title, content, parameters, {columns})
+        VALUES (?, ?, ?, ?, {placeholders})
+    ''', [user_id, title, compress_text(content, db_name), parameters] + _story_parameter_values(params))
+    story_id = cursor.lastrowid
+    _store_story_tags(cursor, story_id, params)
+    _index_story(cursor, story_id, user_id, content)
+    return story_id
+
+def _insert_stories(cursor, rows, db_name=None):
+    # Bulk _insert_story for (user_id, title, content, parameters) rows: everything is compressed
+    # up front, then written with one executemany per table. Returns the new story ids
+    if not rows:
+        return []
+    columns = ", ".join(column for column, _ in STORY_PARAMETER_COLUMNS)
+    placeholders = ", ".join("?" for _ in STORY_PARAMETER_COLUMNS)
+    params = [parse_story_parameters(parameters) for _, _, _, parameters in rows]
+    values = [
+        [user_id, title, compress_text(content, db_name), parameters] + _story_parameter_values(story_params)
+        for (user_id, title, content, parameters), story_params in zip(rows, params)
+    ]
+    cursor.executemany(f'''
+        INSERT INTO stories (user_id, title, content, parameters, {columns})
+        VALUES (?, ?, ?, ?, {placeholders})
+    ''', values)
+    # executemany doesn't report row ids. The inserts hold the write lock, so AUTOINCREMENT gave
+    # them consecutive ids ending at the current sequence value
+    cursor.execute("SELECT seq FROM sqlite_sequence WHERE name = 'stories'")
+    last_id = cursor.fetchone()[0]
+    story_ids = list(range(last_id - len(rows) + 1, last_id + 1))
+    
+    cursor.executemany('INSERT OR IGNORE INTO story_tags (kind, value, story_id) VALUES (?, ?, ?)', [
+        (kind, str(value), story_id)
+        for story_id, story_params in zip(story_ids, params)
+        for kind in STORY_TAG_PARAMETERS if isinstance(story_params.get(kind), list)
+        for value in story_params[kind]
+    ])
+    for story_id, (user_id, _, content, _) in zip(story_ids, rows):
+        _index_story(cursor, story_id, user_id, content)
+    return story_ids
+
+def _update_story_content(cursor, story_id, content, parameters, db_name=None, dictionary_id=None):
+    params = parse_story_parameters(parameters)
+    assignments = ", ".join(f"{column} = ?" for column, _ in STORY_PARAMETER_COLUMNS)
+    cursor.execute(f'UPDATE stories SET content = ?, parameters = ?, {assignments} WHERE id = ?',
+                   [compress_text(content, db_name, dictionary_id), parameters] + _story_parameter_values(params) + [story_id])
+    _store_story_tags(cursor, story_id, params)
+
+def _compact_stories(cursor):
+    # Trains a dictionary on a sample of the saved stories, then rewrites every story with it and
+    # with its parameters as JSON, in the columns and in story_tags. Returns the stories rewritten
+    # and the new dictionary's id, which the caller makes current once the transaction commits
+    db_name = _database_path(cursor)
+    cursor.execute('SELECT story_text(content) FROM stories ORDER BY random() LIMIT ?', (COMPRESSION_SAMPLE_SIZE,))
+    samples = [row[0] for row in cursor.fetchall() if row[0]]
+    dictionary_id = None
+    if len(samples) >= COMPRESSION_MIN_SAMPLES:
+        dictionary = train_compression_dictionary(samples)
+        dictionary_id = int.from_bytes(hashlib.blake2b(dictionary, digest_size=8).digest(), 'big', signed=True)
+        cursor.execute('INSERT OR IGNORE INTO compression_dictionaries (id, data, samples, created_at) VALUES (?, ?, ?, ?)',
+                       (dictionary_id, dictionary, len(samples), time.time()))
+        # Dictionaries are content-addressed, so knowing one that ends up rolled back is harmless
+        state = get_compression_state()
+        with state['lock']:
+            state['dictionaries'][dictionary_id] = dictionary
+    
+    rewritten = 0
+    last_id = 0
+    while True:
+        cursor.execute('SELECT id, story_text(content), parameters FROM stories WHERE id > ? ORDER BY id LIMIT 1000', (last_id,))
+        batch = cursor.fetchall()
+        if not batch:
+            break
+        for story_id, content, parameters in batch:
+            params = parse_story_parameters(parameters)
+            if params:
+                parameters = json.dumps(params)
+            _update_story_content(cursor, story_id, content or '', parameters, db_name, dictionary_id)
+        rewritten += len(batch)
+        last_id = batch[-1][0]
+    return rewritten, dictionary_id
+
+@instrument_query
+def compact_stories(db_name=None):
+    # Maintenance: retrain the compression dictionary once the saved stories have grown or changed
+    with db_connection(db_name) as conn:
+        cursor = conn.cursor()
+        
+        try:
+            cursor.execute('BEGIN IMMEDIATE')
+            rewritten, dictionary_id = _compact_stories(cursor)
+            conn.commit()
+            if dictionary_id is not None:
+                _register_compression_dictionary(db_name or DB_NAME, dictionary_id)
+            logging.info(f"Recompressed {rewritten} stories")
+            return rewritten
+        except sqlite3.Error as e:
+            logging.error(f"Database error while compacting stories: {str(e)}")
+            conn.rollback()
+            raise Exception(f"Error compacting stories: {str(e)}")
+
+@instrument_query
+def count_stories(user_id=None, group_by=(), **filters):
+    # Counts stories by their parameters, e.g. count_stories(narrative_structure="Hero's Journey",
+    # focus="Integrity"), or per group with group_by=('use_case',). Served by the parameter
+    # columns and story_tags indexes, no JSON is parsed
+    column_names = [column for column, _ in STORY_PARAMETER_COLUMNS]
+    for name in list(filters) + list(group_by):
+        if name not in column_names and (name in group_by or name not in STORY_TAG_PARAMETERS):
+            raise Exception(f"Unknown story parameter: {name}")
+    
+    conditions = []
+    values = []
+    if user_id is not None:
+        conditions.append('user_id = ?')
+        values.append(user_id)
+    for name, value in filters.items():
+        if name in STORY_TAG_PARAMETERS:
+            conditions.append('id IN (SELECT story_id FROM story_tags WHERE kind = ? AND value = ?)')
+            values += [name, value]
+        else:
+            conditions.append(f'{name} = ?')
+            values.append(value)
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+    
+    with db_connection() as conn:
+        cursor = conn.cursor()
+        
+        if not group_by:
+            cursor.execute(f'SELECT COUNT(*) FROM stories {where}', values)
+            return cursor.fetchone()[0]
+        groups = ", ".join(group_by)
+        cursor.execute(f'SELECT {groups}, COUNT(*) FROM stories {where} GROUP BY {groups} ORDER BY COUNT(*) DESC', values)
+        rows = cursor.fetchall()
+    
+    return [dict(zip(list(group_by) + ['count'], row)) for row in rows]
+
+@instrument_query
+def save_story(user_id, title, content, parameters):
+    with db_connection() as conn:
+        cursor = conn.cursor()
+        
+        try:
+            # Saving the same text again keeps the copy the user already has
+            story_id = _find_identical_story(cursor, user_id, content)
+            if story_id:
+                logging.info(f"Story already saved. ID: {story_id}")
+                return story_id
+            story_id = _insert_story(cursor, user_id, title, content, parameters)
+            conn.commit()
+            bump_data_version('stories', user_id)
+            logging.info(f"Story saved successfully. ID: {story_id}")
+            return story_id
+        except sqlite3.Error as e:
+            logging.error(f"Database error while saving story: {str(e)}")
+            conn.rollback()
+            raise Exception(f"Error saving story: {str(e)}")
+
+@instrument_query
+def delete_story(story_id):
+    with db_connection() as conn:
+        cursor = conn.cursor()
+        
+        try:
+            cursor.execute('DELETE FROM stories WHERE id = ? RETURNING user_id', (story_id,))
+            deleted = cursor.fetchall()
+            conn.commit()
+            for (user_id,) in deleted:
+                bump_data_version('stories', user_id)
+            logging.info(f"Story deleted successfully. ID: {story_id}")
+        except sqlite3.Error as e:
+            logging.error(f"Database error while deleting story: {str(e)}")
+            conn.rollback()
+            raise Exception(f"Error deleting story: {str(e)}")
+
+@instrument_query
+def get_stories(user_id):
+    with db_connection() as conn:
+        cursor = conn.cursor()
+        
+        cursor.execute('SELECT id, title, story_text(content), parameters, created_at FROM stories WHERE user_id = ? ORDER BY created_at DESC', (user_id,))
+        stories = cursor.fetchall()
+    
+    return [
+        {
+            'id': story[0],
+            'title': story[1],
+            'content': story[2],
+            'parameters': story[3],
+            'created_at': story[4]
+        } for story in stories
+    ]
+
+@instrument_query
+def list_stories(user_id, limit=STORY_PAGE_SIZE, after=None):
+    # Keyset pagination: `after` is the (created_at, id) of the last row of the previous page
+    with db_connection() as conn:
+        cursor = conn.cursor()
+        
+        if after is None:
+            cursor.execute('''
+                SELECT id, title, created_at FROM stories
+                WHERE user_id = ?
+                ORDER BY created_at DESC, id DESC
+                LIMIT ?
+            ''', (user_id, limit))
+        else:
+            cursor.execute('''
+                SELECT id, title, created_at FROM stories
+                WHERE user_id = ? AND (created_at, id) < (?, ?)
+                ORDER BY created_at DESC, id DESC
+                LIMIT ?
+            ''', (user_id, after[0], after[1], limit))
+        stories = cursor.fetchall()
+    
+    return [
+        {
+            'id': story[0],
+            'title': story[1],
+            'created_at': story[2]
+        } for story in stories
+    ]
+
+@instrument_query
+def get_story(story_id, user_id):
+    with db_connection() as conn:
+        cursor = conn.cursor()
+        
+        cursor.execute('SELECT id, title, story_text(content), parameters, created_at FROM stories WHERE id = ? AND user_id = ?', (story_id, user_id))
+        story = cursor.fetchone()
+    
+    if story is None:
+        return None
+    return {
+        'id': story[0],
+        'title': story[1],
+        'content': story[2],
+        'parameters': story[3],
+        'created_at': story[4]
+    }
+
+def build_match_query(query):
+    # Quote every term so user input can't inject FTS5 syntax; the last term is a prefix match
+    terms = re.findall(r'\w+', query)
+    if not terms:
+        return None
+    quoted = [f'"{term}"' for term in terms]
+    quoted[-1] += '*'
+    return ' '.join(quoted)
+
+@instrument_query
+def search_stories(user_id, query, limit=SEARCH_RESULT_LIMIT):
+    match_query = build_match_query(query)
+    if not match_query:
+        return []
+    
+    with db_connection() as conn:
+        cursor = conn.cursor()
+        
+        try:
+            # The user's story ids are collected first, so each FTS match is checked against a small
+            # temporary index instead of a lookup in stories. The unary + keeps SQLite from turning
+            # the join into one MATCH seek per story. snippet() and the title are only read for the
+            # `limit` rows left after ORDER BY ... LIMIT
+            cursor.execute('''
+                WITH own AS MATERIALIZED (SELECT id FROM stories WHERE user_id = ?)
+                SELECT stories_fts.rowid, stories_fts.title, snippet(stories_fts, 1, '**', '**', '…', 12), bm25(stories_fts, 5.0, 1.0) AS score
+                FROM stories_fts
+                JOIN own ON own.id = +stories_fts.rowid
+                WHERE stories_fts MATCH ?
+                ORDER BY score
+                LIMIT ?
+            ''', (user_id, match_query, limit))
+            results = cursor.fetchall()
+        except sqlite3.Error as e:
+            logging.error(f"Database error while searching stories: {str(e)}")
+            return []
+    
+    return [
+        {
+            'id': result[0],
+            'title': result[1],
+            'snippet': result[2],
+            'score': result[3]
+        } for result in results
+    ]
+
+@instrument_query
+def search_tales(query, limit=SEARCH_RESULT_LIMIT):
+    match_query = build_match_query(query)
+    if not match_query:
+        return []
+    
+    # Make sure the compiled tale table reflects the current spreadsheet
+    get_well_known_tales()
+    
+    with db_connection() as conn:
+        cursor = conn.cursor()
+        
+        try:
+            cursor.execute('''
+                SELECT rowid, title, snippet(tales_fts, 1, '**', '**', '…', 12), bm25(tales_fts, 5.0, 1.0) AS score
+                FROM tales_fts
+                WHERE tales_fts MATCH ?
+                ORDER BY score
+                LIMIT ?
+            ''', (match_query, limit))
+            results = cursor.fetchall()
+        except sqlite3.Error as e:
+            logging.error(f"Database error while searching tales: {str(e)}")
+            return []
+    
+    return [
+        {
+            'position': result[0],
+            'title': result[1],
+            'snippet': result[2],
+            'score': result[3]
+        } for result in results
+    ]
+
+# Story revisions: the head lives in stories.content, older revisions are stored as reverse
+# deltas (how to get revision n back from revision n + 1), with zlib snapshots in between so
+# no reconstruction walks a long chain
+def _diff_tokens(text):
+    return re.findall(r"\S+|\s+", text)
+
+def _diff_units(text):
+    # Sentences and lines, each keeping its trailing punctuation or newline
+    return [unit for unit in re.split(r"(?<=[.!?\n])", text) if unit]
+
+def _offsets(parts, start=0):
+    offsets = [start]
+    for part in parts:
+        offsets.append(offsets[-1] + len(part))
+    return offsets
+
+def encode_delta(source, target):
+    # Returns compressed ops that rebuild `target` from `source`, or None when a snapshot is the
+    # better choice. Ops: [start, end] copies that slice of the source, a string is inserted as
+    # is. The diff runs on sentences and lines first, then on the word tokens of each changed
+    # run of them, so its cost follows the size of the edits rather than how far apart they are
+    import difflib
+    
+    ops = []
+    
+    def copy(start, end):
+        if start == end:
+            return
+        if ops and not isinstance(ops[-1], str) and ops[-1][1] == start:
+            ops[-1][1] = end
+        else:
+            ops.append([start, end])
+    
+    def insert(text):
+        if not text:
+            return
+        if ops and isinstance(ops[-1], str):
+            ops[-1] += text
+        else:
+            ops.append(text)
+    
+    source_units = _diff_units(source)
+    target_units = _diff_units(target)
+    unit_offsets = _offsets(source_units)
+    for tag, i1, i2, j1, j2 in difflib.SequenceMatcher(None, source_units, target_units, autojunk=False).get_opcodes():
+        if tag == 'equal':
+            copy(unit_offsets[i1], unit_offsets[i2])
+            continue
+        source_tokens = _diff_tokens("".join(source_units[i1:i2]))
+        target_tokens = _diff_tokens("".join(target_units[j1:j2]))
+        offsets = _offsets(source_tokens, unit_offsets[i1])
+        # Edits within a block are usually local too, so only what lies between the common
+        # prefix and suffix is diffed
+        prefix = 0
+        limit = min(len(source_tokens), len(target_tokens))
+        while prefix < limit and source_tokens[prefix] == target_tokens[prefix]:
+            prefix += 1
+        suffix = 0
+        while suffix < limit - prefix and source_tokens[-1 - suffix] == target_tokens[-1 - suffix]:
+            suffix += 1
+        copy(offsets[0], offsets[prefix])
+        source_middle = source_tokens[prefix:len(source_tokens) - suffix]
+        target_middle = target_tokens[prefix:len(target_tokens) - suffix]
+        if len(source_middle) * len(target_middle) > DELTA_MAX_COMPARISONS:
+            # The block was rewritten: diffing it would be slow and gain little
+            insert("".join(target_middle))
+        else:
+            for word_tag, k1, k2, l1, l2 in difflib.SequenceMatcher(None, source_middle, target_middle, autojunk=False).get_opcodes():
+                if word_tag == 'equal':
+                    copy(offsets[prefix + k1], offsets[prefix + k2])
+                else:
+                    insert("".join(target_middle[l1:l2]))
+        copy(offsets[len(source_tokens) - suffix], offsets[-1])
+    delta = zlib.compress(json.dumps(ops, separators=(',', ':')).encode('utf-8'), 9)
+    if len(delta) >= len(zlib.compress(target.encode('utf-8'), 9)):
+        return None
+    return delta
+
+def apply_delta(source, delta):
+    return "".join(op if isinstance(op, str) else source[op[0]:op[1]] for op in json.loads(zlib.decompress(delta)))
+
+@instrument_query
+def save_story_revision(story_id, user_id, content, parameters):
+    # Makes `content` the new head of an existing story; returns the new revision number
+    with db_connection() as conn:
+        cursor = conn.cursor()
+        
+        try:
+            cursor.execute('''
+                SELECT story_text(content), parameters, revision, COALESCE(revised_at, created_at)
+                FROM stories WHERE id = ? AND user_id = ?
+            ''', (story_id, user_id))
+            head = cursor.fetchone()
+            if head is None:
+                raise Exception("Story not found")
+            head_content, head_parameters, revision, revised_at = head
+            if content == head_content and parameters == head_parameters:
+                return revision
+            
+            cursor.execute('''
+                SELECT COUNT(*), COALESCE(SUM(length(data)), 0) FROM story_revisions
+                WHERE story_id = ? AND revision > (
+                    SELECT COALESCE(MAX(revision), 0) FROM story_revisions WHERE story_id = ? AND kind = 'snapshot'
+                )
+            ''', (story_id, story_id))
+            chain_length, chain_bytes = cursor.fetchone()
+            kind, data = 'delta', None
+            if chain_length < REVISION_MAX_CHAIN and chain_bytes < len(head_content):
+                data = encode_delta(content, head_content)
+            if data is None:
+                kind, data = 'snapshot', zlib.compress(head_content.encode('utf-8'), 9)
+            cursor.execute('''
+                INSERT INTO story_revisions (story_id, revision, kind, data, parameters, size, created_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+            ''', (story_id, revision, kind, data, head_parameters, len(head_content), revised_at))
+            _update_story_content(cursor, story_id, content, parameters)
+            cursor.execute('UPDATE stories SET revision = ?, revised_at = CURRENT_TIMESTAMP WHERE id = ?', (revision + 1, story_id))
+            _index_story(cursor, story_id, user_id, content)
+            conn.commit()
+            bump_data_version('stories', user_id)
+            logging.info(f"Story revision saved. ID: {story_id}, revision: {revision + 1}")
+            return revision + 1
+        except sqlite3.Error as e:
+            logging.error(f"Database error while saving story revision: {str(e)}")
+            conn.rollback()
+            raise Exception(f"Error saving story revision: {str(e)}")
+
+@instrument_query
+def get_story_revisions(story_id, user_id):
+    with db_connection() as conn:
+        cursor = conn.cursor()
+        
+        cursor.execute('''
+            SELECT revision, COALESCE(revised_at, created_at), length(story_text(content)) FROM stories
+            WHERE id = ? AND user_id = ?
+        ''', (story_id, user_id))
+        head = cursor.fetchone()
+        if head is None:
+            return []
+        cursor.execute('''
+            SELECT revision, created_at, size, kind, length(data) FROM story_revisions
+            WHERE story_id = ?
+            ORDER BY revision DESC
+        ''', (story_id,))
+        revisions = cursor.fetchall()
+    
+    return [{'revision': head[0], 'created_at': head[1], 'size': head[2], 'kind': 'head', 'stored_bytes': None}] + [
+        {
+            'revision': revision[0],
+            'created_at': revision[1],
+            'size': revision[2],
+            'kind': revision[3],
+            'stored_bytes': revision[4]
+        } for revision in revisions
+    ]
+
+@instrument_query
+def get_story_revision(story_id, user_id, revision):
+    # Returns (content, parameters) of one revision
+    with db_connection() as conn:
+        cursor = conn.cursor()
+        
+        cursor.execute('SELECT story_text(content), parameters, revision FROM stories WHERE id = ? AND user_id = ?', (story_id, user_id))
+        head = cursor.fetchone()
+        if head is None or revision > head[2] or revision < 1:
+            return None
+        if revision == head[2]:
+            return head[0], head[1]
+        
+        # Start from the nearest snapshot at or after the revision (or the head) and walk back
+        cursor.execute('''
+            SELECT MIN(revision) FROM story_revisions
+            WHERE story_id = ? AND revision >= ? AND kind = 'snapshot'
+        ''', (story_id, revision))
+        snapshot = cursor.fetchone()[0]
+        cursor.execute('''
+            SELECT revision, kind, data, parameters FROM story_revisions
+            WHERE story_id = ? AND revision BETWEEN ? AND ?
+            ORDER BY revision DESC
+        ''', (story_id, revision, snapshot if snapshot is not None else head[2]))
+        chain = cursor.fetchall()
+    
+    content = head[0]
+    parameters = head[1]
+    for _, kind, data, parameters in chain:
+        if kind == 'snapshot':
+            content = zlib.decompress(data).decode('utf-8')
+        else:
+            content = apply_delta(content, data)
+    return content, parameters
+
+def restore_story_revision(story_id, user_id, revision):
+    # Rolling back adds the old text as a new head, so the history itself is never rewritten
+    restored = get_story_revision(story_id, user_id, revision)
+    if restored is None:
+        raise Exception("Revision not found")
+    return save_story_revision(story_id, user_id, restored[0], restored[1])
+
+# Near-duplicate index: MinHash signatures over word shingles, banded into LSH buckets
+@functools.lru_cache(maxsize=1)
+def _minhash_coefficients():
+    import numpy as np
+    
+    # Fixed seed: signatures stored in the database must stay comparable across processes
+    rng = random.Random(MINHASH_SEED)
+    a = np.array([rng.randrange(1, MINHASH_PRIME) for _ in range(MINHASH_PERMUTATIONS)], dtype=np.uint64)
+    b = np.array([rng.randrange(0, MINHASH_PRIME) for _ in range(MINHASH_PERMUTATIONS)], dtype=np.uint64)
+    return a, b
+
+def get_shingles(text):
+    words = re.findall(r"\w+", text.lower())
+    if len(words) < SHINGLE_SIZE:
+        return {" ".join(words)} if words else set()
+    return {" ".join(words[i:i + SHINGLE_SIZE]) for i in range(len(words) - SHINGLE_SIZE + 1)}
+
+@functools.lru_cache(maxsize=256)
+def minhash_signature(text):
+    import numpy as np
+    
+    shingles = get_shingles(text)
+    if not shingles:
+        return None
+    hashes = np.array([zlib.crc32(shingle.encode('utf-8')) % MINHASH_PRIME for shingle in shingles], dtype=np.uint64)
+    a, b = _minhash_coefficients()
+    # (a * x + b) mod p per permutation; a, x < 2^31 so the products fit in 64 bits
+    return ((a[:, None] * hashes[None, :] + b[:, None]) % MINHASH_PRIME).min(axis=1).astype(np.uint32)
+
+def lsh_buckets(signature):
+    rows = MINHASH_PERMUTATIONS // LSH_BANDS
+    return [
+        (band, int.from_bytes(hashlib.blake2b(signature[band * rows:(band + 1) * rows].tobytes(), digest_size=8).digest(), 'big', signed=True))
+        for band in range(LSH_BANDS)
+    ]
+
+def signature_similarity(signature, other):
+    # Share of agreeing MinHash values estimates the Jaccard similarity of the shingle sets
+    return float((signature == other).mean())
+
+def _content_hash(content):
+    return hashlib.sha256(content.encode('utf-8')).hexdigest()
+
+def _index_story(cursor, story_id, user_id, content):
+    # Called inside the transaction that writes the story, so the index never lags behind
+    cursor.execute('DELETE FROM story_lsh_buckets WHERE story_id = ?', (story_id,))
+    signature = minhash_signature(content)
+    if signature is None:
+        cursor.execute('DELETE FROM story_signatures WHERE story_id = ?', (story_id,))
+        return
+    cursor.execute('INSERT OR REPLACE INTO story_signatures (story_id, content_hash, signature) VALUES (?, ?, ?)',
+                   (story_id, _content_hash(content), signature.tobytes()))
+    cursor.executemany('INSERT OR IGNORE INTO story_lsh_buckets (user_id, band, bucket, story_id) VALUES (?, ?, ?, ?)',
+                       [(user_id, band, bucket, story_id) for band, bucket in lsh_buckets(signature)])
+
+def _find_identical_story(cursor, user_id, content):
+    cursor.execute('''
+        SELECT s.id FROM story_signatures g
+        JOIN stories s ON s.id = g.story_id
+        WHERE g.content_hash = ? AND s.user_id = ?
+        LIMIT 1
+    ''', (_content_hash(content), user_id))
+    row = cursor.fetchone()
+    return row[0] if row else None
+
+@instrument_query
+def find_similar_stories(user_id, content, limit=5, threshold=None, exclude_id=None):
+    # Only stories sharing at least one LSH bucket are compared, so the cost depends on the
+    # number of candidates, not on how many stories are saved
+    import numpy as np
+    
+    threshold = SIMILAR_STORY_THRESHOLD if threshold is None else threshold
+    signature = minhash_signature(content or '')
+    if signature is None:
+        return []
+    buckets = lsh_buckets(signature)
+    
+    with db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(f'''
+            WITH probes (band, bucket) AS (VALUES {', '.join(['(?, ?)'] * len(buckets))})
+            SELECT l.story_id, COUNT(*) AS shared FROM probes p
+            JOIN story_lsh_buckets l ON l.user_id = ? AND l.band = p.band AND l.bucket = p.bucket
+            GROUP BY l.story_id
+            ORDER BY shared DESC
+            LIMIT ?
+        ''', [value for bucket in buckets for value in bucket] + [user_id, LSH_MAX_CANDIDATES])
+        candidates = [row[0] for row in cursor.fetchall() if row[0] != exclude_id]
+        if not candidates:
+            return []
+        
+        cursor.execute(f'''
+            SELECT g.story_id, g.content_hash, g.signature, s.title FROM story_signatures g
+            JOIN stories s ON s.id = g.story_id
+            WHERE g.story_id IN ({', '.join('?' * len(candidates))})
+        ''', candidates)
+        rows = cursor.fetchall()
+    
+    content_hash = _content_hash(content)
+    similar = []
+    for story_id, story_hash, stored_signature, title in rows:
+        similarity = signature_similarity(signature, np.frombuffer(stored_signature, dtype=np.uint32))
+        if similarity >= threshold:
+            similar.append({'id': story_id, 'title': title, 'similarity': similarity, 'identical': story_hash == content_hash})
+    similar.sort(key=lambda story: (story['identical'], story['similarity']), reverse=True)
+    return similar[:limit]
+
+# Well-known tale store
+@st.cache_resource
+def get_tale_store():
+    # Process-wide so the corpus is loaded once, not on every rerun
+    return {'signature': None, 'source_hash': None, 'tales': [], 'index': {}, 'summaries': {}, 'lock': threading.Lock()}
+
+def _hash_file(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(65536), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def _parse_tales_file():
+    import pandas as pd
+    
+    df = pd.read_excel(TALES_FILE)
+    df = df.dropna(subset=['Story Title'])
+    df['Story Text'] = df['Story Text'].fillna('')
+    return [(str(row['Story Title']), str(row['Story Text'])) for row in df[['Story Title', 'Story Text']].to_dict('records')]
+
+def _load_compiled_tales(source_hash):
+    with db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT key, value FROM tale_corpus_meta WHERE key IN ('source_hash', 'summary_tokens')")
+        meta = dict(cursor.fetchall())
+        if meta.get('source_hash') != source_hash or meta.get('summary_tokens') != str(TALE_TOKEN_BUDGET):
+            return None
+        cursor.execute('SELECT title, text, summary FROM well_known_tales ORDER BY position')
+        return cursor.fetchall()
+
+def _compile_tales(source_hash, tales):
+    with db_connection() as conn:
+        cursor = conn.cursor()
+        
+        try:
+            cursor.execute('DELETE FROM well_known_tales')
+            cursor.executemany('INSERT INTO well_known_tales (position, title, text, summary) VALUES (?, ?, ?, ?)',
+                               [(i, title, text, summary) for i, (title, text, summary) in enumerate(tales)])
+            cursor.execute("INSERT OR REPLACE INTO tale_corpus_meta (key, value) VALUES ('source_hash', ?)", (source_hash,))
+            cursor.execute("INSERT OR REPLACE INTO tale_corpus_meta (key, value) VALUES ('summary_tokens', ?)", (str(TALE_TOKEN_BUDGET),))
+            conn.commit()
+        except sqlite3.Error as e:
+            logging.error(f"Database error while compiling well-known tales: {str(e)}")
+            conn.rollback()
+
+def _refresh_tale_store(store):
+    stat = os.stat(TALES_FILE)
+    signature = (stat.st_mtime_ns, stat.st_size)
+    if signature == store['signature']:
+        return
+    
+    with store['lock']:
+        if signature == store['signature']:
+            return
+        
+        source_hash = _hash_file(TALES_FILE)
+        if source_hash != store['source_hash']:
+            try:
+                tales = _load_compiled_tales(source_hash)
+            except sqlite3.Error as e:
+                logging.error(f"Database error while loading well-known tales: {str(e)}")
+                tales = None
+            if tales is None:
+                tales = [(title, text, summarize_text(text, TALE_TOKEN_BUDGET)) for title, text in _parse_tales_file()]
+                _compile_tales(source_hash, tales)
+                logging.info(f"Compiled {len(tales)} well-known tales from {TALES_FILE}")
+            
+            index = {}
+            for title, text, _ in tales:
+                index.setdefault(title, text)
+            store['tales'] = [{'Story Title': title, 'Story Text': text} for title, text, _ in tales]
+            store['index'] = index
+            store['summaries'] = {text: summary for _, text, summary in tales if summary and summary != text}
+            store['source_hash'] = source_hash
+        store['signature'] = signature
+
+def get_well_known_tales():
+    store = get_tale_store()
+    try:
+        _refresh_tale_store(store)
+        return store['tales']
+    except FileNotFoundError:
+        logging.error("well_known_tales.xlsx not found in the 'db' directory")
+        return []
+    except Exception as e:
+        logging.error(f"Error reading well-known tales: {str(e)}")
+        return []
+
+def get_tale_titles():
+    return [tale['Story Title'] for tale in get_well_known_tales()]
+
+def get_tale_text(title):
+    get_well_known_tales()
+    return get_tale_store()['index'].get(title)
+
+# Prompt construction
+def count_tokens(text):
+    # Local estimate of Llama 3 tokens for English prose: long words split into several tokens,
+    # punctuation is a token of its own. Close enough for budgeting, no tokenizer download needed
+    return sum(1 + (len(piece) - 1) // 7 for piece in TOKEN_PATTERN.findall(text or ''))
+
+def split_sentences(text):
+    return [sentence for sentence in SENTENCE_PATTERN.split(text.strip()) if sentence]
+
+def _truncate_words(text, token_budget, from_end=False):
+    words = text.split()
+    if from_end:
+        words = words[::-1]
+    kept = []
+    used = 0
+    for word in words:
+        used += count_tokens(word)
+        if used > token_budget:
+            break
+        kept.append(word)
+    if from_end:
+        return "... " + " ".join(kept[::-1])
+    return " ".join(kept) + " ..."
+
+@functools.lru_cache(maxsize=256)
+def summarize_text(text, token_budget):
+    # Extractive summary: sentences are ranked by how frequent their content words are in the
+    # whole text (the opening sentence gets a bonus), then the best ones that fit the budget are
+    # kept in their original order
+    if count_tokens(text) <= token_budget:
+        return text
+    sentences = split_sentences(text)
+    sentence_words = [[word for word in re.findall(r"[a-z']+", sentence.lower()) if word not in STOPWORDS] for sentence in sentences]
+    frequencies = {}
+    for words in sentence_words:
+        for word in words:
+            frequencies[word] = frequencies.get(word, 0) + 1
+    top = max(frequencies.values(), default=1)
+    
+    scores = []
+    for i, words in enumerate(sentence_words):
+        score = sum(frequencies[word] for word in words) / top / max(1, len(words)) ** 0.5
+        scores.append(score + (1.0 if i == 0 else 0.0))
+    
+    chosen = []
+    used = 0
+    for i in sorted(range(len(sentences)), key=lambda i: scores[i], reverse=True):
+        tokens = count_tokens(sentences[i])
+        if used + tokens <= token_budget:
+            chosen.append(i)
+            used += tokens
+    if not chosen:
+        return _truncate_words(text, token_budget)
+    return " ".join(sentences[i] for i in sorted(chosen))
+
+def keep_story_ending(text, token_budget):
+    # The model continues from the end of the user's beginning, so that is the part worth keeping
+    if count_tokens(text) <= token_budget:
+        return text
+    kept = []
+    used = 0
+    for sentence in reversed(split_sentences(text)):
+        tokens = count_tokens(sentence)
+        if used + tokens > token_budget:
+            break
+        kept.append(sentence)
+        used += tokens
+    if not kept:
+        return _truncate_words(text, token_budget, from_end=True)
+    return "... " + " ".join(reversed(kept))
+
+def condense_tale(text, token_budget):
+    if count_tokens(text) <= token_budget:
+        return text
+    if token_budget == TALE_TOKEN_BUDGET:
+        # Corpus tales are summarized once when the corpus is compiled
+        summary = get_tale_store()['summaries'].get(text)
+        if summary is not None:
+            return summary
+    return summarize_text(text, token_budget)
+
+def keep_story_opening(text, token_budget):
+    # Counterpart of keep_story_ending for the text that follows an edited section
+    if count_tokens(text) <= token_budget:
+        return text
+    kept = []
+    used = 0
+    for sentence in split_sentences(text):
+        tokens = count_tokens(sentence)
+        if used + tokens > token_budget:
+            break
+        kept.append(sentence)
+        used += tokens
+    if not kept:
+        return _truncate_words(text, token_budget)
+    return " ".join(kept) + " ..."
+
+def describe_story_parameters(data):
+    lines = f"Story Origin: {data.get('story_origin')}\n"
+    lines += f"Use Case: {data.get('use_case')}\n"
+    lines += f"Time Frame: {data.get('time_frame')}\n"
+    if data.get('age'):
+        lines += f"Age: {data['age']}\n"
+    lines += f"Focus: {', '.join(data.get('focus') or [])}\n"
+    lines += f"Story Type: {data.get('story_type')}\n"
+    lines += f"Narrative Structure: {data.get('narrative_structure')}\n"
+    lines += f"Simplified Structure: {data.get('simplified_structure')}\n"
+    lines += f"Creative Enhancements: {', '.join(data.get('creative_enhancements') or [])}\n"
+    return lines
+
+def build_prompt(data, selected_tale_text=None, token_budget=None):
+    # Returns (prompt, report). Source material over its budget is condensed; the report lists what
+    # was condensed and how many prompt tokens that saved
+    token_budget = token_budget or PROMPT_TOKEN_BUDGET
+    prompt = f"Generate a {data['length']} story with the following parameters:\n"
+    prompt += describe_story_parameters(data)
+    
+    tale_intro = "Based on the following well-known tale, create a similar story:\n"
+    start_intro = "Start with the following user-provided story beginning:\n"
+    condensed = []
+    original_tokens = count_tokens(prompt)
+    remaining = token_budget - original_tokens
+    
+    user_story_start = data['user_story_start']
+    if user_story_start:
+        user_tokens = count_tokens(user_story_start)
+        original_tokens += count_tokens(start_intro) + user_tokens
+        budget = min(USER_START_TOKEN_BUDGET, remaining - count_tokens(start_intro))
+        if user_tokens > budget:
+            user_story_start = keep_story_ending(user_story_start, max(0, budget))
+            condensed.append({'source': 'user_story_start', 'original_tokens': user_tokens, 'tokens': count_tokens(user_story_start)})
+        remaining -= count_tokens(start_intro) + count_tokens(user_story_start)
+    
+    if selected_tale_text:
+        tale_tokens = count_tokens(selected_tale_text)
+        original_tokens += count_tokens(tale_intro) + tale_tokens
+        budget = min(TALE_TOKEN_BUDGET, remaining - count_tokens(tale_intro))
+        if tale_tokens > budget:
+            selected_tale_text = condense_tale(selected_tale_text, max(0, budget))
+            condensed.append({'source': 'tale', 'original_tokens': tale_tokens, 'tokens': count_tokens(selected_tale_text)})
+        prompt += f"{tale_intro}{selected_tale_text}\n"
+    
+    if user_story_start:
+        prompt += f"{start_intro}{user_story_start}\n"
+    
+    prompt_tokens = count_tokens(prompt)
+    return prompt, {
+        'prompt_tokens': prompt_tokens,
+        'original_tokens': original_tokens,
+        'tokens_saved': max(0, original_tokens - prompt_tokens),
+        'condensed': condensed
+    }
+
+def construct_prompt(data, selected_tale_text=None):
+    return build_prompt(data, selected_tale_text)[0]
+
+def prepare_prompt(data, selected_tale_text=None):
+    # construct_prompt for requests that are actually sent: also records the prompt size
+    prompt, report = build_prompt(data, selected_tale_text)
+    observe('storyteller_prompt_tokens', report['prompt_tokens'])
+    if report['tokens_saved']:
+        increment_counter('storyteller_prompt_tokens_saved_total', report['tokens_saved'])
+        logging.info(f"Prompt condensed from {report['original_tokens']} to {report['prompt_tokens']} estimated tokens")
+    return prompt
+
+def build_messages(prompt):
+    return [
+        {"role": "system", "content": "You are an AI storytelling assistant."},
+        {"role": "user", "content": prompt}
+    ]
+
+# LLM request policy
+@st.cache_resource
+def get_circuit_breakers():
+    # Process-wide per-model failure state: 'closed' passes requests, 'open' rejects them until
+    # CIRCUIT_RESET_SECONDS passed, then a single 'half_open' trial request decides
+    return {'lock': threading.Lock(), 'models': {}}
+
+def circuit_allows(model, take_trial=True):
+    # With take_trial=False this only peeks: a recovering circuit keeps its trial for a request
+    # that is actually sent
+    breakers = get_circuit_breakers()
+    with breakers['lock']:
+        state = breakers['models'].setdefault(model, {'state': 'closed', 'failures': 0, 'opened_at': 0.0})
+        if state['state'] == 'closed':
+            return True
+        if time.monotonic() - state['opened_at'] >= CIRCUIT_RESET_SECONDS:
+            if not take_trial:
+                return True
+            # A trial that never reports back (e.g. an abandoned hedge) gets another chance later
+            state['state'] = 'half_open'
+            state['opened_at'] = time.monotonic()
+            return True
+        return False
+
+def record_model_success(model):
+    breakers = get_circuit_breakers()
+    with breakers['lock']:
+        breakers['models'][model] = {'state': 'closed', 'failures': 0, 'opened_at': 0.0}
+    set_gauge('storyteller_llm_circuit_open', 0, model=model)
+
+def record_model_failure(model):
+    breakers = get_circuit_breakers()
+    with breakers['lock']:
+        state = breakers['models'].setdefault(model, {'state': 'closed', 'failures': 0, 'opened_at': 0.0})
+        state['failures'] += 1
+        if state['state'] == 'open' or (state['state'] == 'closed' and state['failures'] < CIRCUIT_FAILURE_THRESHOLD):
+            return
+        state['state'] = 'open'
+        state['opened_at'] = time.monotonic()
+    logging.warning(f"Circuit breaker opened for model {model}")
+    increment_counter('storyteller_llm_circuit_opened_total', model=model)
+    set_gauge('storyteller_llm_circuit_open', 1, model=model)
+
+def get_circuit_states():
+    breakers = get_circuit_breakers()
+    with breakers['lock']:
+        return {model: dict(state) for model, state in breakers['models'].items()}
+
+def get_hedge_delay(model, metric, **labels):
+    # Hedge once the primary runs past its own p95; fixed default until there are enough samples
+    p95, samples = get_quantile(metric, LLM_HEDGE_QUANTILE, model=model, **labels)
+    if samples < LLM_HEDGE_MIN_SAMPLES or p95 is None:
+        return LLM_HEDGE_DEFAULT_SECONDS
+    return max(LLM_HEDGE_MIN_SECONDS, p95)
+
+def get_candidate_models():
+    # The first model is sent right away; the fallback is only sent as a hedge, so callers take
+    # its trial with circuit_allows when they start it
+    models = []
+    for model in (STORY_MODEL, FALLBACK_MODEL):
+        if model and circuit_allows(model, take_trial=not models):
+            models.append(model)
+    if not models:
+        raise Exception("All story models are temporarily unavailable")
+    return models
+
+def is_retryable_error(error):
+    from groq import APIConnectionError, APIStatusError
+    
+    if isinstance(error, (TimeoutError, APIConnectionError)):
+        return True
+    if isinstance(error, APIStatusError):
+        return error.status_code in (408, 409, 429) or error.status_code >= 500
+    return False
+
+@st.cache_resource
+def get_llm_executor():
+    # Threads for in-flight LLM attempts, so a slow attempt can be hedged or abandoned at its deadline.
+    # Each turn runs at most a primary and a hedge; the headroom covers abandoned complete() calls,
+    # which can't be interrupted and run on until their own timeout after the turn is released
+    return ThreadPoolExecutor(max_workers=2 * LLM_MAX_CONCURRENCY + LLM_EXECUTOR_HEADROOM, thread_name_prefix="llm")
+
+# Fair-share LLM scheduling
+@st.cache_resource
+def get_llm_scheduler():
+    # Process-wide: every session, job worker and batch thread waits here for a turn to call the LLM
+    return {
+        'condition': threading.Condition(),
+        'waiting': [],
+        'running': 0,
+        'sequence': 0,
+        'virtual_time': 0.0,
+        'finish_tags': {},
+        'buckets': {}
+    }
+
+def _refill_bucket(state, key, rate, capacity, now):
+    # Token bucket refilled at `rate` tokens per minute up to `capacity`; it can go negative when a
+    # request used more than it was charged up front
+    bucket = state['buckets'].get(key)
+    if bucket is None:
+        bucket = state['buckets'][key] = {'tokens': float(capacity), 'updated': now, 'rate': rate, 'capacity': capacity}
+    else:
+        bucket['tokens'] = min(capacity, bucket['tokens'] + (now - bucket['updated']) * rate / 60)
+        bucket['updated'] = now
+    return bucket
+
+def _user_budget(user_id, kind):
+    # (bucket key, tokens per minute, capacity) of the user's budget for this kind of work, or None
+    if user_id is None:
+        return None
+    if kind == 'batch':
+        return (('batch', user_id), BATCH_TOKENS_PER_MINUTE, BATCH_TOKENS_PER_MINUTE) if BATCH_TOKENS_PER_MINUTE else None
+    return (('user', user_id), USER_TOKENS_PER_MINUTE, USER_TOKEN_BURST) if USER_TOKENS_PER_MINUTE else None
+
+def _ticket_budgets(ticket):
+    budgets = []
+    user_budget = _user_budget(ticket['user_id'], ticket['kind'])
+    if user_budget:
+        budgets.append(user_budget)
+    if LLM_TOKENS_PER_MINUTE:
+        budgets.append((('provider', None), LLM_TOKENS_PER_MINUTE, LLM_TOKENS_PER_MINUTE))
+    return budgets
+
+def _budget_wait(state, key, rate, capacity, cost, now):
+    # Seconds until the bucket holds the cost; a request bigger than the bucket waits for a full one
+    bucket = _refill_bucket(state, key, rate, capacity, now)
+    return max(0.0, (min(cost, capacity) - bucket['tokens']) * 60 / rate)
+
+def _next_ticket(state, now):
+    # Returns (ticket, wait): the waiting ticket with the smallest finish tag that may start now, or
+    # None and how long until one might. A user over budget is skipped; the provider budget holds
+    # everyone back, so small requests can't starve a large one at the head of the queue
+    if state['running'] >= LLM_MAX_CONCURRENCY:
+        return None, None
+    shortest = None
+    for ticket in sorted(state['waiting'], key=lambda ticket: (ticket['finish'], ticket['sequence'])):
+        user_wait = 0.0
+        for key, rate, capacity in _ticket_budgets(ticket):
+            wait = _budget_wait(state, key, rate, capacity, ticket['cost'], now)
+            if key[0] == 'provider' and wait > 0:
+                return None, wait if shortest is None else min(shortest, wait)
+            user_wait = max(user_wait, wait)
+        if user_wait <= 0:
+            return ticket, 0.0
+        shortest = user_wait if shortest is None else min(shortest, user_wait)
+    return None, shortest
+
+def _prune_scheduler(state, now):
+    if len(state['finish_tags']) > LLM_SCHEDULER_MAX_USERS:
+        state['finish_tags'] = {user_id: finish for user_id, finish in state['finish_tags'].items() if finish > state['virtual_time']}
+    if len(state['buckets']) > LLM_SCHEDULER_MAX_USERS:
+        # A bucket that has refilled completely is the same as a new one
+        state['buckets'] = {key: bucket for key, bucket in state['buckets'].items()
+                            if bucket['tokens'] + (now - bucket['updated']) * bucket['rate'] / 60 < bucket['capacity']}
+
+def acquire_llm_turn(user_id, kind, cost):
+    # Blocks until the request may be sent and charges its estimated cost (prompt plus expected
+    # completion tokens) up front; release_llm_turn settles it against the reported usage
+    state = get_llm_scheduler()
+    priority = LLM_PRIORITIES[kind]
+    start = time.monotonic()
+    deadline = start + priority['queue_timeout'] if priority['queue_timeout'] else None
+    
+    with state['condition']:
+        user_budget = _user_budget(user_id, kind)
+        if user_budget:
+            wait = _budget_wait(state, *user_budget, cost, start)
+            if deadline is not None and start + wait > deadline:
+                increment_counter('storyteller_llm_throttled_total', reason='user_budget', kind=kind)
+                raise Exception(f"You have used up your story generation allowance for now. Please try again in {int(wait) + 1} seconds.")
+            if wait >= LLM_BUDGET_LOG_SECONDS:
+                logging.info(f"User {user_id} is over their {kind} token budget, waiting about {wait:.0f}s for the next LLM request")
+        
+        # Self-clocked fair queueing: each user's requests are spaced cost / weight apart in virtual
+        # time, so a user with many requests in flight falls behind users with few
+        finish = max(state['virtual_time'], state['finish_tags'].get(user_id, 0.0)) + cost / priority['weight']
+        state['finish_tags'][user_id] = finish
+        state['sequence'] += 1
+        ticket = {'user_id': user_id, 'kind': kind, 'cost': cost, 'finish': finish, 'sequence': state['sequence']}
+        state['waiting'].append(ticket)
+        set_gauge('storyteller_llm_queue_depth', len(state['waiting']))
+        
+        try:
+            while True:
+                now = time.monotonic()
+                chosen, wait = _next_ticket(state, now)
+                if chosen is ticket:
+                    break
+                if chosen is not None:
+                    # Another ticket's turn: wake its thread and wait for the next change
+                    state['condition'].notify_all()
+                    wait = None
+                if deadline is not None and now >= deadline:
+                    increment_counter('storyteller_llm_throttled_total', reason='queue_timeout', kind=kind)
+                    raise Exception("Story generation is busy right now. Please try again in a moment.")
+                timeouts = [value for value in (wait, deadline - now if deadline is not None else None) if value is not None]
+                state['condition'].wait(min(timeouts) if timeouts else None)
+        except BaseException:
+            state['waiting'].remove(ticket)
+            set_gauge('storyteller_llm_queue_depth', len(state['waiting']))
+            state['condition'].notify_all()
+            raise
+        
+        state['waiting'].remove(ticket)
+        for key, rate, capacity in _ticket_budgets(ticket):
+            state['buckets'][key]['tokens'] -= cost
+        state['running'] += 1
+        state['virtual_time'] = max(state['virtual_time'], finish)
+        _prune_scheduler(state, now)
+        set_gauge('storyteller_llm_queue_depth', len(state['waiting']))
+        set_gauge('storyteller_llm_in_flight', state['running'])
+        state['condition'].notify_all()
+    
+    observe('storyteller_llm_queue_seconds', time.monotonic() - start, kind=kind)
+    return ticket
+
+def release_llm_turn(ticket):
+    state = get_llm_scheduler()
+    usage = ticket.get('usage')
+    with state['condition']:
+        state['running'] -= 1
+        if usage:
+            # Settle the up-front estimate against what the provider reported
+            extra = usage['prompt_tokens'] + usage['completion_tokens'] - ticket['cost']
+            for key, rate, capacity in _ticket_budgets(ticket):
+                bucket = _refill_bucket(state, key, rate, capacity, time.monotonic())
+                bucket['tokens'] = min(capacity, bucket['tokens'] - extra)
+        set_gauge('storyteller_llm_in_flight', state['running'])
+        state['condition'].notify_all()
+    
+    if usage and ticket['user_id'] is not None:
+        try:
+            record_llm_usage(ticket['user_id'], ticket['kind'], ticket['model'], usage)
+        except Exception as e:
+            logging.error(f"Could not record LLM usage of user {ticket['user_id']}: {str(e)}")
+
+def estimate_request_tokens(prompt, options):
+    return count_tokens(prompt) + options.get('max_tokens', LLM_DEFAULT_COMPLETION_TOKENS)
+
+def get_llm_allowance(user_id):
+    # What the user's token bucket holds right now, or None when there is no per-user limit
+    if not USER_TOKENS_PER_MINUTE:
+        return None
+    state = get_llm_scheduler()
+    with state['condition']:
+        bucket = _refill_bucket(state, ('user', user_id), USER_TOKENS_PER_MINUTE, USER_TOKEN_BURST, time.monotonic())
+        return {'available': max(0, int(bucket['tokens'])), 'capacity': USER_TOKEN_BURST, 'per_minute': USER_TOKENS_PER_MINUTE}
+
+def get_llm_scheduler_stats():
+    state = get_llm_scheduler()
+    with state['condition']:
+        waiting = {kind: 0 for kind in LLM_PRIORITIES}
+        for ticket in state['waiting']:
+            waiting[ticket['kind']] += 1
+        return {'running': state['running'], 'waiting': waiting, 'users_waiting': len({ticket['user_id'] for ticket in state['waiting']})}
+
+@instrument_query
+def record_llm_usage(user_id, kind, model, usage):
+    with db_connection() as conn:
+        conn.execute('''
+            INSERT INTO llm_usage (user_id, day, kind, model, requests, prompt_tokens, completion_tokens)
+            VALUES (?, ?, ?, ?, 1, ?, ?)
+            ON CONFLICT (user_id, day, kind, model) DO UPDATE SET
+                requests = requests + 1,
+                prompt_tokens = prompt_tokens + excluded.prompt_tokens,
+                completion_tokens = completion_tokens + excluded.completion_tokens
+        ''', (user_id, datetime.now().strftime('%Y-%m-%d'), kind, model, usage['prompt_tokens'], usage['completion_tokens']))
+        conn.commit()
+    bump_data_version('usage', user_id)
+
+@instrument_query
+def get_llm_usage(user_id, days=USAGE_HISTORY_DAYS):
+    since = (datetime.now() - timedelta(days=days - 1)).strftime('%Y-%m-%d')
+    with db_connection() as conn:
+        rows = conn.execute('''
+            SELECT day, kind, model, requests, prompt_tokens, completion_tokens
+            FROM llm_usage
+            WHERE user_id = ? AND day >= ?
+            ORDER BY day
+        ''', (user_id, since)).fetchall()
+    return [
+        {'day': row[0], 'kind': row[1], 'model': row[2], 'requests': row[3], 'prompt_tokens': row[4], 'completion_tokens': row[5]}
+        for row in rows
+    ]
+
+@instrument_query
+def get_llm_usage_by_user(days=7, limit=20):
+    since = (datetime.now() - timedelta(days=days - 1)).strftime('%Y-%m-%d')
+    with db_connection() as conn:
+        rows = conn.execute('''
+            SELECT users.username, SUM(llm_usage.requests), SUM(llm_usage.prompt_tokens), SUM(llm_usage.completion_tokens)
+            FROM llm_usage
+            JOIN users ON users.id = llm_usage.user_id
+            WHERE llm_usage.day >= ?
+            GROUP BY llm_usage.user_id
+            ORDER BY SUM(llm_usage.prompt_tokens + llm_usage.completion_tokens) DESC
+            LIMIT ?
+        ''', (since, limit)).fetchall()
+    return [
+        {'username': row[0], 'requests': row[1], 'prompt_tokens': row[2], 'completion_tokens': row[3]}
+        for row in rows
+    ]
+
+def _complete_once(model, messages, options):
+    start = time.perf_counter()
+    response = get_groq_client().chat.completions.create(
+        messages=messages,
+        model=model,
+        timeout=LLM_ATTEMPT_TIMEOUT_SECONDS,
+        **options
+    )
+    usage = {
+        'prompt_tokens': getattr(response.usage, 'prompt_tokens', 0) or 0,
+        'completion_tokens': getattr(response.usage, 'completion_tokens', 0) or 0
+    }
+    observe('storyteller_llm_request_seconds', time.perf_counter() - start, model=model, mode='complete')
+    return response.choices[0].message.content, usage
+
+def complete_with_hedging(messages, options):
+    # One attempt: the primary model, plus the fallback if the primary fails or runs past its p95.
+    # Returns (story, usage, model) of whichever answers first
+    from concurrent.futures import FIRST_COMPLETED, wait
+    
+    models = get_candidate_models()
+    executor = get_llm_executor()
+    start = time.monotonic()
+    deadline = start + LLM_ATTEMPT_TIMEOUT_SECONDS
+    hedge_at = start + get_hedge_delay(models[0], 'storyteller_llm_request_seconds', mode='complete') if len(models) > 1 else None
+    pending = {executor.submit(_complete_once, models[0], messages, options): models[0]}
+    error = None
+    
+    while pending:
+        now = time.monotonic()
+        wake_at = deadline if hedge_at is None else min(deadline, hedge_at)
+        done, _ = wait(pending, timeout=max(0.0, wake_at - now), return_when=FIRST_COMPLETED)
+        for future in done:
+            model = pending.pop(future)
+            try:
+                story, usage = future.result()
+            except Exception as e:
+                increment_counter('storyteller_llm_errors_total', model=model, mode='complete')
+                record_model_failure(model)
+                error = e
+                continue
+            record_model_success(model)
+            if model != models[0]:
+                increment_counter('storyteller_llm_hedge_wins_total', model=model)
+            return story, usage, model
+        
+        now = time.monotonic()
+        if hedge_at is not None and (now >= hedge_at or not pending):
+            # Hedge a slow primary, or fall back right away when it failed
+            hedge_at = None
+            if circuit_allows(models[1]):
+                increment_counter('storyteller_llm_hedges_total', model=models[1])
+                pending[executor.submit(_complete_once, models[1], messages, options)] = models[1]
+        elif now >= deadline and pending:
+            for model in pending.values():
+                increment_counter('storyteller_llm_errors_total', model=model, mode='complete')
+                record_model_failure(model)
+            raise TimeoutError(f"No answer from {', '.join(pending.values())} within {LLM_ATTEMPT_TIMEOUT_SECONDS:.0f}s")
+    raise error
+
+def _stream_once(model, messages, options, events, cancelled, streams):
+    # Producer for stream_with_hedging: puts (model, event, value) tuples, stops early when cancelled.
+    # While it reads, the stream is listed in streams['open'], so the consumer can interrupt it
+    start = time.perf_counter()
+    first_token = True
+    try:
+        stream = get_groq_client().chat.completions.create(
+            messages=messages,
+            model=model,
+            stream=True,
+            timeout=LLM_ATTEMPT_TIMEOUT_SECONDS,
+            **options
+        )
+        with streams['lock']:
+            streams['open'][model] = stream
+        try:
+            if cancelled.is_set():
+                return
+            for chunk in stream:
+                if cancelled.is_set():
+                    return
+                # Groq reports token usage on the final chunk of a stream
+                usage = getattr(getattr(chunk, 'x_groq', None), 'usage', None)
+                if usage is not None:
+                    events.put((model, 'usage', {'prompt_tokens': usage.prompt_tokens or 0, 'completion_tokens': usage.completion_tokens or 0}))
+                if not chunk.choices:
+                    continue
+                content = chunk.choices[0].delta.content
+                if content:
+                    if first_token:
+                        observe('storyteller_llm_time_to_first_token_seconds', time.perf_counter() - start, model=model)
+                        first_token = False
+                    events.put((model, 'chunk', content))
+            observe('storyteller_llm_request_seconds', time.perf_counter() - start, model=model, mode='stream')
+            events.put((model, 'done', None))
+        finally:
+            # Unlisted first, so the consumer never interrupts a connection that went back to the pool
+            with streams['lock']:
+                streams['open'].pop(model, None)
+            stream.close()
+    except Exception as e:
+        if not cancelled.is_set():
+            events.put((model, 'error', e))
+
+def _interrupt_stream(stream):
+    # Closing a response from another thread doesn't wake a read blocked waiting for the next chunk
+    # (e.g. a slow model's first token); shutting its socket down makes that read fail right away
+    response = getattr(stream, 'response', None)
+    network_stream = response.extensions.get('network_stream') if response is not None else None
+    sock = network_stream.get_extra_info('socket') if network_stream is not None else None
+    if sock is None:
+        return
+    try:
+        # The plain socket's method, so a TLS socket keeps its state for the reader to fail on
+        socket.socket.shutdown(sock, socket.SHUT_RDWR)
+    except OSError as e:
+        logging.debug(f"Error interrupting abandoned LLM stream: {str(e)}")
+
+def stream_with_hedging(messages, options, turn=None):
+    # Streaming counterpart of complete_with_hedging. The race is decided by the first text chunk:
+    # the fallback is started when the primary's time to first token passes its p95, and the
+    # model that speaks first is streamed while the other one is cancelled
+    models = get_candidate_models()
+    executor = get_llm_executor()
+    events = queue.Queue()
+    cancelled = {model: threading.Event() for model in models}
+    streams = {'lock': threading.Lock(), 'open': {}}
+    start = time.monotonic()
+    deadline = start + LLM_ATTEMPT_TIMEOUT_SECONDS
+    hedge_at = start + get_hedge_delay(models[0], 'storyteller_llm_time_to_first_token_seconds') if len(models) > 1 else None
+    running = {models[0]}
+    executor.submit(_stream_once, models[0], messages, options, events, cancelled[models[0]], streams)
+    winner = None
+    error = None
+    
+    try:
+        while True:
+            if winner is None:
+                wake_at = deadline if hedge_at is None else min(deadline, hedge_at)
+                try:
+                    model, event, value = events.get(timeout=max(0.0, wake_at - time.monotonic()))
+                except queue.Empty:
+                    if hedge_at is not None and time.monotonic() >= hedge_at:
+                        hedge_at = None
+                        if circuit_allows(models[1]):
+                            running.add(models[1])
+                            increment_counter('storyteller_llm_hedges_total', model=models[1])
+                            executor.submit(_stream_once, models[1], messages, options, events, cancelled[models[1]], streams)
+                        elif not running:
+                            raise error
+                    elif time.monotonic() >= deadline:
+                        for model in running:
+                            increment_counter('storyteller_llm_errors_total', model=model, mode='stream')
+                            record_model_failure(model)
+                        raise TimeoutError(f"No answer from {', '.join(sorted(running))} within {LLM_ATTEMPT_TIMEOUT_SECONDS:.0f}s")
+                    continue
+            else:
+                model, event, value = events.get()
+            
+            if winner is None and event == 'error':
+                running.discard(model)
+                increment_counter('storyteller_llm_errors_total', model=model, mode='stream')
+                record_model_failure(model)
+                error = value
+                if hedge_at is not None:
+                    hedge_at = time.monotonic()
+                elif not running:
+                    raise value
+                continue
+            if winner is None:
+                winner = model
+                if turn is not None:
+                    turn['model'] = model
+                for other in running - {model}:
+                    cancelled[other].set()
+                if model != models[0]:
+                    increment_counter('storyteller_llm_hedge_wins_total', model=model)
+            if model != winner:
+                continue
+            
+            if event == 'chunk':
+                yield value
+            elif event == 'usage':
+                record_token_usage(value, model, turn)
+            elif event == 'done':
+                record_model_success(model)
+                return
+            elif event == 'error':
+                increment_counter('storyteller_llm_errors_total', model=model, mode='stream')
+                record_model_failure(model)
+                raise value
+    finally:
+        # Also reached when the consumer stops early or the attempt timed out. Interrupting the
+        # open streams ends their producers now rather than at their next chunk, so they don't
+        # hold executor threads after the caller has released its turn
+        for event in cancelled.values():
+            event.set()
+        with streams['lock']:
+            for stream in streams['open'].values():
+                _interrupt_stream(stream)
+
+def generate_story_with_usage(data, selected_tale_text=None, temperature=None, user_id=None, kind='interactive'):
+    prompt = prepare_prompt(data, selected_tale_text)
+    options = {} if temperature is None else {'temperature': temperature}
+    
+    for attempt in range(LLM_MAX_RETRIES + 1):
+        # Scheduler refusals (allowance used up, queue too long) reach the caller as they are. Each
+        # attempt takes its own turn, so retry backoff doesn't hold a slot
+        turn = acquire_llm_turn(user_id, kind, estimate_request_tokens(prompt, options))
+        try:
+            story, usage, model = complete_with_hedging(build_messages(prompt), options)
+            record_token_usage(usage, model, turn)
+            return story, usage
+        except Exception as e:
+            if attempt >= LLM_MAX_RETRIES or not is_retryable_error(e):
+                logging.error(f"Story generation error: {str(e)}")
+                raise Exception("Error generating story") from e
+            delay = _rate_limit_delay(e, attempt)
+            increment_counter('storyteller_llm_retries_total', mode='complete')
+            logging.warning(f"LLM request failed ({str(e)}), retrying in {delay:.1f}s")
+        finally:
+            release_llm_turn(turn)
+        time.sleep(delay)
+
+def record_token_usage(usage, model=STORY_MODEL, turn=None):
+    increment_counter('storyteller_llm_prompt_tokens_total', usage['prompt_tokens'], model=model)
+    increment_counter('storyteller_llm_completion_tokens_total', usage['completion_tokens'], model=model)
+    if turn is not None:
+        # Settled against the user's budget and written to llm_usage when the turn is released
+        turn['usage'] = usage
+        turn['model'] = model
+
+def generate_story(data, selected_tale_text=None, temperature=None, user_id=None):
+    story, _ = generate_story_with_usage(data, selected_tale_text, temperature, user_id)
+    return story
+
+def generate_story_stream(data, selected_tale_text=None, temperature=None, user_id=None, answer=None):
+    # Yields the story text chunk by chunk as the model produces it. When given, `answer` is
+    # filled with the model that wrote it
+    prompt = prepare_prompt(data, selected_tale_text)
+    options = {} if temperature is None else {'temperature': temperature}
+    yield from _stream_prompt(prompt, options, user_id, answer=answer)
+
+def _stream_prompt(prompt, options, user_id=None, kind='interactive', answer=None):
+    for attempt in range(LLM_MAX_RETRIES + 1):
+        started = False
+        # Scheduler refusals (allowance used up, queue too long) reach the user as they are
+        turn = acquire_llm_turn(user_id, kind, estimate_request_tokens(prompt, options))
+        try:
+            # Closed explicitly, so abandoned streams are shut before the turn is released
+            with closing(stream_with_hedging(build_messages(prompt), options, turn)) as chunks:
+                for chunk in chunks:
+                    started = True
+                    yield chunk
+            if answer is not None:
+                answer['model'] = turn.get('model')
+            return
+        except Exception as e:
+            # Only retry before any text went out, otherwise the story would repeat itself
+            if started or attempt >= LLM_MAX_RETRIES or not is_retryable_error(e):
+                logging.error(f"Story generation error: {str(e)}")
+                raise Exception("Error generating story") from e
+            delay = _rate_limit_delay(e, attempt)
+            increment_counter('storyteller_llm_retries_total', mode='stream')
+            logging.warning(f"LLM stream failed ({str(e)}), retrying in {delay:.1f}s")
+        finally:
+            release_llm_turn(turn)
+        time.sleep(delay)
+
+# Section editing
+def _check_section(sections, start, end, action):
+    if action not in SECTION_ACTIONS:
+        raise Exception(f"Unknown section action: {action}")
+    if not 0 <= start < end <= len(sections):
+        raise Exception(f"Invalid section: paragraphs {start + 1} to {end} of {len(sections)}")
+
+def build_section_prompt(data, sections, start, end, action):
+    # Returns (prompt, report). The model sees the story parameters, the selected paragraphs and
+    # at most SECTION_CONTEXT_TOKENS of the text on either side of them
+    _check_section(sections, start, end, action)
+    section = "\n\n".join(sections[start:end])
+    before = keep_story_ending("\n\n".join(sections[:start]), SECTION_CONTEXT_TOKENS)
+    after = keep_story_opening("\n\n".join(sections[end:]), SECTION_CONTEXT_TOKENS)
+    section_tokens = count_tokens(section)
+    target_words = max(20, round(len(section.split()) * SECTION_ACTIONS[action]['length_factor']))
+    
+    prompt = "You are editing one section of a story with the following parameters:\n"
+    prompt += describe_story_parameters(data)
+    if before:
+        prompt += f"Text before the section:\n{before}\n"
+    prompt += f"SECTION:\n{section}\n"
+    if after:
+        prompt += f"Text after the section:\n{after}\n"
+    prompt += f"{SECTION_ACTIONS[action]['instruction']} Write about {target_words} words. "
+    prompt += "Reply with the new text only, without headings, labels or quotation marks.\n"
     
-    conn.commit()
-    conn.close()
+    return prompt, {
+        'prompt_tokens': count_tokens(prompt),
+        'section_tokens': section_tokens,
+        'max_tokens': round(section_tokens * SECTION_ACTIONS[action]['length_factor'] * 1.5) + SECTION_COMPLETION_HEADROOM
+    }
 
-def get_professionals():
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
+def splice_story_section(sections, start, end, action, text):
+    # Regenerated and expanded text replaces the selected paragraphs, continued text follows them
+    text = text.strip()
+    if action == 'continue':
+        sections = sections[:end] + [text] + sections[end:]
+    else:
+        sections = sections[:start] + [text] + sections[end:]
+    return "\n\n".join(section for section in sections if section)
+
+def edit_story_section_stream(data, story, start, end, action, temperature=None, user_id=None):
+    # Yields the new section chunk by chunk; start and end select paragraphs [start, end) of story
+    prompt, report = build_section_prompt(data, split_paragraphs(story), start, end, action)
+    observe('storyteller_prompt_tokens', report['prompt_tokens'])
+    increment_counter('storyteller_section_edits_total', action=action)
+    options = {'max_tokens': report['max_tokens']}
+    if temperature is not None:
+        options['temperature'] = temperature
+    yield from _stream_prompt(prompt, options, user_id)
+
+def edit_story_section(data, story, start, end, action, temperature=None, user_id=None):
+    # Returns the whole story with the section edited
+    text = "".join(edit_story_section_stream(data, story, start, end, action, temperature, user_id))
+    return splice_story_section(split_paragraphs(story), start, end, action, text)
+
+# Multi-draft generation
+def build_story_variants(data, n, vary='temperature'):
+    variants = []
+    for i in range(n):
+        if vary == 'narrative_structure':
+            start = NARRATIVE_STRUCTURES.index(data['narrative_structure']) if data['narrative_structure'] in NARRATIVE_STRUCTURES else 0
+            structure = NARRATIVE_STRUCTURES[(start + i) % len(NARRATIVE_STRUCTURES)]
+            variants.append({'params': dict(data, narrative_structure=structure), 'temperature': None, 'label': structure})
+        else:
+            temperature = round(0.6 + 0.2 * i, 2)
+            variants.append({'params': dict(data), 'temperature': temperature, 'label': f"Temperature {temperature}"})
+    return variants
+
+def _rate_limit_delay(error, attempt, base=LLM_BACKOFF_SECONDS):
+    # Prefer the provider's Retry-After hint, otherwise jittered exponential backoff
+    response = getattr(error, 'response', None)
+    retry_after = response.headers.get('retry-after') if response is not None else None
+    try:
+        return float(retry_after)
+    except (TypeError, ValueError):
+        return base * (2 ** attempt) * random.uniform(0.5, 1.5)
+
+def _stream_variant(index, variant, selected_tale_text, events, user_id=None):
+    # Rate limits and other retryable errors are already retried by _stream_prompt
+    try:
+        for chunk in generate_story_stream(variant['params'], selected_tale_text, variant['temperature'], user_id):
+            events.put((index, 'chunk', chunk))
+        events.put((index, 'done', None))
+    except Exception as e:
+        events.put((index, 'error', e))
+
+def generate_story_variants_stream(data, selected_tale_text=None, n=3, vary='temperature', max_concurrency=None, user_id=None):
+    # Yields (draft index, event, value) tuples; event is 'chunk', 'done' or 'error'
+    variants = build_story_variants(data, n, vary)
+    events = queue.Queue()
+    executor = ThreadPoolExecutor(max_workers=max(1, min(n, max_concurrency or DRAFT_MAX_CONCURRENCY)))
     
     try:
-        cursor.execute('SELECT * FROM professionals')
-        professionals = cursor.fetchall()
-        
-        print("Debug - Raw professionals data:", professionals)  # Add this line
+        for index, variant in enumerate(variants):
+            executor.submit(_stream_variant, index, variant, selected_tale_text, events, user_id)
+        remaining = n
+        while remaining:
+            index, event, value = events.get()
+            if event != 'chunk':
+                remaining -= 1
+            yield index, event, value
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+
+def generate_story_variants(data, selected_tale_text=None, n=3, vary='temperature', max_concurrency=None, user_id=None):
+    variants = build_story_variants(data, n, vary)
+    chunks = [[] for _ in variants]
+    for index, event, value in generate_story_variants_stream(data, selected_tale_text, n, vary, max_concurrency, user_id):
+        if event == 'chunk':
+            chunks[index].append(value)
+        elif event == 'error':
+            variants[index]['error'] = str(value)
+    for variant, parts in zip(variants, chunks):
+        variant['story'] = "".join(parts)
+    return variants
+
+# Response cache functions
+def canonicalize_request(data, selected_tale_text=None):
+    # Multiselect order and surrounding whitespace don't change the story we ask for
+    canonical = {}
+    for key, value in data.items():
+        if isinstance(value, str):
+            value = value.strip() or None
+        elif isinstance(value, (list, tuple)):
+            value = sorted(str(item).strip() for item in value)
+        canonical[key] = value
     
-        conn.close()
+    request = {
+        "model": STORY_MODEL,
+        "params": canonical,
+        "selected_tale_text": selected_tale_text.strip() if selected_tale_text else None
+    }
+    return json.dumps(request, sort_keys=True, separators=(',', ':'), ensure_ascii=False)
 
-        # Get column names
-        column_names = [description[0] for description in cursor.description]
+def get_cache_key(data, selected_tale_text=None):
+    return hashlib.sha256(canonicalize_request(data, selected_tale_text).encode('utf-8')).hexdigest()
+
+def _bump_cache_stat(cursor, name, amount=1):
+    cursor.execute('UPDATE story_cache_stats SET value = value + ? WHERE name = ?', (amount, name))
+
+def get_cached_story(data, selected_tale_text=None):
+    cache_key = get_cache_key(data, selected_tale_text)
+    now = time.time()
+    with db_connection(CACHE_DB_NAME) as conn:
+        cursor = conn.cursor()
         
-        result = []
-        for pro in professionals:
-            pro_dict = {}
-            for i, col in enumerate(column_names):
-                if i < len(pro):
-                    pro_dict[col] = pro[i]
-                else:
-                    pro_dict[col] = None  # Set to None if the column doesn't exist
-            result.append(pro_dict)
+        try:
+            cursor.execute('SELECT response, created_at FROM story_cache WHERE cache_key = ?', (cache_key,))
+            row = cursor.fetchone()
+            
+            if row and now - row[1] <= CACHE_TTL_SECONDS:
+                cursor.execute('UPDATE story_cache SET last_accessed = ?, hits = hits + 1 WHERE cache_key = ?', (now, cache_key))
+                _bump_cache_stat(cursor, 'hits')
+                conn.commit()
+                increment_counter('storyteller_response_cache_total', result='hit')
+                return row[0]
+            
+            if row:
+                cursor.execute('DELETE FROM story_cache WHERE cache_key = ?', (cache_key,))
+                _bump_cache_stat(cursor, 'evictions')
+            _bump_cache_stat(cursor, 'misses')
+            conn.commit()
+            increment_counter('storyteller_response_cache_total', result='miss')
+            return None
+        except sqlite3.Error as e:
+            logging.error(f"Cache error while reading story: {str(e)}")
+            return None
+
+def store_cached_story(data, selected_tale_text, story):
+    now = time.time()
+    with db_connection(CACHE_DB_NAME) as conn:
+        cursor = conn.cursor()
         
-        return result
-    except sqlite3.Error as e:
-        logging.error(f"Database error in get_professionals: {str(e)}")
-        return []
-    finally:
-        conn.close()
+        try:
+            cursor.execute('''
+                INSERT OR REPLACE INTO story_cache (cache_key, request, response, created_at, last_accessed, hits)
+                VALUES (?, ?, ?, ?, ?, 0)
+            ''', (get_cache_key(data, selected_tale_text), canonicalize_request(data, selected_tale_text), story, now, now))
+            
+            # Drop expired entries, then the least recently used ones beyond the size bound
+            cursor.execute('DELETE FROM story_cache WHERE created_at < ?', (now - CACHE_TTL_SECONDS,))
+            evicted = cursor.rowcount
+            cursor.execute('''
+                DELETE FROM story_cache WHERE cache_key IN (
+                    SELECT cache_key FROM story_cache ORDER BY last_accessed DESC LIMIT -1 OFFSET ?
+                )
+            ''', (CACHE_MAX_ENTRIES,))
+            evicted += cursor.rowcount
+            if evicted:
+                _bump_cache_stat(cursor, 'evictions', evicted)
+            conn.commit()
+        except sqlite3.Error as e:
+            logging.error(f"Cache error while storing story: {str(e)}")
+            conn.rollback()
 
-def add_booking(user_id, professional_id, slot):
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    
-    try:
-        cursor.execute('''
-            INSERT INTO bookings (user_id, professional_id, slot)
-            VALUES (?, ?, ?)
-        ''', (user_id, professional_id, slot))
-        conn.commit()
-        booking_id = cursor.lastrowid
-        logging.info(f"Booking added successfully. ID: {booking_id}")
-        return booking_id
-    except sqlite3.Error as e:
-        logging.error(f"Database error while adding booking: {str(e)}")
-        conn.rollback()
-        raise Exception(f"Error adding booking: {str(e)}")
-    finally:
-        conn.close()
+def get_cache_stats():
+    with db_connection(CACHE_DB_NAME) as conn:
+        cursor = conn.cursor()
+        
+        try:
+            cursor.execute('SELECT name, value FROM story_cache_stats')
+            stats = dict(cursor.fetchall())
+            cursor.execute('SELECT COUNT(*) FROM story_cache')
+            stats['entries'] = cursor.fetchone()[0]
+            return stats
+        except sqlite3.Error as e:
+            logging.error(f"Cache error while reading stats: {str(e)}")
+            return {}
 
-def add_user(user_data):
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
+def generate_story_stream_cached(data, selected_tale_text=None, bypass_cache=False, user_id=None):
+    if not bypass_cache:
+        story = get_cached_story(data, selected_tale_text)
+        if story is not None:
+            yield story
+            return
     
-    hashed_password = generate_password_hash(user_data['password'])
+    chunks = []
+    answer = {}
+    for chunk in generate_story_stream(data, selected_tale_text, user_id=user_id, answer=answer):
+        chunks.append(chunk)
+        yield chunk
+    # Cache keys name STORY_MODEL, so a story the fallback model wrote isn't stored under them
+    if chunks and answer.get('model') == STORY_MODEL:
+        store_cached_story(data, selected_tale_text, "".join(chunks))
+
+# Background generation jobs
+def enqueue_generation_job(user_id, data, selected_tale_text=None, bypass_cache=False):
+    now = time.time()
+    with db_connection() as conn:
+        cursor = conn.cursor()
+        
+        try:
+            # Finished jobs are only kept long enough to be picked up by their session
+            cursor.execute('DELETE FROM generation_jobs WHERE attached = 1 AND finished_at < ?', (now - JOB_RETENTION_SECONDS,))
+            cursor.execute('''
+                INSERT INTO generation_jobs (user_id, parameters, selected_tale_text, bypass_cache, created_at)
+                VALUES (?, ?, ?, ?, ?)
+            ''', (user_id, json.dumps(data), selected_tale_text, int(bool(bypass_cache)), now))
+            conn.commit()
+            job_id = cursor.lastrowid
+        except sqlite3.Error as e:
+            logging.error(f"Database error while enqueuing generation job: {str(e)}")
+            conn.rollback()
+            raise Exception(f"Error queuing story generation: {str(e)}")
     
-    try:
+    workers = get_job_workers()
+    with workers['condition']:
+        workers['condition'].notify()
+    update_queue_depth()
+    return job_id
+
+def claim_next_job():
+    now = time.time()
+    with db_connection() as conn:
+        cursor = conn.cursor()
+        
+        # A single UPDATE is atomic, so two workers can never claim the same job. Running jobs
+        # whose heartbeat stopped (e.g. the process died) are picked up again.
         cursor.execute('''
-            INSERT INTO users (first_name, last_name, email, profession, username, phone, password)
-            VALUES (?, ?, ?, ?, ?, ?, ?)
-        ''', (user_data['first_name'], user_data['last_name'], user_data['email'], user_data['profession'],
-              user_data['username'], user_data['phone'], hashed_password))
+            UPDATE generation_jobs
+            SET status = 'running', started_at = ?, heartbeat_at = ?
+            WHERE id = (
+                SELECT id FROM generation_jobs
+                WHERE status = 'queued' OR (status = 'running' AND heartbeat_at < ?)
+                ORDER BY created_at
+                LIMIT 1
+            )
+            RETURNING id, user_id, parameters, selected_tale_text, bypass_cache, created_at
+        ''', (now, now, now - JOB_LEASE_SECONDS))
+        job = cursor.fetchone()
         conn.commit()
-        user_id = cursor.lastrowid
-    except sqlite3.IntegrityError as e:
-        logging.error(f"Database integrity error: {str(e)}")
-        raise Exception("Username or email already exists")
-    finally:
-        conn.close()
     
-    return user_id
+    if job is None:
+        return None
+    return {
+        'id': job[0],
+        'user_id': job[1],
+        'parameters': json.loads(job[2]),
+        'selected_tale_text': job[3],
+        'bypass_cache': bool(job[4]),
+        'created_at': job[5]
+    }
 
-def get_user(username, password):
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    
-    cursor.execute('SELECT * FROM users WHERE username = ?', (username,))
-    user = cursor.fetchone()
-    
-    conn.close()
-    
-    if user and check_password_hash(user[7], password):
-        return {
-            'id': user[0],
-            'first_name': user[1],
-            'last_name': user[2],
-            'email': user[3],
-            'profession': user[4],
-            'username': user[5],
-            'phone': user[6]
-        }
-    return None
+def update_job_progress(job_id, partial):
+    with db_connection() as conn:
+        conn.execute('UPDATE generation_jobs SET partial = ?, heartbeat_at = ? WHERE id = ?', (partial, time.time(), job_id))
+        conn.commit()
 
-def save_story(user_id, title, content, parameters):
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
+def touch_job(job_id):
+    with db_connection() as conn:
+        conn.execute("UPDATE generation_jobs SET heartbeat_at = ? WHERE id = ? AND status = 'running'", (time.time(), job_id))
+        conn.commit()
+
+def _job_heartbeat(job_id, stopped):
+    # Keeps the lease while the job is silent: waiting for an LLM turn, retrying, or before the
+    # first chunk. Four beats per lease so one slow write doesn't let another worker claim the job
+    while not stopped.wait(JOB_LEASE_SECONDS / 4):
+        try:
+            touch_job(job_id)
+        except Exception as e:
+            logging.warning(f"Could not renew the lease of generation job {job_id}: {str(e)}")
+
+def finish_job(job_id, result=None, error=None):
+    with db_connection() as conn:
+        conn.execute('''
+            UPDATE generation_jobs
+            SET status = ?, result = ?, error = ?, partial = NULL, finished_at = ?
+            WHERE id = ?
+        ''', ('failed' if error else 'done', result, error, time.time(), job_id))
+        conn.commit()
+
+@instrument_query
+def get_job(job_id, user_id):
+    with db_connection() as conn:
+        cursor = conn.cursor()
+        
+        cursor.execute('''
+            SELECT id, status, parameters, partial, result, error, created_at, started_at, finished_at
+            FROM generation_jobs WHERE id = ? AND user_id = ?
+        ''', (job_id, user_id))
+        job = cursor.fetchone()
+        
+        position = None
+        if job and job[1] == 'queued':
+            cursor.execute("SELECT COUNT(*) FROM generation_jobs WHERE status = 'queued' AND created_at <= ?", (job[6],))
+            position = cursor.fetchone()[0]
     
-    try:
+    if job is None:
+        return None
+    return {
+        'id': job[0],
+        'status': job[1],
+        'parameters': json.loads(job[2]),
+        'partial': job[3],
+        'result': job[4],
+        'error': job[5],
+        'created_at': job[6],
+        'started_at': job[7],
+        'finished_at': job[8],
+        'queue_position': position
+    }
+
+@instrument_query
+def get_unattached_job_id(user_id):
+    # Lets a reconnecting session pick up the result of a generation it started earlier
+    with db_connection() as conn:
+        cursor = conn.cursor()
         cursor.execute('''
-            INSERT INTO stories (user_id, title, content, parameters)
-            VALUES (?, ?, ?, ?)
-        ''', (user_id, title, content, parameters))
+            SELECT id FROM generation_jobs
+            WHERE user_id = ? AND attached = 0
+            ORDER BY created_at DESC
+            LIMIT 1
+        ''', (user_id,))
+        job = cursor.fetchone()
+    return job[0] if job else None
+
+def mark_job_attached(job_id):
+    with db_connection() as conn:
+        conn.execute('UPDATE generation_jobs SET attached = 1 WHERE id = ?', (job_id,))
         conn.commit()
-        story_id = cursor.lastrowid
-        logging.info(f"Story saved successfully. ID: {story_id}")
-        return story_id
-    except sqlite3.Error as e:
-        logging.error(f"Database error while saving story: {str(e)}")
-        conn.rollback()
-        raise Exception(f"Error saving story: {str(e)}")
-    finally:
-        conn.close()
 
-def delete_story(story_id):
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
+def update_queue_depth():
+    with db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT COUNT(*) FROM generation_jobs WHERE status = 'queued'")
+        set_gauge('storyteller_job_queue_depth', cursor.fetchone()[0])
+
+def run_generation_job(job):
+    workers = get_job_workers()
+    started = time.time()
+    observe('storyteller_job_wait_seconds', started - job['created_at'])
+    with workers['condition']:
+        workers['busy'] += 1
+        set_gauge('storyteller_job_workers_busy', workers['busy'])
+        # Sessions in this process read the text from here; the database copy is for reconnects
+        workers['live'][job['id']] = {'user_id': job['user_id'], 'chunks': []}
+    stopped = threading.Event()
+    threading.Thread(target=_job_heartbeat, args=(job['id'], stopped), daemon=True, name=f"job-heartbeat-{job['id']}").start()
     
     try:
-        cursor.execute('DELETE FROM stories WHERE id = ?', (story_id,))
-        conn.commit()
-        logging.info(f"Story deleted successfully. ID: {story_id}")
-    except sqlite3.Error as e:
-        logging.error(f"Database error while deleting story: {str(e)}")
-        conn.rollback()
-        raise Exception(f"Error deleting story: {str(e)}")
+        chunks = workers['live'][job['id']]['chunks']
+        last_update = time.monotonic()
+        for chunk in generate_story_stream_cached(job['parameters'], job['selected_tale_text'], job['bypass_cache'], job['user_id']):
+            chunks.append(chunk)
+            # Batch progress writes; only pages in other processes or after a reconnect read them
+            if time.monotonic() - last_update >= JOB_PROGRESS_INTERVAL_SECONDS:
+                update_job_progress(job['id'], "".join(chunks))
+                last_update = time.monotonic()
+        finish_job(job['id'], result="".join(chunks))
+    except Exception as e:
+        logging.error(f"Generation job {job['id']} failed: {str(e)}")
+        finish_job(job['id'], error=str(e))
     finally:
-        conn.close()
+        stopped.set()
+        observe('storyteller_job_run_seconds', time.time() - started)
+        with workers['condition']:
+            workers['busy'] -= 1
+            workers['live'].pop(job['id'], None)
+            set_gauge('storyteller_job_workers_busy', workers['busy'])
 
-def get_stories(user_id):
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    
-    cursor.execute('SELECT id, title, content, parameters, created_at FROM stories WHERE user_id = ? ORDER BY created_at DESC', (user_id,))
-    stories = cursor.fetchall()
+def _job_worker_loop(workers):
+    while True:
+        try:
+            job = claim_next_job()
+        except Exception as e:
+            logging.error(f"Generation worker could not claim a job: {str(e)}")
+            job = None
+        
+        if job is None:
+            # Woken up by enqueue_generation_job; the timeout also picks up jobs queued by other processes
+            with workers['condition']:
+                workers['condition'].wait(timeout=JOB_POLL_SECONDS)
+            continue
+        update_queue_depth()
+        run_generation_job(job)
+
+@st.cache_resource
+def get_job_workers():
+    workers = {'condition': threading.Condition(), 'busy': 0, 'size': JOB_WORKERS, 'threads': [], 'live': {}}
+    for i in range(JOB_WORKERS):
+        thread = threading.Thread(target=_job_worker_loop, args=(workers,), daemon=True, name=f"generation-worker-{i}")
+        thread.start()
+        workers['threads'].append(thread)
+    set_gauge('storyteller_job_workers', JOB_WORKERS)
+    return workers
+
+@instrument_query
+def get_job_queue_stats():
+    workers = get_job_workers()
+    with db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('SELECT status, COUNT(*) FROM generation_jobs GROUP BY status')
+        counts = dict(cursor.fetchall())
+        cursor.execute("SELECT AVG(started_at - created_at) FROM generation_jobs WHERE started_at IS NOT NULL AND created_at > ?", (time.time() - 3600,))
+        average_wait = cursor.fetchone()[0]
+    return {
+        'queued': counts.get('queued', 0),
+        'running': counts.get('running', 0),
+        'done': counts.get('done', 0),
+        'failed': counts.get('failed', 0),
+        'average_wait_seconds_last_hour': average_wait,
+        'workers': workers['size'],
+        'workers_busy': workers['busy'],
+        'utilization': workers['busy'] / workers['size'] if workers['size'] else 0.0
+    }
+
+# Export functions
+def split_paragraphs(content):
+    return [paragraph.strip() for paragraph in re.split(r'\n\s*\n', content) if paragraph.strip()]
+
+def create_download_file(content, format):
+    with timed('storyteller_export_build_seconds', format=format):
+        data = _build_download_file(content, format)
+    observe('storyteller_export_bytes', len(data), format=format)
+    return data
+
+def _build_download_file(content, format):
+    if format == 'txt':
+        return content.encode()
     
-    conn.close()
+    from docx import Document
+    from reportlab.lib.pagesizes import letter
+    from reportlab.lib.styles import getSampleStyleSheet
+    from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer
     
-    return [
-        {
-            'id': story[0],
-            'title': story[1],
-            'content': story[2],
-            'parameters': story[3],
-            'created_at': story[4]
-        } for story in stories
-    ]
+    # Spill to disk past EXPORT_SPOOL_MAX_BYTES instead of growing an in-memory buffer
+    with tempfile.SpooledTemporaryFile(max_size=EXPORT_SPOOL_MAX_BYTES) as file_stream:
+        if format == 'docx':
+            doc = Document()
+            for paragraph in split_paragraphs(content):
+                doc.add_paragraph(paragraph)
+            doc.save(file_stream)
+        elif format == 'pdf':
+            styles = getSampleStyleSheet()
+            pdf = SimpleDocTemplate(file_stream, pagesize=letter, title="Story")
+            flowables = []
+            for paragraph in split_paragraphs(content):
+                flowables.append(Paragraph(escape(paragraph).replace('\n', '<br/>'), styles['BodyText']))
+                flowables.append(Spacer(1, 6))
+            pdf.build(flowables)
+        else:
+            raise ValueError(f"Unsupported download format: {format}")
+        file_stream.seek(0)
+        return file_stream.read()
 
-def get_well_known_tales():
-    try:
-        df = pd.read_excel('db/well_known_tales.xlsx')
-        return df[['Story Title', 'Story Text']].to_dict('records')
-    except FileNotFoundError:
-        logging.error("well_known_tales.xlsx not found in the 'db' directory")
-        return []
-    except Exception as e:
-        logging.error(f"Error reading well-known tales: {str(e)}")
-        return []
+@st.cache_resource
+def get_export_cache():
+    return {'entries': OrderedDict(), 'size': 0, 'lock': threading.Lock()}
 
-def generate_story(data, selected_tale_text=None):
-    prompt = f"Generate a {data['length']} story with the following parameters:\n"
-    prompt += f"Story Origin: {data['story_origin']}\n"
-    prompt += f"Use Case: {data['use_case']}\n"
-    prompt += f"Time Frame: {data['time_frame']}\n"
-    if data['age']:
-        prompt += f"Age: {data['age']}\n"
-    prompt += f"Focus: {', '.join(data['focus'])}\n"
-    prompt += f"Story Type: {data['story_type']}\n"
-    prompt += f"Narrative Structure: {data['narrative_structure']}\n"
-    prompt += f"Simplified Structure: {data['simplified_structure']}\n"
-    prompt += f"Creative Enhancements: {', '.join(data['creative_enhancements'])}\n"
+def get_download_file(content, format):
+    cache = get_export_cache()
+    cache_key = (hashlib.sha256(content.encode('utf-8')).hexdigest(), format)
     
-    if selected_tale_text:
-        prompt += f"Based on the following well-known tale, create a similar story:\n{selected_tale_text}\n"
+    with cache['lock']:
+        data = cache['entries'].get(cache_key)
+        if data is not None:
+            cache['entries'].move_to_end(cache_key)
+            return data
     
-    if data['user_story_start']:
-        prompt += f"Start with the following user-provided story beginning:\n{data['user_story_start']}\n"
+    data = create_download_file(content, format)
     
-    try:
-        response = groq_client.chat.completions.create(
-            messages=[
-                {"role": "system", "content": "You are an AI storytelling assistant."},
-                {"role": "user", "content": prompt}
-            ],
-            model="llama-3.1-70b-versatile",
-        )
-        story = response.choices[0].message.content
-        return story
-    except Exception as e:
-        logging.error(f"Story generation error: {str(e)}")
-        raise Exception("Error generating story")
+    with cache['lock']:
+        if cache_key not in cache['entries']:
+            cache['entries'][cache_key] = data
+            cache['size'] += len(data)
+        # Evict least recently used exports until the cache fits its byte budget
+        while cache['size'] > EXPORT_CACHE_MAX_BYTES and len(cache['entries']) > 1:
+            _, evicted = cache['entries'].popitem(last=False)
+            cache['size'] -= len(evicted)
+    return data
 
-def create_download_file(content, format):
-    if format == 'txt':
-        return content.encode()
-    elif format == 'docx':
-        doc = Document()
-        doc.add_paragraph(content)
-        file_stream = io.BytesIO()
-        doc.save(file_stream)
-        file_stream.seek(0)
-        return file_stream
-    elif format == 'pdf':
-        file_stream = io.BytesIO()
-        p = canvas.Canvas(file_stream)
-        p.drawString(100, 750, content)
-        p.showPage()
-        p.save()
-        file_stream.seek(0)
-        return file_stream
+# Per-session read cache
+@st.cache_resource
+def get_data_versions():
+    # Process-wide, so a write in one session (or a worker thread) invalidates every session's copy
+    return {'versions': {}, 'lock': threading.Lock()}
+
+def bump_data_version(scope, owner_id=None):
+    state = get_data_versions()
+    with state['lock']:
+        state['versions'][(scope, owner_id)] = state['versions'].get((scope, owner_id), 0) + 1
+
+def cached_read(scope, owner_id, loader, *args):
+    # Reruns read from st.session_state until save_story, delete_story, add_booking etc. bump the
+    # version of the (scope, owner_id) the data belongs to, e.g. ('stories', user id)
+    version = get_data_versions()['versions'].get((scope, owner_id), 0)
+    cache = st.session_state.setdefault('data_cache', {})
+    bucket = cache.get((scope, owner_id))
+    if bucket is None or bucket['version'] != version or time.time() - bucket['loaded_at'] > SESSION_CACHE_TTL_SECONDS:
+        bucket = cache[(scope, owner_id)] = {'version': version, 'loaded_at': time.time(), 'entries': OrderedDict()}
+    
+    key = (loader.__name__,) + args
+    if key in bucket['entries']:
+        bucket['entries'].move_to_end(key)
+        increment_counter('storyteller_session_cache_total', scope=scope, result='hit')
+        return bucket['entries'][key]
+    increment_counter('storyteller_session_cache_total', scope=scope, result='miss')
+    value = bucket['entries'][key] = loader(*args)
+    if len(bucket['entries']) > SESSION_CACHE_MAX_ENTRIES:
+        bucket['entries'].popitem(last=False)
+    return value
 
 def main():
+    start = time.perf_counter()
+    queries = queries_in_thread()
+    if METRICS_PORT:
+        start_metrics_server(METRICS_PORT)
+    # Workers start with the server, so jobs left queued or running by a previous process are
+    # picked up even if nobody enqueues a new one
+    get_job_workers()
+    try:
+        render_app()
+    finally:
+        page = st.session_state.get('page', 'main') if st.session_state.get('user_id') else 'login'
+        observe('storyteller_rerun_seconds', time.perf_counter() - start, page=page)
+        observe('storyteller_run_queries', queries_in_thread() - queries, run=page)
+        write_metrics_file()
+
+def render_app():
     st.set_page_config(page_title="AI-Powered Storytelling Assistant", layout="wide")
 
     st.title("AI-Powered Storytelling Assistant")
@@ -322,6 +3549,9 @@ def main():
     if 'page' not in st.session_state:
         st.session_state.page = 'main'
 
+    if st.session_state.user_id is None:
+        restore_session()
+    write_session_cookie()
     if st.session_state.user_id is None:
         show_login_signup()
     else:
@@ -332,6 +3562,133 @@ def main():
             show_professionals_page()
         elif st.session_state.page == 'about':
             show_about_page()
+        elif st.session_state.page == 'usage':
+            show_usage_page()
+        elif st.session_state.page == 'metrics' and is_admin():
+            show_metrics_page()
+
+def start_session(user, token):
+    st.session_state.user_id = user['id']
+    st.session_state.username = user['username']
+    st.session_state.session_token = token
+
+def restore_session():
+    # The token is kept in a cookie so a browser refresh, which starts a new Streamlit session,
+    # logs the user back in without running the password KDF again. st.context.cookies is read
+    # when the session connects, so it is only checked once per session
+    if st.session_state.get('session_cookie_checked'):
+        return
+    st.session_state.session_cookie_checked = True
+    token = st.context.cookies.get(SESSION_COOKIE_NAME)
+    if not token:
+        return
+    user = get_session_user(token)
+    if user:
+        start_session(user, token)
+    else:
+        st.session_state.pending_session_cookie = None
+
+def write_session_cookie():
+    # Streamlit can read cookies but not set them, so the cookie is written by a script in a
+    # contentless iframe, which shares the app's origin. A None token clears it
+    if 'pending_session_cookie' not in st.session_state:
+        return
+    token = st.session_state.pop('pending_session_cookie')
+    st.iframe(f'''
+        <script>
+        const secure = window.parent.location.protocol === 'https:' ? '; Secure' : '';
+        window.parent.document.cookie = {json.dumps(SESSION_COOKIE_NAME)} + '=' + {json.dumps(token or '')}
+            + '; Path=/; Max-Age={SESSION_TTL_SECONDS if token else 0}; SameSite=Strict' + secure;
+        </script>
+    ''', height='content')
+
+def is_admin():
+    return st.session_state.get('username') in ADMIN_USERNAMES
+
+def show_metrics_page():
+    import pandas as pd
+    
+    st.title("Metrics")
+    st.caption("Aggregated since this server process started. Latencies are in seconds.")
+    
+    summary, counters = get_metrics_summary()
+    if summary:
+        st.dataframe(pd.DataFrame(summary), hide_index=True, width='stretch')
+    else:
+        st.write("No measurements yet.")
+    
+    if counters:
+        st.subheader("Counters and gauges")
+        st.dataframe(pd.DataFrame([
+            {'metric': name, 'labels': ', '.join(f"{key}={value}" for key, value in labels), 'value': value_total}
+            for (name, labels), value_total in sorted(counters.items())
+        ]), hide_index=True, width='stretch')
+    
+    st.subheader("Generation queue")
+    job_stats = get_job_queue_stats()
+    col1, col2, col3, col4 = st.columns(4)
+    col1.metric("Queued", job_stats['queued'])
+    col2.metric("Running", job_stats['running'])
+    col3.metric("Worker utilization", f"{job_stats['utilization']:.0%}", help=f"{job_stats['workers_busy']} of {job_stats['workers']} workers busy")
+    average_wait = job_stats['average_wait_seconds_last_hour']
+    col4.metric("Average wait (last hour)", f"{average_wait:.1f}s" if average_wait is not None else "-")
+    
+    st.subheader("LLM scheduler")
+    scheduler = get_llm_scheduler_stats()
+    col1, col2, col3 = st.columns(3)
+    col1.metric("Requests in flight", scheduler['running'], help=f"At most {LLM_MAX_CONCURRENCY} at a time")
+    col2.metric("Waiting (interactive)", scheduler['waiting']['interactive'])
+    col3.metric("Waiting (batch)", scheduler['waiting']['batch'])
+    usage_by_user = get_llm_usage_by_user()
+    if usage_by_user:
+        st.caption("Token usage by user, last 7 days")
+        st.dataframe(pd.DataFrame(usage_by_user), hide_index=True, width='stretch')
+    
+    st.subheader("Response cache")
+    cache_stats = get_cache_stats()
+    lookups = cache_stats.get('hits', 0) + cache_stats.get('misses', 0)
+    col1, col2, col3, col4 = st.columns(4)
+    col1.metric("Hits", cache_stats.get('hits', 0), help="Since the cache database was created, across processes")
+    col2.metric("Misses", cache_stats.get('misses', 0))
+    col3.metric("Hit rate", f"{cache_stats.get('hits', 0) / lookups:.0%}" if lookups else "-")
+    col4.metric("Entries", cache_stats.get('entries', 0), help=f"At most {CACHE_MAX_ENTRIES}")
+    
+    st.subheader("Saved stories")
+    story_counts = count_stories(group_by=('use_case', 'narrative_structure'))
+    if story_counts:
+        st.dataframe(pd.DataFrame(story_counts), hide_index=True, width='stretch')
+    else:
+        st.write("No saved stories yet.")
+    
+    with st.expander("Prometheus text"):
+        st.code(render_prometheus_metrics(), language="text")
+
+def show_usage_page():
+    import pandas as pd
+    
+    st.title("Your Usage")
+    user_id = st.session_state.user_id
+    usage = cached_read('usage', user_id, get_llm_usage, user_id)
+    today = datetime.now().strftime('%Y-%m-%d')
+    
+    col1, col2, col3 = st.columns(3)
+    col1.metric("Tokens today", f"{sum(row['prompt_tokens'] + row['completion_tokens'] for row in usage if row['day'] == today):,}")
+    col2.metric(f"Tokens, last {USAGE_HISTORY_DAYS} days", f"{sum(row['prompt_tokens'] + row['completion_tokens'] for row in usage):,}")
+    allowance = get_llm_allowance(user_id)
+    if allowance:
+        col3.metric("Available now", f"{allowance['available']:,}",
+                    help=f"Your allowance refills at {allowance['per_minute']:,} tokens per minute, up to {allowance['capacity']:,}")
+    
+    if not usage:
+        st.write("You haven't generated any stories yet.")
+        return
+    frame = pd.DataFrame(usage)
+    frame['tokens'] = frame['prompt_tokens'] + frame['completion_tokens']
+    st.subheader("Tokens per day")
+    st.bar_chart(frame.pivot_table(index='day', columns='kind', values='tokens', aggfunc='sum', fill_value=0))
+    st.subheader("By model")
+    st.dataframe(frame.groupby(['kind', 'model'], as_index=False)[['requests', 'prompt_tokens', 'completion_tokens']].sum(),
+                 hide_index=True, width='stretch')
 
 def show_about_page():
     st.title("About AI-Powered Storytelling Assistant")
@@ -363,6 +3720,42 @@ def show_about_page():
         st.session_state.page = 'main'
         st.rerun()
 
+def open_saved_story(story_id):
+    # The story body is only fetched when the story is opened
+    story = get_story(story_id, st.session_state.user_id)
+    if story:
+        st.session_state.current_story = story['content']
+        st.session_state.current_story_id = story['id']
+        st.session_state.current_story_title = story['title']
+        st.session_state.current_story_params = parse_story_parameters(story['parameters'])
+        # The editor widget keeps its own state; drop it so it shows the opened story
+        st.session_state.pop('main_edit_story', None)
+
+def show_story_history(story_id):
+    user_id = st.session_state.user_id
+    revisions = cached_read('stories', user_id, get_story_revisions, story_id, user_id)
+    if len(revisions) < 2:
+        return
+    
+    st.title("History")
+    st.caption(st.session_state.get('current_story_title', ''))
+    labels = {
+        revision['revision']: f"Revision {revision['revision']}{' (current)' if revision['kind'] == 'head' else ''} - {revision['created_at']}"
+        for revision in revisions
+    }
+    selected = st.selectbox("Revision", list(labels), format_func=labels.get, key=f"history_revision_{story_id}")
+    restored = cached_read('stories', user_id, get_story_revision, story_id, user_id, selected)
+    if restored is None:
+        return
+    st.text_area("Preview", value=restored[0], height=150, disabled=True, key=f"history_preview_{story_id}_{selected}")
+    if selected != revisions[0]['revision'] and st.button(f"Restore revision {selected}", key=f"history_restore_{story_id}"):
+        try:
+            restore_story_revision(story_id, user_id, selected)
+            open_saved_story(story_id)
+            st.rerun()
+        except Exception as e:
+            st.error(str(e))
+
 def show_sidebar():
     with st.sidebar:
         st.title("Menu")
@@ -375,25 +3768,95 @@ def show_sidebar():
         if st.button("About", key="sidebar_about"):
             st.session_state.page = 'about'
             st.rerun()
+        if st.button("Usage", key="sidebar_usage"):
+            st.session_state.page = 'usage'
+            st.rerun()
+        if is_admin() and st.button("Metrics", key="sidebar_metrics"):
+            st.session_state.page = 'metrics'
+            st.rerun()
         
-        st.title("Saved Stories")
-        saved_stories = get_stories(st.session_state.user_id)
-        for i, story in enumerate(saved_stories):
-            col1, col2= st.columns([3, 1])
-            with col1:
-                if st.button(story['title'], key=f"story_{i}"):
-                    st.session_state.current_story = story['content']
-                    st.session_state.current_story_id = story['id']
-                    st.session_state.current_story_title = story['title']
-            with col2:
-                if st.button("🗑️", key=f"delete_{i}", help="Delete story"):
-                    delete_story(story['id'])
-                    st.rerun()
+        show_sidebar_search()
+        show_saved_stories()
         
         st.title("User Actions")
         if st.button("Logout", key="sidebar_logout"):
+            if st.session_state.get('session_token'):
+                delete_session(st.session_state.session_token)
+            st.session_state.pending_session_cookie = None
             st.session_state.user_id = None
+            st.session_state.session_token = None
+            st.session_state.pop('data_cache', None)
+            st.rerun()
+
+# The sidebar sections are fragments: typing a search or browsing the history only reruns that
+# section. Anything that changes the main page (opening a story, deleting one) reruns the app
+@st.fragment
+@instrument_fragment
+def show_sidebar_search():
+    user_id = st.session_state.user_id
+    st.title("Search")
+    search_query = st.text_input("Search stories and tales", key="sidebar_search")
+    if not search_query:
+        return
+    story_results = cached_read('stories', user_id, search_stories, user_id, search_query)
+    tale_results = cached_read('tales', None, search_tales, search_query)
+    if not story_results and not tale_results:
+        st.caption("No matches")
+    for result in story_results:
+        if st.button(result['title'], key=f"search_story_{result['id']}"):
+            open_saved_story(result['id'])
             st.rerun()
+        st.caption(result['snippet'])
+    for result in tale_results:
+        if st.button(f"Tale: {result['title']}", key=f"search_tale_{result['position']}"):
+            st.session_state.page = 'main'
+            st.session_state.main_story_origin = "Well-known Tale"
+            st.session_state.main_selected_tale = result['title']
+            st.rerun()
+        st.caption(result['snippet'])
+
+def load_more_stories():
+    st.session_state.story_pages += 1
+
+@st.fragment
+@instrument_fragment
+def show_saved_stories():
+    user_id = st.session_state.user_id
+    st.title("Saved Stories")
+    if 'story_pages' not in st.session_state:
+        st.session_state.story_pages = 1
+    
+    saved_stories = []
+    after = None
+    has_more = False
+    for _ in range(st.session_state.story_pages):
+        page = cached_read('stories', user_id, list_stories, user_id, STORY_PAGE_SIZE + 1, after)
+        has_more = len(page) > STORY_PAGE_SIZE
+        page = page[:STORY_PAGE_SIZE]
+        saved_stories.extend(page)
+        if not has_more:
+            break
+        after = (page[-1]['created_at'], page[-1]['id'])
+    
+    for story in saved_stories:
+        col1, col2= st.columns([3, 1])
+        with col1:
+            if st.button(story['title'], key=f"story_{story['id']}"):
+                open_saved_story(story['id'])
+                st.rerun()
+        with col2:
+            if st.button("🗑️", key=f"delete_{story['id']}", help="Delete story"):
+                delete_story(story['id'])
+                if st.session_state.get('current_story_id') == story['id']:
+                    st.session_state.pop('current_story_id', None)
+                st.rerun()
+    
+    if has_more:
+        # A callback runs before the fragment reruns, so the next page shows without a full rerun
+        st.button("Load more", key="sidebar_load_more", on_click=load_more_stories)
+    
+    if st.session_state.get('current_story_id'):
+        show_story_history(st.session_state.current_story_id)
 
 def show_login_signup():
     tab1, tab2 = st.tabs(["Login", "Sign Up"])
@@ -403,13 +3866,19 @@ def show_login_signup():
         username = st.text_input("Username", key="login_username")
         password = st.text_input("Password", type="password", key="login_password")
         if st.button("Login"):
-            user = get_user(username, password)
-            if user:
-                st.session_state.user_id = user['id']
-                st.success("Logged in successfully!")
-                st.rerun()
+            try:
+                user = get_user(username, password)
+            except Exception as e:
+                st.error(str(e))
             else:
-                st.error("Invalid credentials")
+                if user:
+                    token = create_session(user['id'])
+                    start_session(user, token)
+                    st.session_state.pending_session_cookie = token
+                    st.success("Logged in successfully!")
+                    st.rerun()
+                else:
+                    st.error("Invalid credentials")
 
     with tab2:
         st.header("Sign Up")
@@ -435,7 +3904,79 @@ def show_login_signup():
             except Exception as e:
                 st.error(str(e))
 
+@st.fragment(run_every=JOB_PAGE_POLL_SECONDS)
+def show_generation_job():
+    job_id = st.session_state.get('current_job_id')
+    if not job_id:
+        return
+    live = get_job_workers()['live'].get(job_id)
+    if live is not None and live['user_id'] == st.session_state.user_id:
+        st.caption("Generating your story...")
+        st.markdown("".join(live['chunks']))
+        return
+    job = get_job(job_id, st.session_state.user_id)
+    if job is None:
+        st.session_state.current_job_id = None
+        return
+    
+    if job['status'] == 'queued':
+        st.info(f"Waiting for a free worker (position {job['queue_position']} in the queue)...")
+    elif job['status'] == 'running':
+        st.caption("Generating your story...")
+        st.markdown(job['partial'] or "")
+    else:
+        mark_job_attached(job_id)
+        st.session_state.current_job_id = None
+        if job['status'] == 'failed':
+            st.error(job['error'])
+            return
+        user_story_start = job['parameters'].get('user_story_start')
+        if user_story_start:
+            st.session_state.current_story = user_story_start + "\n\n" + job['result']
+        else:
+            st.session_state.current_story = job['result']
+        st.session_state.current_story_title = f"Story_{datetime.now().strftime('%Y%m%d_%H%M%S')}"
+        st.session_state.current_story_params = job['parameters']
+        st.session_state.pop('current_story_id', None)
+        st.session_state.pop('main_edit_story', None)
+        st.rerun()
+
 def show_main_page():
+    show_story_generator()
+    
+    if 'current_job_id' not in st.session_state:
+        st.session_state.current_job_id = get_unattached_job_id(st.session_state.user_id)
+    if st.session_state.current_job_id:
+        show_generation_job()
+
+    if st.session_state.get('story_drafts'):
+        st.subheader("Compare Drafts")
+        drafts = st.session_state.story_drafts
+        for i, (column, draft) in enumerate(zip(st.columns(len(drafts)), drafts)):
+            with column:
+                st.caption(draft['label'])
+                st.markdown(draft['story'])
+                if st.button("Use this draft", key=f"use_draft_{i}"):
+                    user_story_start = draft['params'].get('user_story_start')
+                    if user_story_start:
+                        st.session_state.current_story = user_story_start + "\n\n" + draft['story']
+                    else:
+                        st.session_state.current_story = draft['story']
+                    st.session_state.current_story_title = f"Story_{datetime.now().strftime('%Y%m%d_%H%M%S')}"
+                    st.session_state.current_story_params = draft['params']
+                    st.session_state.pop('current_story_id', None)
+                    st.session_state.pop('main_edit_story', None)
+                    st.session_state.story_drafts = []
+                    st.rerun()
+
+    if 'current_story' in st.session_state:
+        show_story_editor()
+
+# The parameter form and the story editor are fragments: changing a parameter or typing in the
+# editor reruns only that section, and what they read comes from the per-session cache
+@st.fragment
+@instrument_fragment
+def show_story_generator():
     col1, col2 = st.columns(2)
     
     with col1:
@@ -447,10 +3988,9 @@ def show_main_page():
         user_story_start = None
         
         if story_origin == "Well-known Tale":
-            tale_data = get_well_known_tales()
-            tale_titles = [tale['Story Title'] for tale in tale_data]
+            tale_titles = get_tale_titles()
             selected_tale = st.selectbox("Select a Well-known Tale", tale_titles, key="main_selected_tale")
-            selected_tale_text = next((tale['Story Text'] for tale in tale_data if tale['Story Title'] == selected_tale), None)
+            selected_tale_text = get_tale_text(selected_tale)
             if selected_tale_text:
                 st.text_area("Selected Tale", value=selected_tale_text, height=200, key="selected_tale_text", disabled=True)
         else:  # Personal Anecdote
@@ -485,15 +4025,7 @@ def show_main_page():
             "How we're different: A marketing story"
         ], key="main_story_type")
         
-        narrative_structure = st.selectbox("Narrative Structure", [
-            "Story-Spine (Default)",
-            "The Story Hanger",
-            "Hero's Journey",
-            "Beginning to End",
-            "In Media Res",
-            "Nested Loops",
-            "The Cliffhanger"
-        ], key="main_narrative_structure")
+        narrative_structure = st.selectbox("Narrative Structure", NARRATIVE_STRUCTURES, key="main_narrative_structure")
         
         simplified_structure = st.selectbox("Simplified Narrative Structure", [
             "Overcoming the Monster",
@@ -527,98 +4059,241 @@ def show_main_page():
         "user_story_start": user_story_start
     }
 
-    if st.button("Generate Story", key="main_generate"):
-        with st.spinner("Generating your story..."):
-            try:
-                generated_story = generate_story(params, selected_tale_text)
-                if user_story_start:
-                    st.session_state.current_story = user_story_start + "\n\n" + generated_story
-                else:
-                    st.session_state.current_story = generated_story
-                st.session_state.current_story_title = f"Story_{datetime.now().strftime('%Y%m%d_%H%M%S')}"
-                st.session_state.current_story_params = params  # Store the parameters
-            except Exception as e:
-                st.error(str(e))
+    _, prompt_report = build_prompt(params, selected_tale_text)
+    for item in prompt_report['condensed']:
+        if item['source'] == 'tale':
+            st.warning(f"The selected tale is long, so a summary of it ({item['tokens']} of {item['original_tokens']} tokens) is sent to the model. Details left out of the summary won't shape the story.")
+        else:
+            st.warning(f"Your story beginning is long, so only its last part ({item['tokens']} of {item['original_tokens']} tokens) is sent to the model. Your full text is still kept at the start of the story.")
+    st.caption(f"Estimated prompt size: {prompt_report['prompt_tokens']} tokens" + (f" ({prompt_report['tokens_saved']} saved by condensing)" if prompt_report['tokens_saved'] else ""))
 
-    if 'current_story' in st.session_state:
-        st.subheader("Generated Story")
-        story = st.text_area("Edit your story here:", value=st.session_state.current_story, height=300, key="main_edit_story")
-        
-        download_format = st.selectbox("Download Format", ["txt", "docx", "pdf"], index=1, key="main_download_format")
-        
-        if st.button("Save Story", key="main_save"):
-            try:
-                save_story(st.session_state.user_id, st.session_state.current_story_title, story, json.dumps(st.session_state.current_story_params))
-                st.success("Story saved successfully!")
-                st.rerun()
-            except Exception as e:
-                st.error(str(e))
+    bypass_cache = st.checkbox("Bypass cache (regenerate)", key="main_bypass_cache", help="Always request a fresh story instead of reusing one generated earlier with the same parameters")
+    draft_count = st.number_input("Drafts to compare", min_value=1, max_value=MAX_DRAFTS, value=1, key="main_draft_count")
+    vary_by = "Temperature"
+    if draft_count > 1:
+        vary_by = st.radio("Vary drafts by", ["Temperature", "Narrative Structure"], horizontal=True, key="main_vary_by")
+
+    generate_clicked = st.button("Generate Story", key="main_generate")
+    if generate_clicked and draft_count > 1:
+        vary = 'narrative_structure' if vary_by == "Narrative Structure" else 'temperature'
+        variants = build_story_variants(params, draft_count, vary)
+        columns = st.columns(draft_count)
+        placeholders = []
+        for column, variant in zip(columns, variants):
+            with column:
+                st.caption(variant['label'])
+                placeholders.append(st.empty())
         
-        file_content = create_download_file(story, download_format)
-        st.download_button(
-            label=f"Download Story as {download_format.upper()}",
-            data=file_content,
-            file_name=f"story_{datetime.now().strftime('%Y%m%d_%H%M%S')}.{download_format}",
-            mime=f"application/{download_format}",
-            key="main_download"
-        )
+        # Drafts are generated concurrently; this thread only renders their chunks as they arrive
+        chunks = [[] for _ in variants]
+        for index, event, value in generate_story_variants_stream(params, selected_tale_text, draft_count, vary, user_id=st.session_state.user_id):
+            if event == 'chunk':
+                chunks[index].append(value)
+                placeholders[index].markdown("".join(chunks[index]))
+            elif event == 'error':
+                variants[index]['error'] = str(value)
+                placeholders[index].error(str(value))
+        for variant, parts in zip(variants, chunks):
+            variant['story'] = "".join(parts)
+        st.session_state.story_drafts = [variant for variant in variants if 'error' not in variant]
+        st.rerun()
+    elif generate_clicked:
+        # Generation runs on a background worker, so widget changes and reconnects don't lose it
+        try:
+            st.session_state.current_job_id = enqueue_generation_job(st.session_state.user_id, params, selected_tale_text, bypass_cache)
+            st.rerun()
+        except Exception as e:
+            st.error(str(e))
+
+@st.fragment
+@instrument_fragment
+def show_story_editor():
+    st.subheader("Generated Story")
+    story = st.text_area("Edit your story here:", value=st.session_state.current_story, height=300, key="main_edit_story")
+    
+    download_format = st.selectbox("Download Format", ["txt", "docx", "pdf"], index=1, key="main_download_format")
+    
+    user_id = st.session_state.user_id
+    similar = cached_read('stories', user_id, find_similar_stories, user_id, story, 5, None, st.session_state.get('current_story_id'))
+    near_duplicate = similar[0] if similar and similar[0]['similarity'] >= NEAR_DUPLICATE_THRESHOLD else None
+    if near_duplicate and near_duplicate['identical']:
+        st.info(f"This story is already saved as \"{near_duplicate['title']}\".")
+    elif near_duplicate:
+        st.info(f"This story is {near_duplicate['similarity']:.0%} similar to your saved story \"{near_duplicate['title']}\". You can save it as a new revision of that one instead of another copy.")
+    
+    # A story that is already saved gets a new revision instead of another row
+    current_story_id = st.session_state.get('current_story_id')
+    if st.button("Save Story", key="main_save"):
+        try:
+            if current_story_id:
+                save_story_revision(current_story_id, st.session_state.user_id, story, json.dumps(st.session_state.current_story_params))
+            else:
+                st.session_state.current_story_id = save_story(st.session_state.user_id, st.session_state.current_story_title, story, json.dumps(st.session_state.current_story_params))
+            st.session_state.current_story = story
+            st.success("Story saved successfully!")
+            st.rerun()
+        except Exception as e:
+            st.error(str(e))
+    if current_story_id and st.button("Save as New Story", key="main_save_new"):
+        try:
+            st.session_state.current_story_title = f"Story_{datetime.now().strftime('%Y%m%d_%H%M%S')}"
+            st.session_state.current_story_id = save_story(st.session_state.user_id, st.session_state.current_story_title, story, json.dumps(st.session_state.current_story_params))
+            st.session_state.current_story = story
+            st.rerun()
+        except Exception as e:
+            st.error(str(e))
+    if near_duplicate and not near_duplicate['identical'] and st.button(f"Save as a revision of \"{near_duplicate['title']}\"", key="main_revise_similar"):
+        try:
+            save_story_revision(near_duplicate['id'], st.session_state.user_id, story, json.dumps(st.session_state.current_story_params))
+            st.session_state.current_story_id = near_duplicate['id']
+            st.session_state.current_story_title = near_duplicate['title']
+            st.session_state.current_story = story
+            st.rerun()
+        except Exception as e:
+            st.error(str(e))
+    
+    if similar:
+        with st.expander(f"Similar saved stories ({len(similar)})"):
+            for item in similar:
+                col1, col2 = st.columns([4, 1])
+                col1.write(f"{item['title']} ({item['similarity']:.0%} similar)")
+                if col2.button("Open", key=f"similar_open_{item['id']}"):
+                    open_saved_story(item['id'])
+                    st.rerun()
+    
+    # Only the selected paragraphs and a little text around them go to the model; the new text is
+    # streamed into the story in place
+    paragraphs = split_paragraphs(story)
+    if paragraphs:
+        with st.expander("Rewrite part of the story"):
+            if len(paragraphs) > 1:
+                first, last = st.select_slider("Paragraphs", options=list(range(1, len(paragraphs) + 1)), value=(1, 1), key=f"main_section_range_{len(paragraphs)}")
+            else:
+                first, last = 1, 1
+            action = st.radio("Action", list(SECTION_ACTIONS), format_func=lambda name: SECTION_ACTIONS[name]['label'], horizontal=True, key="main_section_action")
+            _, report = build_section_prompt(st.session_state.current_story_params, paragraphs, first - 1, last, action)
+            st.caption(f"Sends about {report['prompt_tokens']} prompt tokens and asks for at most {report['max_tokens']} back, instead of regenerating all {count_tokens(story)} tokens of the story")
+            if st.button(f"{SECTION_ACTIONS[action]['label']} paragraphs {first}-{last}" if last > first else f"{SECTION_ACTIONS[action]['label']} paragraph {first}", key="main_section_apply"):
+                preview = st.empty()
+                chunks = []
+                try:
+                    for chunk in edit_story_section_stream(st.session_state.current_story_params, story, first - 1, last, action, user_id=user_id):
+                        chunks.append(chunk)
+                        preview.markdown(splice_story_section(paragraphs, first - 1, last, action, "".join(chunks)))
+                except Exception as e:
+                    st.error(str(e))
+                else:
+                    st.session_state.current_story = splice_story_section(paragraphs, first - 1, last, action, "".join(chunks))
+                    st.session_state.pop('main_edit_story', None)
+                    st.rerun()
+    
+    # The file is only built when the button is clicked
+    st.download_button(
+        label=f"Download Story as {download_format.upper()}",
+        data=lambda: get_download_file(story, download_format),
+        file_name=f"story_{datetime.now().strftime('%Y%m%d_%H%M%S')}.{download_format}",
+        mime=EXPORT_MIME_TYPES[download_format],
+        key="main_download"
+    )
+
+def format_slot(start_time):
+    return datetime.strptime(start_time, '%Y-%m-%d %H:%M').strftime('%a %d %b, %H:%M')
 
 def show_professionals_page():
     st.title("Professional Storytellers")
     
-    professionals = get_professionals()
+    professionals = cached_read('professionals', None, get_professionals)
     
     if not professionals:
         # Add some dummy data if the table is empty
-        dummy_data = [
-            ("John Doe", "Expert storyteller with 10 years of experience in corporate narratives.", 10, 4.8, 150),
-            ("Jane Smith", "Specializes in personal branding stories with a touch of humor.", 8, 4.7, 120),
-            ("Mike Johnson", "Master of fantasy tales and creative writing workshops.", 15, 4.9, 200),
-            ("Sarah Brown", "Focuses on inspirational stories for motivational speaking.", 12, 4.6, 180),
-            ("David Lee", "Experienced in crafting compelling product launch stories.", 7, 4.5, 100),
-        ]
-        
-        conn = sqlite3.connect(DB_NAME)
-        cursor = conn.cursor()
-        
-        for pro in dummy_data:
-            cursor.execute('''
-                INSERT INTO professionals (name, bio, experience, rating, price)
-                VALUES (?, ?, ?, ?, ?)
-            ''', pro)
-        
-        conn.commit()
-        conn.close()
-        
-        professionals = get_professionals()
+        seed_professionals()
+        professionals = cached_read('professionals', None, get_professionals)
+    ensure_slot_window()
     
     for pro in professionals:
-        st.write("---")
-        col1, col2, col3 = st.columns([2, 1, 1])
-        
-        with col1:
-            st.subheader(pro.get('name', 'Unknown'))
-            st.write(pro.get('bio', 'No bio available'))
-        
-        with col2:
-            st.write(f"Experience: {pro.get('experience', 'Unknown')} years")
-            st.write(f"Rating: {pro.get('rating', 'Unknown')}/5.0")
-            st.write(f"Price: ${pro.get('price', 'Unknown')}/session")
-        
-        with col3:
-            available_slots = [f"{random.randint(9, 17)}:00" for _ in range(3)]
-            selected_slot = st.selectbox(f"Available slots for {pro.get('name', 'Unknown')}", available_slots, key=f"slot_{pro.get('id', 'unknown')}")
-            if st.button("Book Session", key=f"book_{pro.get('id', 'unknown')}"):
-                try:
-                    booking_id = add_booking(st.session_state.user_id, pro.get('id'), selected_slot)
-                    st.success(f"Booked a session with {pro.get('name', 'Unknown')} at {selected_slot}")
-                except Exception as e:
-                    st.error(str(e))
+        show_professional_card(pro)
     
     if st.button("Back to Main Page"):
         st.session_state.page = 'main'
         st.rerun()
 
+def book_selected_slot(pro, slot_labels):
+    # Button callback: runs before the card reruns, so the card already shows the updated slots
+    slot_id = st.session_state.get(f"slot_{pro['id']}")
+    try:
+        add_booking(st.session_state.user_id, pro['id'], slot_id)
+        st.session_state[f"booking_message_{pro['id']}"] = ('success', f"Booked a session with {pro.get('name', 'Unknown')} on {slot_labels.get(slot_id)}")
+    except Exception as e:
+        st.session_state[f"booking_message_{pro['id']}"] = ('error', str(e))
+
+# One fragment per card: picking a slot or booking reruns only that card
+@st.fragment
+@instrument_fragment
+def show_professional_card(pro):
+    st.write("---")
+    col1, col2, col3 = st.columns([2, 1, 1])
+    
+    with col1:
+        st.subheader(pro.get('name', 'Unknown'))
+        st.write(pro.get('bio', 'No bio available'))
+    
+    with col2:
+        st.write(f"Experience: {pro.get('experience', 'Unknown')} years")
+        st.write(f"Rating: {pro.get('rating', 'Unknown')}/5.0")
+        st.write(f"Price: ${pro.get('price', 'Unknown')}/session")
+    
+    with col3:
+        message = st.session_state.pop(f"booking_message_{pro['id']}", None)
+        if message and message[0] == 'success':
+            st.success(message[1])
+        elif message:
+            st.error(message[1])
+        
+        slots = cached_read('slots', pro['id'], get_next_free_slots, pro['id'])
+        if not slots:
+            st.write(f"No free slots in the next {SLOT_WINDOW_DAYS} days")
+            return
+        slot_labels = {slot['id']: format_slot(slot['start_time']) for slot in slots}
+        st.selectbox(f"Available slots for {pro.get('name', 'Unknown')}", list(slot_labels), format_func=slot_labels.get, key=f"slot_{pro['id']}")
+        st.button("Book Session", key=f"book_{pro['id']}", on_click=book_selected_slot, args=(pro, slot_labels))
+
+def measure_import_time(module):
+    # A fresh interpreter per module, so nothing is already cached in sys.modules
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+                            capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__)))
+    for line in reversed(result.stderr.splitlines()):
+        parts = [part.strip() for part in line.split('|')]
+        if len(parts) == 3 and parts[2] == module:
+            return int(parts[1]) / 1e6
+    return None
+
+def print_startup_report():
+    rows = [('import app (startup path)', measure_import_time('app'))]
+    rows += [(f"import {module} (deferred)", measure_import_time(module)) for module in DEFERRED_IMPORTS]
+    
+    init_steps = [
+        ('database schema', lambda: ensure_schema(DB_NAME)),
+        ('response cache schema', lambda: ensure_schema(CACHE_DB_NAME)),
+        ('Groq client', get_groq_client),
+        ('well-known tale corpus', get_well_known_tales)
+    ]
+    for label, step in init_steps:
+        start = time.perf_counter()
+        try:
+            step()
+            rows.append((f"init {label}", time.perf_counter() - start))
+        except Exception as e:
+            rows.append((f"init {label} (failed: {str(e)})", time.perf_counter() - start))
+    
+    width = max(len(label) for label, _ in rows)
+    print(f"{'step'.ljust(width)}  seconds")
+    for label, seconds in rows:
+        print(f"{label.ljust(width)}  {'n/a' if seconds is None else f'{seconds:.3f}'}")
+
 if __name__ == "__main__":
-    init_db()
-    main()
+    if '--startup-report' in sys.argv:
+        print_startup_report()
+    elif '--compact-stories' in sys.argv:
+        print(f"Recompressed {compact_stories()} stories")
+    else:
+        main()
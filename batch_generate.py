@@ -0,0 +1,181 @@
+"""Generate stories in bulk without the Streamlit UI.
+
+Reads a JSONL file where every line is a story parameter dict (the same
+shape show_main_page builds), generates the stories with a worker pool and
+inserts them into the stories table. Progress is checkpointed in the
+database, so re-running the same command resumes where it stopped.
+Requests are scheduled as batch work, paced by the user's batch token
+bucket (BATCH_TOKENS_PER_MINUTE, unlimited by default), and their usage
+is recorded in llm_usage. The scheduler lives in memory,
+so it doesn't see requests made by a separately running app process.
+
+    python batch_generate.py prompts.jsonl --user-id 1 --workers 4
+"""
+import argparse
+import hashlib
+import json
+import logging
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime
+
+import app
+
+# st.cache_resource warns on every call when there is no Streamlit script run
+logging.getLogger('streamlit').setLevel(logging.ERROR)
+
+DEFAULT_PARAMS = {
+    "story_origin": "Personal Anecdote",
+    "use_case": "Personal Branding",
+    "time_frame": "Recent Experience",
+    "age": None,
+    "focus": [],
+    "length": "Short (250-500 words)",
+    "story_type": "Personal stories: Who you are, what you do, how you do it, and who you do it for",
+    "narrative_structure": "Story-Spine (Default)",
+    "simplified_structure": "The Quest",
+    "creative_enhancements": [],
+    "user_story_start": None
+}
+
+
+def get_completed_lines(job_id):
+    with app.db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('SELECT line_number FROM batch_checkpoints WHERE job_id = ?', (job_id,))
+        return {row[0] for row in cursor.fetchall()}
+
+
+def read_jobs(path, completed):
+    jobs = []
+    with open(path, encoding='utf-8') as f:
+        for line_number, line in enumerate(f, start=1):
+            if not line.strip() or line_number in completed:
+                continue
+            try:
+                jobs.append((line_number, json.loads(line)))
+            except json.JSONDecodeError as e:
+                logging.error(f"Skipping line {line_number}: invalid JSON ({str(e)})")
+    return jobs
+
+
+def resolve_job(record, default_user_id):
+    params = {key: record.get(key, value) for key, value in DEFAULT_PARAMS.items()}
+    selected_tale_text = record.get('selected_tale_text')
+    if not selected_tale_text and record.get('selected_tale'):
+        selected_tale_text = app.get_tale_text(record['selected_tale'])
+        if selected_tale_text is None:
+            raise Exception(f"Unknown well-known tale: {record['selected_tale']}")
+    user_id = record.get('user_id', default_user_id)
+    if user_id is None:
+        raise Exception("No user_id in the record and no --user-id given")
+    return params, selected_tale_text, user_id
+
+
+def generate_job(line_number, record, default_user_id):
+    params, selected_tale_text, user_id = resolve_job(record, default_user_id)
+    # generate_story_with_usage already retries rate limited requests
+    story, usage = app.generate_story_with_usage(params, selected_tale_text, user_id=user_id, kind='batch')
+
+    if params['user_story_start']:
+        story = params['user_story_start'] + "\n\n" + story
+    title = record.get('title') or f"Story_{datetime.now().strftime('%Y%m%d_%H%M%S')}_{line_number}"
+    return {
+        'line_number': line_number,
+        'user_id': user_id,
+        'title': title,
+        'content': story,
+        'parameters': json.dumps(params),
+        'usage': usage
+    }
+
+
+def flush_results(job_id, results):
+    # Stories and their checkpoints commit together, so a crash never loses or duplicates a line
+    with app.db_connection() as conn:
+        cursor = conn.cursor()
+        try:
+            app._insert_stories(cursor, [
+                (result['user_id'], result['title'], result['content'], result['parameters']) for result in results
+            ])
+            cursor.executemany('''
+                INSERT OR REPLACE INTO batch_checkpoints (job_id, line_number)
+                VALUES (?, ?)
+            ''', [(job_id, result['line_number']) for result in results])
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+
+
+def run_batch(args):
+    app.init_db()
+
+    job_id = args.job_id or hashlib.sha256(os.path.abspath(args.input).encode('utf-8')).hexdigest()[:16]
+    completed = get_completed_lines(job_id)
+    jobs = read_jobs(args.input, completed)
+    logging.info(f"Job {job_id}: {len(jobs)} stories to generate, {len(completed)} already done")
+
+    pending = []
+    generated = 0
+    failed = 0
+    prompt_tokens = 0
+    completion_tokens = 0
+    start = time.perf_counter()
+
+    with ThreadPoolExecutor(max_workers=args.workers) as executor:
+        futures = {
+            executor.submit(generate_job, line_number, record, args.user_id): line_number
+            for line_number, record in jobs
+        }
+        for future in as_completed(futures):
+            line_number = futures[future]
+            try:
+                result = future.result()
+            except Exception as e:
+                failed += 1
+                logging.error(f"Line {line_number} failed: {str(e)}")
+                continue
+
+            pending.append(result)
+            generated += 1
+            prompt_tokens += result['usage']['prompt_tokens']
+            completion_tokens += result['usage']['completion_tokens']
+            if len(pending) >= args.batch_size:
+                flush_results(job_id, pending)
+                pending = []
+                logging.info(f"Progress: {generated}/{len(jobs)} generated, {failed} failed")
+
+    if pending:
+        flush_results(job_id, pending)
+
+    elapsed = time.perf_counter() - start
+    report = {
+        'job_id': job_id,
+        'generated': generated,
+        'failed': failed,
+        'skipped': len(completed),
+        'elapsed_seconds': round(elapsed, 2),
+        'stories_per_minute': round(generated / elapsed * 60, 2) if elapsed else 0.0,
+        'completion_tokens_per_second': round(completion_tokens / elapsed, 2) if elapsed else 0.0,
+        'prompt_tokens': prompt_tokens,
+        'completion_tokens': completion_tokens
+    }
+    print(json.dumps(report, indent=2))
+    return 1 if failed else 0
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Generate stories in bulk from a JSONL file of story parameters.")
+    parser.add_argument('input', help="JSONL file, one story parameter dict per line")
+    parser.add_argument('--user-id', type=int, help="owner of the generated stories when a line has no user_id")
+    parser.add_argument('--workers', type=int, default=4, help="concurrent LLM requests (default: 4)")
+    parser.add_argument('--batch-size', type=int, default=25, help="stories per insert transaction (default: 25)")
+    parser.add_argument('--job-id', help="checkpoint key (default: derived from the input path)")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    sys.exit(run_batch(parse_args()))
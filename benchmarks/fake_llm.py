@@ -0,0 +1,191 @@
+"""In-process stand-in for the Groq chat completions endpoint.
+
+Serves the OpenAI-compatible /openai/v1/chat/completions route (plain and
+server-sent-event streaming) with a configurable time to first token and
+token rate, so the app can be exercised without network access or API
+spend. A max_tokens in the request caps the completion length, as it does
+on the real endpoint. Point the Groq client at it with GROQ_BASE_URL=<server.base_url>.
+
+Faults can be injected to exercise the request policy: error_rate answers
+that share of requests with error_status, slow_rate adds slow_latency to
+the time to first token of that share of requests, and model_overrides
+maps a model name to its own values for any of these settings, e.g.
+
+    FakeLLMServer(slow_rate=0.1, slow_latency=3.0,
+                  model_overrides={'llama-3.1-8b-instant': {'first_token_latency': 0.05}})
+"""
+import json
+import random
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+WORDS = ("once upon a time a curious founder set out to build something that "
+         "would change how people told their stories and along the way learned ").split()
+
+
+class FakeLLMServer:
+    def __init__(self, first_token_latency=0.2, tokens_per_second=200.0, completion_tokens=400, host='127.0.0.1', port=0,
+                 error_rate=0.0, error_status=500, slow_rate=0.0, slow_latency=5.0, model_overrides=None, seed=None):
+        self.first_token_latency = first_token_latency
+        self.tokens_per_second = tokens_per_second
+        self.completion_tokens = completion_tokens
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.slow_rate = slow_rate
+        self.slow_latency = slow_latency
+        self.model_overrides = model_overrides or {}
+        self.requests = 0
+        self.requests_by_model = {}
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer((host, port), self._make_handler())
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def base_url(self):
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def completion_words(self, settings=None):
+        count = (settings or {}).get('completion_tokens', self.completion_tokens)
+        return [WORDS[i % len(WORDS)] + " " for i in range(count)]
+
+    def settings_for(self, model):
+        settings = {
+            'first_token_latency': self.first_token_latency,
+            'tokens_per_second': self.tokens_per_second,
+            'completion_tokens': self.completion_tokens,
+            'error_rate': self.error_rate,
+            'error_status': self.error_status,
+            'slow_rate': self.slow_rate,
+            'slow_latency': self.slow_latency
+        }
+        settings.update(self.model_overrides.get(model, {}))
+        with self._lock:
+            settings['fail'] = self._random.random() < settings['error_rate']
+            if self._random.random() < settings['slow_rate']:
+                settings['first_token_latency'] += settings['slow_latency']
+        return settings
+
+    def _make_handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, format, *args):
+                pass
+
+            def do_POST(self):
+                if not self.path.endswith('/chat/completions'):
+                    self.send_error(404)
+                    return
+                body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+                model = body.get('model', 'fake-model')
+                with server._lock:
+                    server.requests += 1
+                    server.requests_by_model[model] = server.requests_by_model.get(model, 0) + 1
+
+                settings = server.settings_for(model)
+                if body.get('max_tokens'):
+                    settings['completion_tokens'] = min(settings['completion_tokens'], body['max_tokens'])
+                if settings['fail']:
+                    self._error(settings['error_status'])
+                    return
+                prompt_tokens = sum(len(str(message.get('content', '')).split()) for message in body.get('messages', []))
+                if body.get('stream'):
+                    self._stream(model, prompt_tokens, settings)
+                else:
+                    self._complete(model, prompt_tokens, settings)
+
+            def _error(self, status):
+                payload = json.dumps({'error': {'message': f"Injected error {status}", 'type': 'fake_error'}}).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def _complete(self, model, prompt_tokens, settings):
+                words = server.completion_words(settings)
+                time.sleep(settings['first_token_latency'] + len(words) / settings['tokens_per_second'])
+                payload = json.dumps({
+                    'id': f"chatcmpl-{uuid.uuid4().hex}",
+                    'object': 'chat.completion',
+                    'created': int(time.time()),
+                    'model': model,
+                    'choices': [{
+                        'index': 0,
+                        'message': {'role': 'assistant', 'content': ''.join(words)},
+                        'finish_reason': 'stop'
+                    }],
+                    'usage': {
+                        'prompt_tokens': prompt_tokens,
+                        'completion_tokens': len(words),
+                        'total_tokens': prompt_tokens + len(words)
+                    }
+                }).encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def _stream(self, model, prompt_tokens, settings):
+                completion_id = f"chatcmpl-{uuid.uuid4().hex}"
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/event-stream')
+                self.send_header('Connection', 'close')
+                self.end_headers()
+                time.sleep(settings['first_token_latency'])
+
+                words = server.completion_words(settings)
+                self.close_connection = True
+                try:
+                    for i, word in enumerate(words):
+                        if i:
+                            time.sleep(1 / settings['tokens_per_second'])
+                        self._send_event(completion_id, model, {'content': word}, None)
+                    self._send_event(completion_id, model, {}, 'stop', usage={
+                        'prompt_tokens': prompt_tokens,
+                        'completion_tokens': len(words),
+                        'total_tokens': prompt_tokens + len(words)
+                    })
+                    self.wfile.write(b"data: [DONE]\n\n")
+                    self.wfile.flush()
+                except (BrokenPipeError, ConnectionResetError):
+                    # The client abandoned the stream, e.g. a hedge request that lost the race
+                    pass
+
+            def _send_event(self, completion_id, model, delta, finish_reason, usage=None):
+                chunk = {
+                    'id': completion_id,
+                    'object': 'chat.completion.chunk',
+                    'created': int(time.time()),
+                    'model': model,
+                    'choices': [{'index': 0, 'delta': delta, 'finish_reason': finish_reason}]
+                }
+                if usage:
+                    chunk['x_groq'] = {'id': completion_id, 'usage': usage}
+                self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode('utf-8'))
+                self.wfile.flush()
+
+        return Handler
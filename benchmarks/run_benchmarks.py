@@ -0,0 +1,669 @@
+"""Benchmarks for the hot paths in app.py.
+
+Every benchmark runs against a throwaway database in a temporary directory
+and the LLM calls go to benchmarks/fake_llm.py, so results only depend on
+this machine. Results are written as JSON so runs can be compared:
+
+    python benchmarks/run_benchmarks.py --output bench_results.json
+    python benchmarks/run_benchmarks.py --quick
+"""
+import argparse
+import contextlib
+import itertools
+import json
+import logging
+import os
+import platform
+import random
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timezone
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fake_llm import FakeLLMServer
+
+STORY_LENGTHS = {'short': 375, 'medium': 750, 'long': 1250}
+
+SAMPLE_PARAMS = {
+    "story_origin": "Personal Anecdote",
+    "use_case": "Product Launch",
+    "time_frame": "Mid-career",
+    "age": None,
+    "focus": ["Integrity", "Persistence", "Optimism"],
+    "length": "Medium (500-1000 words)",
+    "story_type": "Where we're going: A vision story",
+    "narrative_structure": "Hero's Journey",
+    "simplified_structure": "The Quest",
+    "creative_enhancements": ["Metaphors", "Dialogue"],
+    "user_story_start": "It was the week before our first launch."
+}
+
+
+def measure(fn, repeat, warmup=1):
+    for _ in range(warmup):
+        fn()
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        samples.append((time.perf_counter() - start) * 1000)
+    return summarize(samples)
+
+
+def summarize(samples):
+    samples = sorted(samples)
+    return {
+        'repeat': len(samples),
+        'min_ms': round(samples[0], 4),
+        'median_ms': round(statistics.median(samples), 4),
+        'p95_ms': round(samples[min(len(samples) - 1, int(len(samples) * 0.95))], 4),
+        'mean_ms': round(statistics.fmean(samples), 4),
+        'max_ms': round(samples[-1], 4)
+    }
+
+
+def story_text(words):
+    paragraph = "The team gathered around the whiteboard and sketched the plan for the launch. "
+    sentence_words = len(paragraph.split())
+    sentences = [paragraph] * max(1, words // sentence_words)
+    return "\n\n".join("".join(sentences[i:i + 5]) for i in range(0, len(sentences), 5))
+
+
+def prepare_workdir():
+    workdir = tempfile.mkdtemp(prefix='storytelling-bench-')
+    os.makedirs(os.path.join(workdir, 'db'))
+    shutil.copy(os.path.join(REPO_DIR, 'db', 'well_known_tales.xlsx'), os.path.join(workdir, 'db'))
+    return workdir
+
+
+def init_database(app, path):
+    app.DB_NAME = path
+    app.init_db()
+
+
+def create_database(app, path, rows):
+    init_database(app, path)
+    content = story_text(250)
+    with app.db_connection() as conn:
+        conn.execute("INSERT INTO users (first_name, last_name, email, profession, username, phone, password) "
+                     "VALUES ('Bench', 'User', 'bench@example.com', 'Other', 'bench', '0', 'x')")
+        conn.executemany('INSERT INTO stories (user_id, title, content, parameters) VALUES (1, ?, ?, ?)',
+                         ((f"Story_{i}", content, json.dumps(SAMPLE_PARAMS)) for i in range(rows)))
+        conn.executemany('INSERT INTO professionals (name, bio, experience, rating, price) VALUES (?, ?, ?, ?, ?)',
+                         ((f"Pro {i}", "Experienced storyteller.", i % 20, 4.5, 100.0) for i in range(rows)))
+        conn.commit()
+
+
+def index_similarity(app):
+    # create_database inserts rows directly, so they still need their MinHash/LSH entries
+    with app.db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('SELECT id, user_id, content FROM stories')
+        for story_id, user_id, content in cursor.fetchall():
+            app._index_story(cursor, story_id, user_id, content)
+        conn.commit()
+
+
+def bench_database(app, workdir, sizes, repeat):
+    results = []
+    for rows in sizes:
+        create_database(app, os.path.join(workdir, f"bench_{rows}.db"), rows)
+        # Large listings are slow by design; keep the total runtime bounded
+        runs = max(3, repeat // 10) if rows >= 100000 else repeat
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            results.append({'name': 'get_stories', 'params': {'rows': rows}, 'stats': measure(lambda: app.get_stories(1), runs)})
+            results.append({'name': 'list_stories', 'params': {'rows': rows}, 'stats': measure(lambda: app.list_stories(1), repeat)})
+            results.append({'name': 'get_professionals', 'params': {'rows': rows}, 'stats': measure(app.get_professionals, runs)})
+            index_similarity(app)
+            new_story = story_text(250).replace("launch", "offsite retreat")
+            results.append({'name': 'find_similar_stories', 'params': {'rows': rows, 'match': 'near_duplicate'},
+                            'stats': measure(lambda: app.find_similar_stories(1, new_story), repeat)})
+            unrelated = "A tiny bakery on the corner kept its lights on through the winter storm for the neighbours."
+            results.append({'name': 'find_similar_stories', 'params': {'rows': rows, 'match': 'none'},
+                            'stats': measure(lambda: app.find_similar_stories(1, unrelated), repeat)})
+        logging.info(f"database benchmarks done for {rows} rows")
+    return results
+
+
+def bench_search(app, workdir, rows, repeat):
+    # Full-text search for one user among `rows` stories spread over 100 users. "launch" matches
+    # every story, "retreat" one in ten, so most matches belong to other users. Content is stored
+    # compressed, as the app saves it, so snippets pay for decompression
+    init_database(app, os.path.join(workdir, 'bench_search.db'))
+    content = story_text(600)
+    contents = [app.compress_text(content), app.compress_text(content + " The offsite retreat changed everything.")]
+    with app.db_connection() as conn:
+        conn.executemany("INSERT INTO users (first_name, last_name, email, profession, username, phone, password) "
+                         "VALUES ('Bench', 'User', ?, 'Other', ?, '0', 'x')", ((f"bench{i}@example.com", f"bench{i}") for i in range(100)))
+        conn.executemany('INSERT INTO stories (user_id, title, content, parameters) VALUES (?, ?, ?, ?)', (
+            (i % 100 + 1, f"Story_{i}", contents[i % 10 == 0], json.dumps(SAMPLE_PARAMS)) for i in range(rows)
+        ))
+        conn.commit()
+
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        results = [
+            {'name': 'search_stories', 'params': {'rows': rows, 'query': query, 'results': len(app.search_stories(1, query))},
+             'stats': measure(lambda: app.search_stories(1, query), repeat)}
+            for query in ("launch", "retreat", "nonexistentword")
+        ]
+    logging.info(f"search benchmarks done for {rows} rows")
+    return results
+
+
+def database_bytes(app):
+    with app.db_connection() as conn:
+        conn.execute('VACUUM')
+        conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+        content_bytes = conn.execute('SELECT SUM(length(CAST(content AS BLOB))) FROM stories').fetchone()[0]
+    return os.path.getsize(app.DB_NAME), content_bytes
+
+
+def bench_storage(app, workdir, rows, repeat):
+    # Stories written the old way (plain text, parameters only as JSON), then compacted in place,
+    # the way the storage migration converts an existing database
+    texts = [tale['Story Text'] for tale in app.get_well_known_tales()]
+    init_database(app, os.path.join(workdir, 'bench_storage.db'))
+    with app.db_connection() as conn:
+        conn.execute("INSERT INTO users (first_name, last_name, email, profession, username, phone, password) "
+                     "VALUES ('Bench', 'User', 'bench@example.com', 'Other', 'bench', '0', 'x')")
+        conn.executemany('INSERT INTO stories (user_id, title, content, parameters) VALUES (1, ?, ?, ?)', (
+            (f"Story_{i}", f"Draft {i}.\n\n{texts[i % len(texts)]}", json.dumps(dict(
+                SAMPLE_PARAMS,
+                narrative_structure=app.NARRATIVE_STRUCTURES[i % len(app.NARRATIVE_STRUCTURES)],
+                use_case=("Product Launch", "Personal Branding", "Company Origin")[i % 3]
+            ))) for i in range(rows)
+        ))
+        conn.commit()
+
+    def count_json():
+        with app.db_connection() as conn:
+            return conn.execute("SELECT COUNT(*) FROM stories WHERE json_extract(parameters, '$.narrative_structure') = ? "
+                                "AND json_extract(parameters, '$.use_case') = ?", ("Hero's Journey", "Product Launch")).fetchone()[0]
+
+    file_bytes, content_bytes = database_bytes(app)
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        results = [
+            {'name': 'storage.plain', 'params': {'rows': rows, 'file_bytes': file_bytes, 'content_bytes': content_bytes},
+             'stats': measure(lambda: app.get_story(rows // 2, 1), repeat * 10)},
+            {'name': 'count_stories.json_extract', 'params': {'rows': rows, 'matches': count_json()}, 'stats': measure(count_json, repeat)}
+        ]
+        compact = measure(app.compact_stories, 1, warmup=0)
+        file_bytes, content_bytes = database_bytes(app)
+        results += [
+            {'name': 'compact_stories', 'params': {'rows': rows}, 'stats': compact},
+            {'name': 'storage.compressed', 'params': {'rows': rows, 'file_bytes': file_bytes, 'content_bytes': content_bytes},
+             'stats': measure(lambda: app.get_story(rows // 2, 1), repeat * 10)},
+            {'name': 'count_stories.columns', 'params': {
+                'rows': rows, 'matches': app.count_stories(narrative_structure="Hero's Journey", use_case="Product Launch")
+            }, 'stats': measure(lambda: app.count_stories(narrative_structure="Hero's Journey", use_case="Product Launch"), repeat)},
+            {'name': 'count_stories.tags', 'params': {'rows': rows, 'matches': app.count_stories(focus="Integrity", use_case="Product Launch")},
+             'stats': measure(lambda: app.count_stories(focus="Integrity", use_case="Product Launch"), repeat)}
+        ]
+    logging.info(f"storage benchmarks done for {rows} rows")
+    return results
+
+
+def bench_booking(app, workdir, bookers, attempts):
+    # Load test: `bookers` threads start together and each makes `attempts` bookings of random
+    # slots from a small pool, so most attempts collide. Every slot must end up booked exactly once
+    init_database(app, os.path.join(workdir, 'bench_booking.db'))
+    app.seed_professionals()
+    with app.db_connection() as conn:
+        pool = conn.execute('''
+            SELECT professional_id, id FROM (
+                SELECT professional_id, id, ROW_NUMBER() OVER (PARTITION BY professional_id ORDER BY start_time) AS position
+                FROM professional_slots WHERE booking_id IS NULL AND start_time > ?
+            ) WHERE position <= 10
+        ''', (datetime.now().strftime('%Y-%m-%d %H:%M'),)).fetchall()
+
+    def run(slots):
+        outcomes = {'booked': 0, 'conflicts': 0, 'errors': 0}
+        samples = []
+        lock = threading.Lock()
+        barrier = threading.Barrier(bookers)
+
+        def booker(user_id):
+            rng = random.Random(user_id)
+            barrier.wait()
+            for _ in range(attempts):
+                professional_id, slot_id = rng.choice(slots)
+                start = time.perf_counter()
+                try:
+                    app.add_booking(user_id, professional_id, slot_id)
+                    outcome = 'booked'
+                except Exception as e:
+                    outcome = 'conflicts' if 'no longer available' in str(e) else 'errors'
+                    if outcome == 'errors':
+                        logging.error(f"Booking failed: {str(e)}")
+                with lock:
+                    outcomes[outcome] += 1
+                    samples.append((time.perf_counter() - start) * 1000)
+
+        threads = [threading.Thread(target=booker, args=(user_id,)) for user_id in range(1, bookers + 1)]
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - start
+        with app.db_connection() as conn:
+            double_booked = conn.execute('SELECT COUNT(*) FROM (SELECT slot_id FROM bookings WHERE slot_id IS NOT NULL GROUP BY slot_id HAVING COUNT(*) > 1)').fetchone()[0]
+        return dict(outcomes, bookers=bookers, slots=len(slots), double_booked=double_booked,
+                    attempts_per_second=round(bookers * attempts / elapsed, 1)), summarize(samples)
+
+    results = []
+    params, stats = run(pool[:1])
+    results.append({'name': 'add_booking.same_slot', 'params': params, 'stats': stats})
+    params, stats = run(pool[1:])
+    results.append({'name': 'add_booking.contended', 'params': params, 'stats': stats})
+    with app.db_connection() as conn:
+        plan = conn.execute('EXPLAIN QUERY PLAN SELECT id, start_time FROM professional_slots WHERE professional_id = 1 '
+                            'AND booking_id IS NULL AND start_time > ? ORDER BY start_time LIMIT 5', ('',)).fetchall()
+    results.append({'name': 'get_next_free_slots', 'params': {'plan': plan[-1][-1]}, 'stats': measure(lambda: app.get_next_free_slots(1), 200)})
+    logging.info(f"booking load test done with {bookers} bookers")
+    return results
+
+
+def bench_auth(app, workdir, logins, repeat):
+    # A login with a password runs the KDF, a returning session only looks up its token; the burst
+    # is `logins` users logging in at once through the bounded password pool
+    init_database(app, os.path.join(workdir, 'bench_auth.db'))
+    for n in range(logins):
+        app.add_user({'first_name': 'Bench', 'last_name': str(n), 'email': f"bench{n}@example.com", 'profession': 'Other',
+                      'username': f"bench{n}", 'phone': '', 'password': 'secret'})
+    token = app.create_session(1)
+
+    def password_login():
+        app.clear_login_attempts('bench0')
+        assert app.get_user('bench0', 'secret')
+
+    results = [
+        {'name': 'login.password', 'params': {'method': app.PASSWORD_HASH_METHOD}, 'stats': measure(password_login, min(repeat, 10))},
+        {'name': 'login.session', 'params': {}, 'stats': measure(lambda: app.get_session_user(token), 200)}
+    ]
+
+    samples = []
+    outcomes = {'ok': 0, 'errors': 0}
+    lock = threading.Lock()
+    barrier = threading.Barrier(logins)
+
+    def login(n):
+        barrier.wait()
+        start = time.perf_counter()
+        try:
+            ok = app.get_user(f"bench{n}", 'secret') is not None
+        except Exception:
+            ok = False
+        with lock:
+            samples.append((time.perf_counter() - start) * 1000)
+            outcomes['ok' if ok else 'errors'] += 1
+
+    threads = [threading.Thread(target=login, args=(n,)) for n in range(logins)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    results.append({'name': 'login.burst', 'params': dict(outcomes, logins=logins, workers=app.PASSWORD_WORKERS,
+                    logins_per_second=round(logins / elapsed, 1)), 'stats': summarize(samples)})
+    return results
+
+
+def bench_tales(app, workdir, repeat):
+    init_database(app, os.path.join(workdir, 'bench_tales.db'))
+
+    def cold():
+        store = app.get_tale_store()
+        store.update(signature=None, source_hash=None)
+        with app.db_connection() as conn:
+            conn.execute('DELETE FROM tale_corpus_meta')
+            conn.commit()
+        app.get_well_known_tales()
+
+    def compiled():
+        app.get_tale_store().update(signature=None, source_hash=None)
+        app.get_well_known_tales()
+
+    return [
+        {'name': 'get_well_known_tales', 'params': {'state': 'cold_parse'}, 'stats': measure(cold, max(3, repeat // 10))},
+        {'name': 'get_well_known_tales', 'params': {'state': 'compiled'}, 'stats': measure(compiled, repeat)},
+        {'name': 'get_well_known_tales', 'params': {'state': 'warm'}, 'stats': measure(app.get_well_known_tales, repeat)}
+    ]
+
+
+def bench_exports(app, repeat):
+    results = []
+    for length, words in STORY_LENGTHS.items():
+        content = story_text(words)
+        for format in ('txt', 'docx', 'pdf'):
+            data = app.create_download_file(content, format)
+            results.append({
+                'name': 'create_download_file',
+                'params': {'format': format, 'length': length, 'bytes': len(data)},
+                'stats': measure(lambda: app.create_download_file(content, format), repeat)
+            })
+    return results
+
+
+def bench_prompt(app, tale_text, repeat):
+    results = [
+        {'name': 'construct_prompt', 'params': {'tale': False}, 'stats': measure(lambda: app.construct_prompt(SAMPLE_PARAMS), repeat * 10)},
+        {'name': 'construct_prompt', 'params': {'tale': True}, 'stats': measure(lambda: app.construct_prompt(SAMPLE_PARAMS, tale_text), repeat * 10)}
+    ]
+    # Prompt size over the whole tale corpus, with and without condensing
+    reports = [app.build_prompt(SAMPLE_PARAMS, tale['Story Text'])[1] for tale in app.get_well_known_tales()]
+    results.append({'name': 'build_prompt.tale_corpus', 'params': {
+        'tales': len(reports),
+        'condensed': sum(1 for report in reports if report['condensed']),
+        'original_tokens': sum(report['original_tokens'] for report in reports),
+        'prompt_tokens': sum(report['prompt_tokens'] for report in reports),
+        'tokens_saved': sum(report['tokens_saved'] for report in reports)
+    }, 'stats': measure(lambda: app.build_prompt(SAMPLE_PARAMS, tale_text), repeat * 10)})
+    return results
+
+
+def bench_llm(app, server, repeat):
+    runs = max(3, repeat // 5)
+
+    def time_to_first_token():
+        start = time.perf_counter()
+        stream = app.generate_story_stream(SAMPLE_PARAMS)
+        next(stream)
+        elapsed = time.perf_counter() - start
+        for _ in stream:
+            pass
+        return elapsed
+
+    ttft = sorted(time_to_first_token() * 1000 for _ in range(runs))
+    fake_server = {
+        'first_token_latency_s': server.first_token_latency,
+        'tokens_per_second': server.tokens_per_second,
+        'completion_tokens': server.completion_tokens
+    }
+    return [
+        {'name': 'generate_story', 'params': fake_server, 'stats': measure(lambda: app.generate_story(SAMPLE_PARAMS), runs)},
+        {'name': 'generate_story_stream', 'params': fake_server, 'stats': measure(lambda: "".join(app.generate_story_stream(SAMPLE_PARAMS)), runs)},
+        {'name': 'generate_story_stream.time_to_first_token', 'params': fake_server, 'stats': {
+            'repeat': runs,
+            'min_ms': round(ttft[0], 4),
+            'median_ms': round(statistics.median(ttft), 4),
+            'max_ms': round(ttft[-1], 4)
+        }}
+    ] + bench_section_edits(app, runs)
+
+
+def bench_section_edits(app, runs):
+    # Revising one paragraph of a ~500 word story, against regenerating the whole story
+    story = story_text(500)
+    middle = len(app.split_paragraphs(story)) // 2
+    results = []
+    for action in app.SECTION_ACTIONS:
+        prompt, report = app.build_section_prompt(SAMPLE_PARAMS, app.split_paragraphs(story), middle, middle + 1, action)
+        results.append({'name': f"edit_story_section.{action}",
+                        'params': {'prompt_tokens': report['prompt_tokens'], 'max_tokens': report['max_tokens'],
+                                   'story_tokens': app.count_tokens(story)},
+                        'stats': measure(lambda: "".join(app.edit_story_section_stream(SAMPLE_PARAMS, story, middle, middle + 1, action)), runs)})
+    return results
+
+
+def bench_request_policy(app, args, repeat):
+    # Primary model with an injected slow tail and errors, fallback model fast and healthy
+    runs = max(50, repeat)
+    server = FakeLLMServer(
+        args.first_token_latency, args.tokens_per_second, 100,
+        error_rate=args.error_rate, slow_rate=args.slow_rate, slow_latency=args.slow_latency, seed=0,
+        model_overrides={app.FALLBACK_MODEL or 'fallback': {'first_token_latency': args.first_token_latency / 2, 'error_rate': 0.0, 'slow_rate': 0.0}}
+    ).start()
+    previous = (os.environ['GROQ_BASE_URL'], app.FALLBACK_MODEL, app.LLM_HEDGE_DEFAULT_SECONDS)
+    os.environ['GROQ_BASE_URL'] = server.base_url
+    app._create_groq_client.clear()
+    # With only a handful of samples the hedge delay falls back to this default; roughly the healthy p95
+    app.LLM_HEDGE_DEFAULT_SECONDS = args.first_token_latency * 2 + 100 / args.tokens_per_second
+    params = {'first_token_latency_s': args.first_token_latency, 'error_rate': args.error_rate,
+              'slow_rate': args.slow_rate, 'slow_latency_s': args.slow_latency}
+
+    def generate():
+        try:
+            app.generate_story(SAMPLE_PARAMS)
+        except Exception:
+            pass
+
+    results = []
+    try:
+        for hedging, fallback in (('off', None), ('on', previous[1] or 'fallback')):
+            app.FALLBACK_MODEL = fallback
+            app.get_circuit_breakers.clear()
+            # The hedge delay is learnt from latency samples, start both runs from the same state
+            app.get_metrics_registry.clear()
+            results.append({'name': 'generate_story.request_policy', 'params': dict(params, hedging=hedging),
+                            'stats': measure(generate, runs, warmup=0)})
+    finally:
+        os.environ['GROQ_BASE_URL'], app.FALLBACK_MODEL, app.LLM_HEDGE_DEFAULT_SECONDS = previous
+        app._create_groq_client.clear()
+        server.stop()
+    return results
+
+
+def bench_fairness(app, workdir, args):
+    # Simulated multi-user load on a fake endpoint: one user floods interactive requests from many
+    # threads, one runs batch work, and a few light users send one request at a time. Runs with every
+    # request in a single FIFO flow, with per-user fair queueing, and with per-user token budgets too
+    server = FakeLLMServer(first_token_latency=0.05, tokens_per_second=2000, completion_tokens=200).start()
+    previous = (os.environ['GROQ_BASE_URL'], app.FALLBACK_MODEL, app.LLM_MAX_CONCURRENCY, app.USER_TOKENS_PER_MINUTE,
+                app.USER_TOKEN_BURST, app.LLM_PRIORITIES['interactive']['queue_timeout'])
+    os.environ['GROQ_BASE_URL'] = server.base_url
+    app._create_groq_client.clear()
+    app.FALLBACK_MODEL = None
+    app.LLM_MAX_CONCURRENCY = 4
+    app.LLM_PRIORITIES['interactive']['queue_timeout'] = 10
+    init_database(app, os.path.join(workdir, 'bench_fairness.db'))
+    users = {}
+    for name in ['heavy', 'batch'] + [f"light{n}" for n in range(args.light_users)]:
+        users[name] = app.add_user({'first_name': name, 'last_name': 'Bench', 'email': f"{name}@example.com", 'profession': 'Other',
+                                    'username': name, 'phone': '', 'password': 'secret'})
+
+    def run(mode):
+        app.get_llm_scheduler.clear()
+        app.USER_TOKENS_PER_MINUTE = 6000 if mode == 'fair_budgets' else 0
+        app.USER_TOKEN_BURST = 3000
+        samples = {'heavy': [], 'batch': [], 'light': []}
+        refused = {'heavy': 0, 'batch': 0, 'light': 0}
+        lock = threading.Lock()
+        workers = [('heavy', 'interactive', 6, 0.0)] * 8 + [('batch', 'batch', 6, 0.0)] * 4
+        workers += [(f"light{n}", 'interactive', 3, 0.2) for n in range(args.light_users)]
+        barrier = threading.Barrier(len(workers))
+
+        def worker(name, kind, requests, think):
+            group = name.rstrip('0123456789')
+            user_id = users[name] if mode != 'fifo' else None
+            barrier.wait()
+            if group == 'light':
+                # Arrive once the flood has filled the queue
+                time.sleep(0.1)
+            for _ in range(requests):
+                start = time.perf_counter()
+                try:
+                    app.generate_story_with_usage(SAMPLE_PARAMS, user_id=user_id, kind=kind if mode != 'fifo' else 'interactive')
+                except Exception:
+                    with lock:
+                        refused[group] += 1
+                    continue
+                with lock:
+                    samples[group].append((time.perf_counter() - start) * 1000)
+                time.sleep(think)
+
+        threads = [threading.Thread(target=worker, args=spec) for spec in workers]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return [{'name': f"llm_fairness.{group}", 'params': {'mode': mode, 'completed': len(samples[group]), 'refused': refused[group]},
+                 'stats': summarize(samples[group]) if samples[group] else {}} for group in samples]
+
+    results = []
+    try:
+        for mode in ('fifo', 'fair', 'fair_budgets'):
+            results += run(mode)
+        with app.db_connection() as conn:
+            recorded = conn.execute('SELECT SUM(requests) FROM llm_usage').fetchone()[0]
+        results.append({'name': 'llm_fairness.usage_rows', 'params': {'requests_recorded': recorded}, 'stats': {}})
+    finally:
+        (os.environ['GROQ_BASE_URL'], app.FALLBACK_MODEL, app.LLM_MAX_CONCURRENCY, app.USER_TOKENS_PER_MINUTE,
+         app.USER_TOKEN_BURST, app.LLM_PRIORITIES['interactive']['queue_timeout']) = previous
+        app._create_groq_client.clear()
+        app.get_llm_scheduler.clear()
+        server.stop()
+    return results
+
+
+def bench_reruns(app, workdir, repeat, stories):
+    rerun_dir = os.path.join(workdir, 'rerun')
+    os.makedirs(os.path.join(rerun_dir, 'db'))
+    shutil.copy(os.path.join(REPO_DIR, 'db', 'well_known_tales.xlsx'), os.path.join(rerun_dir, 'db'))
+    create_database(app, os.path.join(rerun_dir, 'storytelling_assistant.db'), stories)
+
+    previous_dir = os.getcwd()
+    os.chdir(rerun_dir)
+    try:
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            return _measure_reruns(rerun_dir, repeat, stories)
+    finally:
+        os.chdir(previous_dir)
+
+
+def _measure_reruns(rerun_dir, repeat, stories):
+    from streamlit.testing.v1 import AppTest
+
+    at = AppTest.from_file(os.path.join(REPO_DIR, 'app.py'), default_timeout=120)
+    at.session_state['user_id'] = 1
+    at.run()
+    results = [{'name': 'rerun.main_page', 'params': {'stories': stories}, 'stats': measure(at.run, repeat)}]
+
+    # Interactions: AppTest always reruns the whole script, so these show what the per-session
+    # cache saves; fragment-only reruns in a browser are reported as storyteller_fragment_seconds
+    use_cases = itertools.cycle(["Product Launch", "Team Building"])
+    results.append({'name': 'rerun.change_parameter', 'params': {'stories': stories},
+                    'stats': measure(lambda: at.selectbox(key='main_use_case').set_value(next(use_cases)).run(), repeat)})
+    next(button for button in at.sidebar.button if button.key and button.key.startswith('story_')).click().run()
+    edits = itertools.cycle([" The end.", " The beginning."])
+    results.append({'name': 'rerun.edit_story', 'params': {'stories': stories},
+                    'stats': measure(lambda: at.text_area(key='main_edit_story').input(story_text(250) + next(edits)).run(), repeat)})
+
+    at.radio(key='main_story_origin').set_value("Well-known Tale").run()
+    results.append({'name': 'rerun.main_page_tale', 'params': {'stories': stories}, 'stats': measure(at.run, repeat)})
+
+    at.session_state['page'] = 'professionals'
+    at.run()
+    results.append({'name': 'rerun.professionals_page', 'params': {'professionals': stories}, 'stats': measure(at.run, repeat)})
+    if at.exception:
+        logging.error(f"App raised during rerun benchmark: {at.exception}")
+    return results
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=REPO_DIR, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the hot paths of the storytelling assistant.")
+    parser.add_argument('--output', help="write JSON results to this file instead of stdout")
+    parser.add_argument('--sizes', default='10,1000,100000', help="comma separated row counts for the DB benchmarks")
+    parser.add_argument('--repeat', type=int, default=20, help="timed iterations per benchmark (default: 20)")
+    parser.add_argument('--quick', action='store_true', help="small sizes and few iterations, for a smoke run")
+    parser.add_argument('--first-token-latency', type=float, default=0.2, help="fake LLM time to first token in seconds")
+    parser.add_argument('--tokens-per-second', type=float, default=400.0, help="fake LLM streaming rate")
+    parser.add_argument('--completion-tokens', type=int, default=400, help="fake LLM completion length")
+    parser.add_argument('--slow-rate', type=float, default=0.03, help="share of primary model requests given extra latency (policy group)")
+    parser.add_argument('--slow-latency', type=float, default=2.0, help="extra latency of those requests in seconds (policy group)")
+    parser.add_argument('--error-rate', type=float, default=0.05, help="share of primary model requests that fail (policy group)")
+    parser.add_argument('--search-rows', type=int, default=100000, help="stories in the full-text search benchmark database")
+    parser.add_argument('--storage-rows', type=int, default=20000, help="stories in the storage benchmark database")
+    parser.add_argument('--bookers', type=int, default=32, help="concurrent threads in the booking load test")
+    parser.add_argument('--booking-attempts', type=int, default=25, help="bookings each of those threads attempts")
+    parser.add_argument('--logins', type=int, default=16, help="simultaneous logins in the auth benchmark")
+    parser.add_argument('--light-users', type=int, default=6, help="light interactive users in the fairness simulation")
+    parser.add_argument('--skip', default='', help="comma separated groups to skip: db,search,storage,booking,auth,tales,export,prompt,llm,policy,fairness,rerun")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    sizes = [10, 1000] if args.quick else [int(size) for size in args.sizes.split(',') if size]
+    repeat = 5 if args.quick else args.repeat
+    skip = set(filter(None, args.skip.split(',')))
+
+    server = FakeLLMServer(args.first_token_latency, args.tokens_per_second, args.completion_tokens).start()
+    os.environ['GROQ_BASE_URL'] = server.base_url
+    os.environ.setdefault('GROQ_API_KEY', 'benchmark')
+    workdir = prepare_workdir()
+    previous_dir = os.getcwd()
+    os.chdir(workdir)
+
+    import app
+    logging.getLogger().setLevel(logging.WARNING)
+    logging.getLogger('streamlit').setLevel(logging.ERROR)
+
+    results = []
+    try:
+        if 'db' not in skip:
+            results += bench_database(app, workdir, sizes, repeat)
+        if 'search' not in skip:
+            results += bench_search(app, workdir, 1000 if args.quick else args.search_rows, repeat)
+        if 'storage' not in skip:
+            results += bench_storage(app, workdir, 1000 if args.quick else args.storage_rows, repeat)
+        if 'booking' not in skip:
+            results += bench_booking(app, workdir, args.bookers, 5 if args.quick else args.booking_attempts)
+        if 'auth' not in skip:
+            results += bench_auth(app, workdir, 4 if args.quick else args.logins, repeat)
+        if 'tales' not in skip:
+            results += bench_tales(app, workdir, repeat)
+        if 'export' not in skip:
+            results += bench_exports(app, repeat)
+        if 'prompt' not in skip:
+            results += bench_prompt(app, app.get_well_known_tales()[0]['Story Text'], repeat)
+        if 'llm' not in skip:
+            results += bench_llm(app, server, repeat)
+        if 'policy' not in skip:
+            results += bench_request_policy(app, args, repeat)
+        if 'fairness' not in skip:
+            results += bench_fairness(app, workdir, args)
+        if 'rerun' not in skip:
+            results += bench_reruns(app, workdir, repeat, 1000 if not args.quick else 10)
+    finally:
+        os.chdir(previous_dir)
+        server.stop()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    report = {
+        'meta': {
+            'timestamp': datetime.now(timezone.utc).isoformat(),
+            'git_revision': git_revision(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'sizes': sizes,
+            'repeat': repeat
+        },
+        'results': results
+    }
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
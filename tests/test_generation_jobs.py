@@ -0,0 +1,80 @@
+import os
+import sys
+import tempfile
+import threading
+import time
+import types
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app
+
+PARAMETERS = {
+    "story_origin": "Personal Anecdote",
+    "use_case": "Personal Branding",
+    "time_frame": "Childhood",
+    "age": None,
+    "focus": ["Integrity"],
+    "length": "Short (250-500 words)",
+    "story_type": "What we believe: A story about values",
+    "narrative_structure": "Hero's Journey",
+    "simplified_structure": "The Quest",
+    "creative_enhancements": [],
+    "user_story_start": None
+}
+
+class SlowStartCompletions:
+    # Streams a short story, but only after first_chunk_delay seconds of silence
+    def __init__(self, first_chunk_delay):
+        self.first_chunk_delay = first_chunk_delay
+        self.calls = 0
+        self.lock = threading.Lock()
+    
+    def create(self, messages, model, stream=False, **options):
+        with self.lock:
+            self.calls += 1
+        
+        def chunks():
+            time.sleep(self.first_chunk_delay)
+            for word in "Once upon a time there was a fox.".split():
+                delta = types.SimpleNamespace(content=word + " ")
+                yield types.SimpleNamespace(choices=[types.SimpleNamespace(delta=delta)], x_groq=None)
+        return chunks()
+
+class GenerationJobLeaseTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.saved = {name: getattr(app, name) for name in ('DB_NAME', 'CACHE_DB_NAME', 'JOB_LEASE_SECONDS', 'JOB_WORKERS', 'FALLBACK_MODEL', 'groq_client')}
+        app.DB_NAME = os.path.join(self.directory.name, 'jobs.db')
+        app.CACHE_DB_NAME = os.path.join(self.directory.name, 'cache.db')
+        app.JOB_LEASE_SECONDS = 1
+        app.JOB_WORKERS = 2
+        app.FALLBACK_MODEL = None
+        self.completions = SlowStartCompletions(first_chunk_delay=3 * app.JOB_LEASE_SECONDS)
+        app.groq_client = types.SimpleNamespace(chat=types.SimpleNamespace(completions=self.completions))
+        app.init_db()
+    
+    def tearDown(self):
+        for name, value in self.saved.items():
+            setattr(app, name, value)
+        self.directory.cleanup()
+    
+    def test_silent_job_keeps_its_lease(self):
+        job_id = app.enqueue_generation_job(1, PARAMETERS, bypass_cache=True)
+        
+        deadline = time.time() + 30
+        job = app.get_job(job_id, 1)
+        while job['status'] in ('queued', 'running') and time.time() < deadline:
+            # Both workers poll while the first chunk is overdue; the lease must stop the idle one
+            if job['status'] == 'running' and time.time() - job['started_at'] > 2 * app.JOB_LEASE_SECONDS:
+                self.assertIsNone(app.claim_next_job())
+            time.sleep(0.2)
+            job = app.get_job(job_id, 1)
+        
+        self.assertEqual(job['status'], 'done')
+        self.assertTrue(job['result'].startswith("Once upon a time"))
+        self.assertEqual(self.completions.calls, 1)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,148 @@
+import os
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+sys.path.insert(0, os.path.join(REPO_DIR, 'benchmarks'))
+
+import app
+from fake_llm import FakeLLMServer
+
+PARAMETERS = {
+    "story_origin": "Personal Anecdote",
+    "use_case": "Personal Branding",
+    "time_frame": "Childhood",
+    "age": None,
+    "focus": ["Integrity"],
+    "length": "Short (250-500 words)",
+    "story_type": "What we believe: A story about values",
+    "narrative_structure": "Hero's Journey",
+    "simplified_structure": "The Quest",
+    "creative_enhancements": [],
+    "user_story_start": None
+}
+
+SETTINGS = ('DB_NAME', 'CACHE_DB_NAME', 'FALLBACK_MODEL', 'LLM_MAX_CONCURRENCY', 'LLM_TOKENS_PER_MINUTE',
+            'USER_TOKENS_PER_MINUTE', 'USER_TOKEN_BURST', 'BATCH_TOKENS_PER_MINUTE')
+
+class LLMSchedulerTest(unittest.TestCase):
+    # Multi-user load against benchmarks/fake_llm.py, the local stand-in for the Groq endpoint
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.saved = {name: getattr(app, name) for name in SETTINGS}
+        self.saved_environ = {name: os.environ.get(name) for name in ('GROQ_BASE_URL', 'GROQ_API_KEY')}
+        self.server = FakeLLMServer(first_token_latency=0.05, tokens_per_second=2000, completion_tokens=40).start()
+        os.environ['GROQ_BASE_URL'] = self.server.base_url
+        os.environ['GROQ_API_KEY'] = 'test'
+        app._create_groq_client.clear()
+        app.get_llm_scheduler.clear()
+        app.get_circuit_breakers.clear()
+        app.DB_NAME = os.path.join(self.directory.name, 'scheduler.db')
+        app.CACHE_DB_NAME = os.path.join(self.directory.name, 'cache.db')
+        app.FALLBACK_MODEL = None
+        app.LLM_MAX_CONCURRENCY = 2
+        app.LLM_TOKENS_PER_MINUTE = 0
+        app.USER_TOKENS_PER_MINUTE = 0
+        app.BATCH_TOKENS_PER_MINUTE = 0
+        app.init_db()
+        self.users = {name: self.add_user(name) for name in ('heavy', 'light', 'batch')}
+    
+    def tearDown(self):
+        for name, value in self.saved.items():
+            setattr(app, name, value)
+        for name, value in self.saved_environ.items():
+            if value is None:
+                os.environ.pop(name, None)
+            else:
+                os.environ[name] = value
+        app._create_groq_client.clear()
+        app.get_llm_scheduler.clear()
+        self.server.stop()
+        self.directory.cleanup()
+    
+    def add_user(self, name):
+        return app.add_user({'first_name': name, 'last_name': 'Test', 'email': f"{name}@example.com", 'profession': 'Other',
+                             'username': name, 'phone': '', 'password': 'secret'})
+    
+    def test_heavy_user_does_not_starve_light_user(self):
+        # The heavy user queues far more requests than there are turns; each of the light user's
+        # requests must still start within a turn or two instead of behind the whole backlog
+        grants = []
+        grants_lock = threading.Lock()
+        acquire = app.acquire_llm_turn
+        
+        def recording_acquire(user_id, kind, cost):
+            turn = acquire(user_id, kind, cost)
+            with grants_lock:
+                grants.append(user_id)
+            return turn
+        
+        app.acquire_llm_turn = recording_acquire
+        self.addCleanup(setattr, app, 'acquire_llm_turn', acquire)
+        
+        def heavy():
+            for _ in range(4):
+                app.generate_story_with_usage(PARAMETERS, user_id=self.users['heavy'])
+        
+        flood = [threading.Thread(target=heavy) for _ in range(8)]
+        for thread in flood:
+            thread.start()
+        while app.get_llm_scheduler_stats()['waiting']['interactive'] < 5:
+            time.sleep(0.01)
+        
+        light = self.users['light']
+        overtaken = []
+        for _ in range(3):
+            backlog = app.get_llm_scheduler_stats()['waiting']['interactive']
+            with grants_lock:
+                granted_before = len(grants)
+            app.generate_story_with_usage(PARAMETERS, user_id=light)
+            with grants_lock:
+                overtaken.append((backlog, grants[granted_before:].index(light)))
+        for thread in flood:
+            thread.join()
+        
+        for backlog, heavy_granted_first in overtaken:
+            self.assertLessEqual(heavy_granted_first, app.LLM_MAX_CONCURRENCY, f"queued behind {heavy_granted_first} of {backlog} heavy requests")
+        self.assertEqual(grants.count(self.users['heavy']), 32)
+    
+    def test_batch_work_draws_from_its_own_bucket(self):
+        app.USER_TOKENS_PER_MINUTE = 60
+        app.USER_TOKEN_BURST = 3000
+        app.BATCH_TOKENS_PER_MINUTE = 6000
+        user_id = self.users['batch']
+        cost = app.estimate_request_tokens(app.prepare_prompt(PARAMETERS), {})
+        
+        # More batch work than the interactive allowance could ever hold
+        for _ in range(app.USER_TOKEN_BURST // cost + 2):
+            app.generate_story_with_usage(PARAMETERS, user_id=user_id, kind='batch')
+        
+        buckets = app.get_llm_scheduler()['buckets']
+        self.assertLess(buckets[('batch', user_id)]['tokens'], app.BATCH_TOKENS_PER_MINUTE)
+        self.assertNotIn(('user', user_id), buckets)
+        self.assertEqual(app.get_llm_allowance(user_id)['available'], app.USER_TOKEN_BURST)
+        
+        # The user's interactive allowance is untouched, so the app still answers right away
+        start = time.monotonic()
+        app.generate_story_with_usage(PARAMETERS, user_id=user_id)
+        self.assertLess(time.monotonic() - start, 5)
+        kinds = {row['kind']: row['requests'] for row in app.get_llm_usage(user_id)}
+        self.assertEqual(kinds, {'batch': app.USER_TOKEN_BURST // cost + 2, 'interactive': 1})
+    
+    def test_exhausted_interactive_allowance_is_refused(self):
+        app.USER_TOKENS_PER_MINUTE = 1
+        app.USER_TOKEN_BURST = app.estimate_request_tokens(app.prepare_prompt(PARAMETERS), {})
+        user_id = self.users['light']
+        app.generate_story_with_usage(PARAMETERS, user_id=user_id)
+        
+        with self.assertRaisesRegex(Exception, "allowance"):
+            app.generate_story_with_usage(PARAMETERS, user_id=user_id)
+        # Batch work isn't charged against it
+        app.generate_story_with_usage(PARAMETERS, user_id=user_id, kind='batch')
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,148 @@
+import os
+import sys
+import tempfile
+import time
+import unittest
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+sys.path.insert(0, os.path.join(REPO_DIR, 'benchmarks'))
+
+import app
+from fake_llm import FakeLLMServer
+
+PARAMETERS = {
+    "story_origin": "Personal Anecdote",
+    "use_case": "Personal Branding",
+    "time_frame": "Childhood",
+    "age": None,
+    "focus": ["Integrity"],
+    "length": "Short (250-500 words)",
+    "story_type": "What we believe: A story about values",
+    "narrative_structure": "Hero's Journey",
+    "simplified_structure": "The Quest",
+    "creative_enhancements": [],
+    "user_story_start": None
+}
+
+SETTINGS = ('DB_NAME', 'CACHE_DB_NAME', 'FALLBACK_MODEL', 'LLM_MAX_RETRIES', 'LLM_HEDGE_DEFAULT_SECONDS',
+            'CIRCUIT_FAILURE_THRESHOLD', 'CIRCUIT_RESET_SECONDS', 'USER_TOKENS_PER_MINUTE', '_stream_once', '_complete_once')
+
+class RequestPolicyTest(unittest.TestCase):
+    # Circuit breaker and hedging against benchmarks/fake_llm.py, the local stand-in for the Groq endpoint
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.saved = {name: getattr(app, name) for name in SETTINGS}
+        self.saved_environ = {name: os.environ.get(name) for name in ('GROQ_BASE_URL', 'GROQ_API_KEY')}
+        self.server = FakeLLMServer(first_token_latency=0.05, tokens_per_second=2000, completion_tokens=40).start()
+        os.environ['GROQ_BASE_URL'] = self.server.base_url
+        os.environ['GROQ_API_KEY'] = 'test'
+        app._create_groq_client.clear()
+        app.get_llm_scheduler.clear()
+        app.get_circuit_breakers.clear()
+        # The hedge delay is learnt from latency samples; start from none, so the default applies
+        app.get_metrics_registry.clear()
+        app.DB_NAME = os.path.join(self.directory.name, 'policy.db')
+        app.CACHE_DB_NAME = os.path.join(self.directory.name, 'cache.db')
+        app.LLM_MAX_RETRIES = 0
+        app.USER_TOKENS_PER_MINUTE = 0
+        app.init_db()
+        # Created up front, so importing groq doesn't count against the first attempt's latency
+        app.get_groq_client()
+    
+    def tearDown(self):
+        for name, value in self.saved.items():
+            setattr(app, name, value)
+        for name, value in self.saved_environ.items():
+            if value is None:
+                os.environ.pop(name, None)
+            else:
+                os.environ[name] = value
+        # Abandoned attempts run on until the endpoint answers; let them finish before the server goes
+        app.get_llm_executor().shutdown(wait=True)
+        app.get_llm_executor.clear()
+        app._create_groq_client.clear()
+        app.get_circuit_breakers.clear()
+        app.get_metrics_registry.clear()
+        self.server.stop()
+        self.directory.cleanup()
+    
+    def circuit_state(self, model):
+        return app.get_circuit_states().get(model, {}).get('state', 'closed')
+    
+    def test_breaker_opens_then_half_opens(self):
+        app.FALLBACK_MODEL = None
+        app.CIRCUIT_FAILURE_THRESHOLD = 3
+        app.CIRCUIT_RESET_SECONDS = 0.5
+        model = app.STORY_MODEL
+        self.server.error_rate = 1.0
+        
+        for _ in range(app.CIRCUIT_FAILURE_THRESHOLD):
+            with self.assertRaises(Exception):
+                app.generate_story(PARAMETERS)
+        self.assertEqual(self.circuit_state(model), 'open')
+        
+        # While open, requests fail without reaching the endpoint
+        sent = self.server.requests
+        with self.assertRaises(Exception) as refused:
+            app.generate_story(PARAMETERS)
+        self.assertIn("temporarily unavailable", str(refused.exception.__cause__))
+        self.assertEqual(self.server.requests, sent)
+        
+        # After the reset time a single trial goes out; it fails, so the circuit opens again
+        time.sleep(app.CIRCUIT_RESET_SECONDS)
+        self.assertTrue(app.circuit_allows(model, take_trial=False))
+        self.assertEqual(self.circuit_state(model), 'open')
+        with self.assertRaises(Exception):
+            app.generate_story(PARAMETERS)
+        self.assertEqual(self.server.requests, sent + 1)
+        self.assertEqual(self.circuit_state(model), 'open')
+        
+        # Only one request may take the trial while it is in flight
+        time.sleep(app.CIRCUIT_RESET_SECONDS)
+        self.assertTrue(app.circuit_allows(model))
+        self.assertEqual(self.circuit_state(model), 'half_open')
+        self.assertFalse(app.circuit_allows(model))
+        
+        # A successful trial closes the circuit
+        time.sleep(app.CIRCUIT_RESET_SECONDS)
+        self.server.error_rate = 0.0
+        self.assertTrue(app.generate_story(PARAMETERS))
+        self.assertEqual(self.circuit_state(model), 'closed')
+    
+    def test_hedge_fires_only_after_hedge_delay(self):
+        app.LLM_HEDGE_DEFAULT_SECONDS = 0.3
+        primary, fallback = app.STORY_MODEL, app.FALLBACK_MODEL or 'fallback'
+        app.FALLBACK_MODEL = fallback
+        started = []
+        
+        def recording(attempt):
+            def record(model, *args):
+                started.append((model, time.monotonic()))
+                return attempt(model, *args)
+            return record
+        
+        app._stream_once = recording(self.saved['_stream_once'])
+        app._complete_once = recording(self.saved['_complete_once'])
+        generators = {
+            'stream': lambda: "".join(app.generate_story_stream(PARAMETERS)),
+            'complete': lambda: app.generate_story(PARAMETERS)
+        }
+        for mode, generate in generators.items():
+            with self.subTest(mode=mode, primary='fast'):
+                started.clear()
+                self.server.model_overrides = {primary: {'first_token_latency': 0.05}}
+                self.assertTrue(generate())
+                self.assertEqual([model for model, _ in started], [primary])
+            
+            with self.subTest(mode=mode, primary='slow'):
+                started.clear()
+                self.server.model_overrides = {primary: {'first_token_latency': 1.0}, fallback: {'first_token_latency': 0.05}}
+                hedge_wins = app.get_metrics_summary()[1].get(('storyteller_llm_hedge_wins_total', (('model', fallback),)), 0)
+                self.assertTrue(generate())
+                self.assertEqual([model for model, _ in started], [primary, fallback])
+                self.assertGreaterEqual(started[1][1] - started[0][1], app.LLM_HEDGE_DEFAULT_SECONDS - 0.05)
+                self.assertEqual(app.get_metrics_summary()[1][('storyteller_llm_hedge_wins_total', (('model', fallback),))], hedge_wins + 1)
+
+if __name__ == '__main__':
+    unittest.main()